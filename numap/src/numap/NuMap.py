@@ -9,31 +9,98 @@ map function, which can use threads and processes.
 """
 
 try:
-    from multiprocessing import Process, cpu_count, TimeoutError
+    from multiprocessing import Process, Pipe, cpu_count, TimeoutError, Lock
     from multiprocessing.queues import SimpleQueue
+    from multiprocessing.sharedctypes import RawArray
     HASMP = True
 except ImportError:
     HASMP = False
+try:
+    # for the template process
+    from _multiprocessing import Connection, sendfd, recvfd
+    from multiprocessing.forking import prepare
+    HASFD = True
+except ImportError:
+    HASFD = False
+try:
+    # for cpu affinity
+    from ctypes import CDLL, c_ulong, sizeof, get_errno
+    # the symbols of the process, no library is searched
+    _libc = CDLL(None, use_errno=True)
+    _libc.sched_setaffinity, _libc.sched_getaffinity
+    HASAFF = True
+except (OSError, AttributeError, TypeError):
+    HASAFF = False
 try:
     import rpyc
     HASRP = True
 except ImportError:
     HASRP = False
+try:
+    import asyncio
+    HASAIO = True
+except ImportError:
+    try:
+        import trollius as asyncio
+        HASAIO = True
+    except ImportError:
+        HASAIO = False
 
 # Threading and Queues
-from threading import Thread, Semaphore, Event
+from threading import Thread, Semaphore, Event, Condition
 from threading import Lock as tLock
+from threading import local, current_thread
 from Queue import Queue, Empty
-# for PriorityQueue
-from heapq import heappush, heappop
+try:
+    # for per-worker channels
+    from select import select
+    from fcntl import ioctl, fcntl, F_GETFD, F_SETFD, FD_CLOEXEC
+    from termios import FIONREAD
+    HASCH = True
+except ImportError:
+    HASCH = False
+from array import array
+# for tracing
+from collections import deque, OrderedDict
+# for the result cache
+from hashlib import sha1
+from types import CodeType
+# for shared memory
+from mmap import mmap
+from cPickle import dumps, load, loads, Pickler, Unpickler, \
+                    HIGHEST_PROTOCOL
+from cStringIO import StringIO
+# for the template process
+import os
+import sys
+import atexit
+import logging
+from socket import socketpair
+from subprocess import Popen
+from signal import signal, SIGCHLD, SIGTERM, SIG_IGN, SIG_DFL
+# for element timeouts
+from signal import setitimer, SIGALRM, ITIMER_REAL
+from tempfile import TemporaryFile
+from ctypes import c_int
 # Misc.
-from itertools import izip, repeat
+from time import time, sleep
+from itertools import izip, repeat, count
+from functools import partial
 from inspect import getsource, isbuiltin, isfunction
 # sets-up logging
 from logging import getLogger
 log = getLogger(__name__)
 import warnings
 
+try:
+    StopAsyncIteration
+except NameError:
+    class StopAsyncIteration(Exception):
+        """
+        Raised by the future returned from ``NuMap.anext`` if the **task** is
+        finished.
+        """
+
 
 class NuMap(object):
     """
@@ -62,6 +129,13 @@ class NuMap(object):
     **not** include workers needed to run remote processes and can be equal 
     ``0`` for a purely remote ``NuMaps``.
 
+    An "inline" ``NuMap`` has no pool, no manager threads and no "buffer". An
+    element is evaluated in the calling thread, when its result is requested
+    by ``NuMap.next``, the **tasks** are evaluated in the order in which 
+    their results are consumed. Results are returned in order, tracked, 
+    cached and counted like results from a pool, which allows to switch 
+    between serial and parallel evaluation e.g. for profiling.
+
 
     *Iteration*
  
@@ -95,6 +169,15 @@ class NuMap(object):
     collapse the ``NuMap`` evaluation. Do **not* specify timeouts in for
     chained **tasks**.
 
+    The "timeout" of ``NuMap.next`` does not stop the evaluation of the late 
+    element, which still occupies its **worker**. A **task** added with an 
+    "item_timeout" limits each call of its callable inside the **worker**, a 
+    call, which takes longer raises a ``TimeoutError``, which is returned as
+    the result of the element. In "process" **workers** the call is 
+    interrupted by ``SIGALRM``, in "thread" **workers** the ``TimeoutError`` 
+    is raised asynchronously in the **worker** thread, when it executes the 
+    next Python instruction i.e. blocking calls are not interrupted.
+
     
     *Parallel evaluation*
     
@@ -131,6 +214,144 @@ class NuMap(object):
     satisfy the worst case number of queued results is lower then the safe 
     default.
     
+    A **task** added with a "batch" size is evaluated in batches of 
+    consecutive elements. Its callable is called once per chunk with a 
+    ``list`` of the elements and returns a sequence with a result for each 
+    element, the results are returned one by one as for any other **task**. 
+    If the callable raises an exception or returns the wrong number of 
+    results all elements of the batch fail. Batches do not span strides, 
+    therefore the "stride" is raised to the largest "batch" and the "buffer" 
+    cannot be smaller than a "batch". The pool putter does not send a partial
+    batch before it blocks on the "buffer", while earlier results of its 
+    **task** are pending, because their retrieval makes room for the rest of
+    the batch.
+    
+    
+    *Automatic tuning*
+    
+    If the "stride" or the "buffer" is ``'auto'`` the pool putter measures the 
+    time it waits for the "buffer" and the number of elements in the pool 
+    (which is smaller then the number of **workers** if some are idle). At the
+    end of each rotation through the **tasks** the "buffer" grows if idle 
+    **workers** wait for the "buffer" and shrinks if the pool is saturated. The
+    "stride" grows if **workers** are idle and shrinks if the pool is 
+    over-subscribed. The "buffer" never drops below the number of **tasks** 
+    times the "stride", which is the safe default. An automatic "stride" must
+    not be used with ``NuMaps`` shared by ``Pipers`` with multiple downstream
+    ``Pipers``, because ``itertools.tee`` objects are locked for a fixed 
+    "stride".
+
+
+    *Weights*
+
+    By default each **task** contributes "stride" elements to every rotation. 
+    A **task** added with a "weight" contributes "stride" times its "weight" 
+    relative to the smallest "weight" elements, fractions are carried over to 
+    the next rotation (deficit round-robin). A **task**, which consumes the 
+    results of another **task** of the same ``NuMap`` has the "weight" of that
+    **task**. If "balance" is ``True`` the weights are set before each 
+    rotation from the measured compute time per element of the chained 
+    **tasks**, such that independent chains get a similar share of the 
+    **worker** time. The default "buffer" holds a weighted rotation and is 
+    doubled if "balance" is ``True``, balancing never exceeds the initial 
+    "buffer". The results of **tasks** have to be consumed at the rates given
+    by their weights e.g. from separate threads, otherwise the ``NuMap`` 
+    might dead-lock. Weights must not be used with ``NuMaps`` shared by 
+    ``Pipers`` with multiple downstream ``Pipers`` (see: *Automatic tuning*)
+    or if **tasks** consume the results of other **tasks** in any other way.
+
+
+    *Backpressure*
+
+    If "schedule" is ``'backpressure'`` the pool putter does not rotate through
+    the **tasks**. It takes the next elements from the most downstream 
+    **task**, which consumes results of another **task** of the same ``NuMap``
+    that are available, otherwise it feeds the input **tasks** in turns. A 
+    **task** is not fed while it holds "stride" elements, which are evaluated 
+    or not yet consumed. Elements move through chained **tasks** first, which
+    lowers the latency and the number of buffered results. The results of all
+    end **tasks** have to be consumed. Weights are ignored.
+
+
+    *Byte budget*
+
+    If "buffer_bytes" is given the "buffer" is a budget of bytes. Each 
+    element is charged with its share of the size of its pickled chunk, first
+    of the input or the size of the last result of its **task** if larger, 
+    and after the chunk has been evaluated of the results. The charge is 
+    returned when the result is retrieved. The pool putter waits if the 
+    budget is exceeded, but at least the safe default "buffer" of elements is
+    always allowed, a single element larger than the budget does not 
+    dead-lock. Until the first results arrive only the safe default "buffer"
+    of elements is submitted. A given "buffer" remains the limit on the number of 
+    elements. "buffer_bytes" cannot be combined with *Automatic tuning*.
+
+
+    *Affinity*
+
+    By default the **workers** run on any CPU. If "affinity" is 
+    ``'compact'`` each local **worker** is pinned to a single CPU, CPUs are 
+    used NUMA node by node. If ``'spread'`` the **workers** are pinned to the
+    CPU sets of the NUMA nodes in turn, no memory policy is set. If 
+    ``'reserve'`` the first CPU is reserved for the pool putter and pool 
+    getter threads and the **workers** are pinned compactly to the remaining
+    CPUs. A sequence of CPUs or CPU sets is used in turn, the n-th
+    **worker** is pinned to its n-th item. The topology is read from 
+    ``/sys``, only the CPUs allowed for the ``NuMap`` process are used. The 
+    layout is reported by ``NuMap.stats``. Requires "process" **workers** 
+    and Linux.
+
+
+    *Template*
+
+    By default "process" **workers** are forked from the ``NuMap`` process and
+    inherit its memory. If "start_method" is ``'template'`` a template process
+    is started, when the first **task** is added. It is a fresh Python 
+    interpreter, which imports the modules of the callables of the **tasks** 
+    and the modules listed by their ``imports`` decorators, when the **tasks** 
+    are added. The main module is imported (without running the code guarded
+    by ``if __name__ == '__main__'``) only if a callable is defined in it. The 
+    **workers** are forked from the warm template process, so they start 
+    quickly and do not inherit the memory of the ``NuMap`` process. The 
+    template process ends together with the **worker pool**. Like for
+    ``multiprocessing`` on Windows the callables and arguments of **tasks** 
+    have to be picklable.
+
+
+    *Worker state*
+
+    Each **worker** thread or process calls the "initializer" with "initargs"
+    once, when it is started. The "initializer" can prepare expensive objects 
+    e.g. load a model or open a database connection and store them in the 
+    ``dict`` returned by ``worker_state``. The callables of the **tasks** get
+    the same ``dict`` from ``worker_state``, it persists for the lifetime of 
+    the **worker** also between the runs of a persistent **worker pool**. If 
+    the "initializer" raises an exception all elements evaluated by the 
+    **worker** raise it.
+
+
+    *Cache*
+
+    A **task** added with a "cache" (a ``Cache`` instance) memoizes its 
+    results. The key of an element is a hash of the pickled callable, the 
+    arguments of the **task** and the pickled element. The pool putter looks
+    up each element in the ``Cache``, a hit does not enter the pool, its 
+    result is passed to the pool getter, which returns it in order. Results, 
+    which are not exceptions are stored in the ``Cache``. A ``Cache`` has an 
+    in-memory least-recently used tier and an optional on-disk tier, it can 
+    be shared by **tasks** and ``NuMap`` instances. The "cache" requires the
+    ``'pipe'`` "transport".
+
+
+    *Hedging*
+
+    In an "ordered" ``NuMap`` a slow element holds back all later results. 
+    Chunks of **tasks**, which callables are decorated with ``idempotent`` 
+    are duplicated if they have been in the **worker pool** much longer than
+    the recent chunks of their **task** and some **workers** are idle. The 
+    first result of a chunk is returned the results of its duplicate are 
+    discarded by the pool getter.
+    
     
     *Stopping*
     
@@ -148,10 +369,15 @@ class NuMap(object):
         for "func" required if "func" is given
       - args (``tuple``) [default: ``None``] optional, see: ``NuMap.add_task`` 
       - kwargs (``dict``) [default: ``None``] optional, see: ``NuMap.add_task``
-      - worker_type(``'process'`` or ``'thread'``) [default: ``'process'``] 
-        Defines the type of internally spawned pool workers. For 
-        ``multiprocessing.Process`` based worker choose 'process' for 
-        ``threading.Thread`` workers choose 'thread'.
+      - worker_type(``'process'``, ``'thread'``, ``'asyncio'`` or 
+        ``'inline'``) [default: ``'process'``] Defines the type of internally
+        spawned pool workers. For ``multiprocessing.Process`` based worker 
+        choose 'process' for ``threading.Thread`` workers choose 'thread'. For
+        'asyncio' a single thread runs an event loop, on which up to 
+        "worker_num" elements are evaluated concurrently. The functions of the
+        **tasks** should return coroutines or futures. Requires ``asyncio`` or
+        ``trollius``. For 'inline' the elements are evaluated in the calling 
+        thread see: *Pool*.
       - worker_num(int) [default: number of CPUs, min: 1] The number of workers 
         to spawn locally. Defaults to the number of availble CPUs, which is a 
         reasonable choice for process-based  ``NuMaps``.
@@ -160,10 +386,22 @@ class NuMap(object):
         ``(('localhost', 2]), ('127.0.0.1', 2))`` "remote worker_num" is the 
         number of workers processes per remote host. A custom ``TCP`` port can 
         be specified ``(('localhost:6666',2),)``.
-      - stride(``int``) [default: automatic] number of elements from a **task**
-        evaluated in parallel
-      - buffer(``int``) [default: automatic] total number number of elements 
-        (inputs and results) in the ``NuMap`` instance
+      - stride(``int`` or ``'auto'``) [default: automatic] number of elements 
+        from a **task** evaluated in parallel. If ``'auto'`` the "stride" starts
+        at the number of **workers** and is adapted while the ``NuMap`` is 
+        running see: *Automatic tuning*.
+      - buffer(``int`` or ``'auto'``) [default: automatic] total number number 
+        of elements (inputs and results) in the ``NuMap`` instance. If 
+        ``'auto'`` the "buffer" is adapted while the ``NuMap`` is running 
+        between the safe minimum and "buffer_max" see: *Automatic tuning*.
+      - buffer_max(``int``) [default: ``None``] The ceiling of an automatic 
+        "buffer" defaults to 4 times the safe default "buffer".
+      - buffer_bytes(``int``) [default: ``None``] The total size in bytes of 
+        the pickled elements (inputs and results) in the ``NuMap`` instance 
+        see: *Byte budget*. Requires "process" **workers**.
+      - affinity(``str`` or sequence) [default: ``None``] Pins local "process"
+        **workers** to CPUs. Either ``'compact'``, ``'spread'``, ``'reserve'``
+        or a sequence of CPUs or CPU sets see: *Affinity*.
       - ordered(``bool``) [default: ``True``] If ``True`` the output of all 
         **tasks** will be ordered see: order.
       - skip(``bool``) [default: ``False``] Should we skip a result if trying to
@@ -171,6 +409,57 @@ class NuMap(object):
       - name(``str``) [default: "imap_id(id(object))"] an optional name to 
         associate with this ``NuMap`` instance. It should be unique. Useful for 
         code generation.            
+      - transport(``'pipe'`` or ``'shm'``) [default: ``'pipe'``] How elements 
+        and results are passed between the ``NuMap`` and "process" **workers**.
+        If ``'shm'`` payloads larger than "shm_threshold" are placed in a 
+        shared memory arena of "shm_size" bytes and only a small handle is send
+        through the pipe. A result is copied out of the arena and its memory 
+        is reclaimed when it is returned by ``NuMap.next``. Requires local 
+        "process" **workers**.
+      - shm_size(``int``) [default: ``2 ** 28``] size of the shared memory 
+        arena in bytes
+      - shm_threshold(``int``) [default: ``2 ** 16``] minimum size in bytes of 
+        a payload, which is placed in the shared memory arena.
+      - dispatch(``'shared'``, ``'round_robin'`` or ``'depth'``) [default: 
+        ``'shared'``] How elements are fed to "process" **workers**. If 
+        ``'shared'`` all **workers** read from a single queue. Otherwise each 
+        **worker** has its own input channel, which is chosen in turns 
+        (``'round_robin'``) or by the smallest number of pending bytes 
+        (``'depth'``). An idle **worker** steals elements from the channels of 
+        busy **workers**. This avoids contention on the lock of the shared 
+        queue for large pools. Without ``select`` and ``fcntl`` the single 
+        queue is used.
+      - chunksize(``int`` or ``'auto'``) [default: ``1``] The maximum number of
+        elements from a **task** send to a **worker** in a single message and 
+        returned as a single message. Chunks do not span strides, so the 
+        "chunksize" is at most "stride". Larger chunks reduce the pickling and
+        pipe overhead for cheap functions. If ``'auto'`` the "stride" is split
+        evenly between all **workers**. Can be overridden for each **task** 
+        see: ``NuMap.add_task``.
+      - persistent(``bool``) [default: ``False``] If ``True`` the **worker 
+        pool** is kept alive by ``NuMap.stop`` and reused by the next 
+        ``NuMap.start``, which sends the new **tasks** to the waiting 
+        **workers**. The pool is torn down by ``NuMap.shutdown``. Callables 
+        and arguments of **tasks** of later runs of a "process" pool have to 
+        be picklable.
+      - retries(``int``) [default: ``1``] If a "process" **worker** dies e.g.
+        it is killed or crashes, it is replaced and the chunk it evaluated is
+        submitted again at most "retries" times. Afterwards the elements of 
+        the chunk raise a ``RuntimeError``.
+      - balance(``bool``) [default: ``False``] If ``True`` the weights of the 
+        **tasks** are adapted to their compute time see: *Weights*.
+      - schedule(``'weave'`` or ``'backpressure'``) [default: ``'weave'``] How
+        the pool putter chooses the next **task**. If ``'weave'`` it rotates 
+        through the **tasks** see: *Backpressure*.
+      - start_method(``'fork'`` or ``'template'``) [default: ``'fork'``] How
+        "process" **workers** are started. If ``'fork'`` they are forked from 
+        the ``NuMap`` process see: *Template*. The "template" requires the 
+        ``'pipe'`` "transport".
+      - initializer(callable) [default: ``None``] Called by each **worker** 
+        when it is started see: *Worker state*. Remote **workers** call it in
+        the local process.
+      - initargs(``tuple``) [default: ``None``] The arguments of the 
+        "initializer".
 
     Restrictions:
     
@@ -182,34 +471,83 @@ class NuMap(object):
 
     @staticmethod
     def _pool_put(pool_semaphore, tasks, put_to_pool_in, pool_size, id_self, \
-                  is_stopping):
+                  is_stopping, chunksizes, arena, tuner, stats, balancer=None, \
+                  memos=None, inject=None, budget=None, batched=None, \
+                  released=None):
         """ 
         (internal) Intended to be run in a seperate thread. Feeds tasks into 
         to the pool whenever semaphore permits. Finishes if self._stopping is 
-        set.
+        set. Consecutive elements of a **task** are grouped into chunks of at
+        most "chunksizes[task]" elements, which are send as a single message.
+        A chunk never spans two strides and is flushed before the pool putter
+        blocks on the semaphore, unless it is a batch of a "batched" **task**,
+        which has earlier elements, which have not been "released". Large 
+        elements are placed in the shared 
+        memory "arena" if given. The "tuner" if given adapts the stride and
+        semaphore before each rotation of the weave, the "balancer" if given
+        adapts the weights of the **tasks**. Submitted elements, the time 
+        waited for the semaphore and the serialization of chunks are counted
+        in "stats". Elements, which results are found in the "memos" of their 
+        **tasks** are not submitted, their results are passed to the pool 
+        getter by "inject". The elements are charged with the size of the 
+        pickled chunks in the "budget" if given.
         """
         log.debug('NuMap(%s) started pool_putter.' % id_self)
+        task_stats = stats.tasks
+        sequence = count()
+
+        def pack(task, chunk):
+            # chunk message, if the pool is not threaded the whole message is
+            # pickled here and send as it is
+            index, size = chunk[0][0], len(chunk)
+            counters = task_stats[task]
+            counters['submitted'] += size
+            message = (task, chunk, time(), sequence.next())
+            if stats.pickled:
+                start = time()
+                indices = [item[0] for item in chunk]
+                frame = _dump_chunk(message)
+                counters['input_bytes'] += len(frame)
+                counters['input_time'] += time() - start
+                if budget is not None:
+                    budget.submit(task, indices, len(frame))
+                message = (task, frame) + message[2:]
+            if _tracer.on:
+                _tracer.record('submit', id_self, task, index, size)
+            return message
+
+        # elements, which have acquired the semaphore
+        taken = [0] * tasks.lenght
+
         last_tasks = {}
         for task in xrange(tasks.lenght):
             last_tasks[task] = -1
         stop_tasks = []
+        chunk_head, chunk = None, []
         while True:
             # are we stopping the Weaver?
             if is_stopping():
                 log.debug('NuMap(%s) pool_putter has been told to stop.' % \
                            id_self)
                 tasks.stop()
+            # about to start a new rotation
+            if tasks.r == tasks.repeats and tasks.i == tasks.lenght - 1:
+                if tuner is not None:
+                    tuner.rotate()
+                if balancer is not None:
+                    balancer.rotate()
             # try to get a task
             try:
-                log.debug('NuMap(%s) pool_putter waits for next task.' % \
-                           id_self)
                 task = tasks.next()
-                log.debug('NuMap(%s) pool_putter received next task.' % id_self)
             except StopIteration:
                 # Weaver raised a StopIteration
                 stop_task = tasks.i # current task
                 log.debug('NuMap(%s) pool_putter caught StopIteration from task %s.' % \
                                                                   (id_self, stop_task))
+                if chunk:
+                    # a partial chunk of the stopped task
+                    put_to_pool_in(pack(chunk_head[0], chunk))
+                    chunk_head, chunk = None, []
                 if stop_task not in stop_tasks:
                     # task raised stop for the first time.
                     log.debug('NuMap(%s) pool_putter task %s first-time finished.' % \
@@ -219,6 +557,9 @@ class NuMap(object):
                     log.debug('NuMap(%s) pool_putter sends a sentinel for task %s.' % \
                                                            (id_self, stop_task))
                     put_to_pool_in((stop_task, None, last_tasks[stop_task]))
+                    if _tracer.on:
+                        _tracer.record('stop', id_self, stop_task, \
+                                       last_tasks[stop_task])
                 if len(stop_tasks) == tasks.lenght:
                     log.debug('NuMap(%s) pool_putter sent sentinels for all tasks.' % \
                                                                         id_self)
@@ -235,25 +576,76 @@ class NuMap(object):
 
             # got task
             last_tasks[tasks.i] = task[-1][0] # last valid result
-            log.debug('NuMap(%s) pool_putter waits for semaphore for task %s' % \
-                       (id_self, task))
-            pool_semaphore.acquire()
-            log.debug('NuMap(%s) pool_putter gets semaphore for task %s' % \
-                       (id_self, task))
-            #gc.disable()
-            put_to_pool_in(task)
-            #gc.enable()
-            log.debug('NuMap(%s) pool_putter submits task %s to worker.' % \
-                       (id_self, task))
+            if not pool_semaphore.acquire(False):
+                # we are going to block, the results from the partial chunk 
+                # might be needed to release the semaphore.
+                if chunk and not (batched and batched[chunk_head[0]] and \
+                                  taken[chunk_head[0]] - len(chunk) > \
+                                  released[chunk_head[0]]):
+                    put_to_pool_in(pack(chunk_head[0], chunk))
+                    chunk_head, chunk = None, []
+                waits = time()
+                pool_semaphore.acquire()
+                waited = time() - waits
+                task_stats[tasks.i]['semaphore_wait'] += waited
+                if tuner is not None:
+                    tuner.waited += waited
+            taken[tasks.i] += 1
+            memo = memos[tasks.i] if memos else None
+            if memo is not None:
+                i, data = task[-1]
+                key = memo.key(data)
+                hit, result = memo.cache.get(key) if key is not None else \
+                              (False, None)
+                if hit:
+                    # the result by-passes the pool
+                    task_stats[tasks.i]['cached'] += 1
+                    results = [(i, True, result)]
+                    inject((tasks.i, results, (None, time(), 0., 0., 0., 0, \
+                                               0.), sequence.next()))
+                    if chunk and tasks.r == tasks.repeats:
+                        put_to_pool_in(pack(chunk_head[0], chunk))
+                        chunk_head, chunk = None, []
+                    continue
+                if key is not None:
+                    memo.pending[i] = key
+            if tuner is not None:
+                tuner.submit()
+            chunk_head = task[:-1]
+            chunk.append(task[-1] if arena is None else \
+                         (task[-1][0], arena.dumps(task[-1][1])))
+            # the chunk is full or the stride is finished
+            if len(chunk) == chunksizes[tasks.i] or tasks.r == tasks.repeats:
+                #gc.disable()
+                put_to_pool_in(pack(chunk_head[0], chunk))
+                #gc.enable()
+                chunk_head, chunk = None, []
         log.debug('NuMap(%s) pool_putter returns' % id_self)
 
     @staticmethod
-    def _pool_get(get, results, next_available, task_next_lock, to_skip, \
-                  task_num, pool_size, id_self):
+    def _pool_get(get, results, reorders, ordered, task_next_lock, to_skip, \
+                  task_num, pool_size, id_self, arena, tuner, stats, waiters, \
+                  memos=None, hedger=None, budget=None, pressure=None):
         """ 
         (internal) Intended to be run in a separate thread and take results from
         the pool and put them into queues depending on the task of the result. 
         It finishes if it receives termination-sentinels from all pool workers.
+        The "reorders" of the **tasks** hold results until all previous results
+        have arrived if the ``NuMap`` is "ordered", otherwise they only track 
+        which results have arrived. If "reorders" is ``None`` the ``NuMap`` is
+        unordered and does not skip results, chunks of results are passed 
+        without locking to the ``_Unordered`` "results".
+        Skipped results are removed from the shared memory "arena" if given.
+        The number of received results is counted by the "tuner" if given.
+        Results, the timings piggybacked by the **workers** and the depth of 
+        the reorder buffer are counted in "stats". The "waiters" of a **task** 
+        are called whenever new results might be available. Results, which are
+        not exceptions are stored in the "memos" of their **tasks**, results 
+        from the "memos" have no **worker**. The results of duplicated chunks, 
+        which arrive second are discarded if a "hedger" is given. The elements
+        are charged with the size of the pickled results in the "budget" if 
+        given. Results put into the queues are counted by the "pressure" if 
+        given.
         """
         log.debug('NuMap(%s) started pool_getter' % id_self)
         # should return when all workers have returned, each worker sends a 
@@ -261,15 +653,14 @@ class NuMap(object):
         # all tasks but the next available queue should be released only if we 
         # now that no new results will arrive.
         sentinels = 0
-        result_ids, last_result_id, very_last_result_id = {}, {}, {}
+        very_last_result_id, received = {}, {}
         for i in xrange(task_num):
-            last_result_id[i] = -1
             very_last_result_id[i] = -2
-            result_ids[i] = set()
+            received[i] = 0
+        task_stats, worker_stats = stats.tasks, stats.workers
 
         while True:
             try:
-                log.debug('NuMap(%s) pool_getter waits for a result.' % id_self)
                 #gc.disable()
                 result = get()
                 #gc.enable()
@@ -295,72 +686,218 @@ class NuMap(object):
             if result[1] is None:
                 task = result[0]
                 very_last_result_id[task] = result[2]
-                if last_result_id[task] == very_last_result_id[task]:
+                last = received[task] - 1 if reorders is None else \
+                       reorders[task].last
+                if last == very_last_result_id[task]:
                     results[task].put(('stop', False, 'stop'))
-                    next_available[task].put(True)
+                    if pressure is not None:
+                        pressure.arrive(task)
+                    if _tracer.on:
+                        _tracer.record('stop', id_self, task, result[2])
                     log.debug('NuMap(%s) pool_getter sent sentinel for task %s.'\
                                                             % (id_self, task))
+                    if waiters[task]:
+                        _wake(waiters[task])
+                continue
+
+            # got a chunk of results for some task, which might be exceptions
+            task, chunk, timing, seq = result
+            if hedger is not None and not hedger.receive(seq):
+                # the duplicate of this chunk has won
+                if arena is not None:
+                    for i, is_valid, real_result in chunk:
+                        arena.free(real_result)
+                continue
+            worker, started, queued, loaded, computed, dumped_bytes, dumped = \
+                                                                         timing
+            if stats.pickled and budget is not None:
+                budget.receive(task, [item[0] for item in chunk], dumped_bytes)
+            counters = task_stats[task]
+            if worker is None:
+                # results from the cache by-passed the pool
+                counters['completed'] += len(chunk)
+            else:
+                counters['inqueue_time'] += queued
+                counters['input_time'] += loaded
+                counters['compute_time'] += computed
+                counters['output_bytes'] += dumped_bytes
+                counters['output_time'] += dumped
+                wcounters = worker_stats[worker]
+                wcounters['chunks'] += 1
+                wcounters['inqueue_time'] += queued
+                wcounters['input_time'] += loaded
+                wcounters['compute_time'] += computed
+                wcounters['output_bytes'] += dumped_bytes
+                wcounters['output_time'] += dumped
+                if tuner is not None:
+                    tuner.received += len(chunk)
+                memo = memos[task] if memos else None
+                for i, is_valid, real_result in chunk:
+                    if is_valid:
+                        counters['completed'] += 1
+                        wcounters['completed'] += 1
+                    else:
+                        counters['failed'] += 1
+                        wcounters['failed'] += 1
+                    if memo is not None:
+                        key = memo.pending.pop(i, None)
+                        if is_valid and key is not None:
+                            memo.cache.put(key, real_result)
+            if _tracer.on:
+                _tracer.record('start', id_self, task, chunk[0][0], worker, \
+                               started)
+                _tracer.record('finish', id_self, task, chunk[0][0], worker, \
+                               started + loaded + computed)
+
+            if reorders is None:
+                # the unordered fast path
+                results[task].extend(chunk)
+                received[task] += len(chunk)
+                queued = len(chunk)
+                if received[task] == very_last_result_id[task] + 1:
+                    results[task].put(('stop', False, 'stop'))
+                    queued += 1
+                if pressure is not None:
+                    pressure.arrive(task, queued)
+                if waiters[task]:
+                    _wake(waiters[task])
                 continue
 
-            # got some result for some task, which might be an exception
-            task, i, is_valid, real_result = result
             # locked if next for this task is in 
             # the process of raising a TimeoutError
             task_next_lock[task].acquire()
-            log.debug('NuMap(%s) pool_getter received result %s for task %s)' % \
-                      (id_self, i, task))
+            reorder = reorders[task]
+            queued = 0
 
             if to_skip[task]:
-                log.debug('NuMap(%s) pool_getter skips results: %s' % (id_self, \
-                range(last_result_id[task] + 1, last_result_id[task] + \
-                      to_skip[task] + 1)))
-                last_result_id[task] += to_skip[task]
+                # held back, but will not be released
+                for item in reorder.skip(to_skip[task]):
+                    if ordered and arena is not None:
+                        arena.free(item[2])
+                    if ordered and budget is not None:
+                        budget.discharge(task, item[0])
                 to_skip[task] = 0
 
-            if i > last_result_id[task]:
-                result_ids[task].add(i)
-                results[task].put((i, is_valid, real_result))
-                log.debug('NuMap(%s) pool_getter put result %s for task %s to queue' % \
-                          (id_self, i, task))
-            else:
-                log.debug('NuMap(%s) pool_getter skips result %s for task %s' % \
-                          (id_self, i, task))
-
-            # this releases the next method for each ordered result in the queue
-            # if the NuMap instance is ordered =False this information is 
-            # ommitted.
-            while last_result_id[task] + 1 in result_ids[task]:
-                next_available[task].put(True)
-                last_result_id[task] += 1
-                log.debug('NuMap(%s) pool_getter released task: %s' % \
-                          (id_self, task))
-            if last_result_id[task] == very_last_result_id[task]:
+            for i, is_valid, real_result in chunk:
+                if i > reorder.last:
+                    if ordered:
+                        reorder.put(i, (i, is_valid, real_result))
+                    else:
+                        reorder.put(i, True)
+                        results[task].put((i, is_valid, real_result))
+                        queued += 1
+                else:
+                    if arena is not None:
+                        arena.free(real_result)
+                    if budget is not None:
+                        budget.discharge(task, i)
+
+            # this releases consecutive results, if the NuMap instance is 
+            # ordered =False they have been released already.
+            if reorder.depth > counters['reorder_max']:
+                counters['reorder_max'] = reorder.depth
+            item = reorder.pop()
+            while item is not None:
+                if ordered:
+                    results[task].put(item)
+                    queued += 1
+                item = reorder.pop()
+            counters['reorder_depth'] = reorder.depth
+            if reorder.last == very_last_result_id[task]:
                 results[task].put(('stop', False, 'stop'))
-                next_available[task].put(True)
+                queued += 1
             # release the next method
             task_next_lock[task].release()
+            if pressure is not None and queued:
+                pressure.arrive(task, queued)
+            if waiters[task]:
+                _wake(waiters[task])
         log.debug('NuMap(%s) pool_getter returns' % id_self)
 
     def __init__(self, func=None, iterable=None, args=None, kwargs=None, \
                  worker_type=None, worker_num=None, worker_remote=None, \
                  stride=None, buffer=None, ordered=True, skip=False, \
-                 name=None):
+                 name=None, chunksize=1, transport=None, shm_size=2 ** 28, \
+                 shm_threshold=2 ** 16, dispatch=None, buffer_max=None, \
+                 persistent=False, retries=1, balance=False, schedule=None, \
+                 start_method=None, initializer=None, initargs=None, \
+                 buffer_bytes=None, affinity=None):
 
         self.name = (name or 'numap_%s' % id(self))
         log.debug('%s %s starts initializing' % (self, self.name))
         if worker_type == 'process' and not HASMP:
             log.error('worker_type process requires multiprocessing')
             raise ImportError('worker_type process requires multiprocessing')
+        if worker_type == 'asyncio' and not HASAIO:
+            log.error('worker_type asyncio requires asyncio or trollius')
+            raise ImportError('worker_type asyncio requires asyncio or trollius')
         self.worker_type = (worker_type or 'process')
+        if self.worker_type in ('asyncio', 'inline') and worker_remote:
+            log.error('worker_type %s does not support remote workers' % \
+                      self.worker_type)
+            raise ValueError('worker_type %s does not support remote workers' %\
+                             self.worker_type)
         if worker_remote and not HASRP:
             log.error('worker_remote requires RPyC')
             raise ImportError('worker_remote requires RPyC')
+        self.transport = (transport or 'pipe')
+        if self.transport == 'shm' and \
+           (self.worker_type != 'process' or worker_remote):
+            log.error('transport shm requires local process workers')
+            raise ValueError('transport shm requires local process workers')
+        self.shm_size = shm_size
+        self.shm_threshold = shm_threshold
+        self._arena = None              # shared memory arena (if shm)
+        self.persistent = persistent
+        self.retries = retries
+        self._controls = []             # send the registry to waiting workers
+        self._readers = []              # result pipes of process workers
+        self.initializer = initializer
+        self.initargs = tuple(initargs or ())
+        self.start_method = (start_method or 'fork')
+        self._template = None           # forks process workers (if template)
+        if self.start_method == 'template':
+            if self.worker_type != 'process' or self.transport != 'pipe':
+                log.error('start_method template requires process workers ' + \
+                          'and the pipe transport')
+                raise ValueError('start_method template requires process ' + \
+                                 'workers and the pipe transport')
+            if not (HASFD and HASCH):
+                log.error('start_method template requires fd passing')
+                raise ImportError('start_method template requires fd passing')
+        elif self.start_method != 'fork':
+            log.error('start_method %s is not supported' % self.start_method)
+            raise ValueError('start_method %s is not supported' % \
+                             self.start_method)
+        self.affinity = affinity
+        self._affinity = None           # the cpus of workers (if affinity)
+        if affinity is not None:
+            if self.worker_type != 'process':
+                log.error('affinity requires process workers')
+                raise ValueError('affinity requires process workers')
+            if not HASAFF:
+                log.error('affinity requires sched_setaffinity')
+                raise ImportError('affinity requires sched_setaffinity')
+            self._affinity = _Affinity(affinity)
+        self.dispatch = (dispatch or 'shared')
+        if self.dispatch != 'shared' and self.worker_type != 'process':
+            log.error('dispatch %s requires process workers' % self.dispatch)
+            raise ValueError('dispatch %s requires process workers' % \
+                             self.dispatch)
+        if self.dispatch != 'shared' and not HASCH:
+            log.warning('dispatch %s requires select and fcntl, using the ' \
+                        'shared queue' % self.dispatch)
+            self.dispatch = 'shared'
 
         self._tasks = []
         self._tasks_tracked = {}
+        self._tasks_registry = {}       # {task_id:(func, args, kwargs)}
         self._started = Event()         # (if not raise TimeoutError on next)
         self._stopping = Event()        # (starting stopping procedure see stop)
         # pool options
+        self.stride_auto = (stride == 'auto')
+        if self.stride_auto:
+            stride = None
         if worker_num is None:
             self.worker_num = stride or cpu_count()
         else:
@@ -371,20 +908,42 @@ class NuMap(object):
         self.buffer = buffer            # defines the maximum number
         # of jobs which are in the input queue, pool and output queues
         # and next method
+        self.buffer_max = buffer_max    # ceiling for the automatic buffer
+        self.buffer_bytes = buffer_bytes    # budget of pickled bytes
+        if buffer_bytes and (self.worker_type != 'process' or \
+                             buffer == 'auto' or self.stride_auto):
+            log.error('buffer_bytes requires process workers and no ' + \
+                      'automatic tuning')
+            raise ValueError('buffer_bytes requires process workers and no ' + \
+                             'automatic tuning')
+        self._budget = None
+        self._tuner = None
+        self._balancer = None
+        self._pressure = None
+        self._hedger = None
+        self._stats = None              # counters of the last start
+        self.balance = balance          # weights from compute times
+        self.schedule = (schedule or 'weave')
+        if self.schedule not in ('weave', 'backpressure') or \
+           (self.schedule == 'backpressure' and balance):
+            log.error('schedule %s is not supported' % self.schedule)
+            raise ValueError('schedule %s is not supported' % self.schedule)
+
+        self.chunksize = chunksize      # elements per pool message
 
         # next method options
         self.ordered = ordered
         self.skip = skip
 
         # make pool input and output queues based on worker type.
+        # the result pipes of process workers are made in _start_workers
         if self.worker_type == 'process':
-            self._inqueue = SimpleQueue()
-            self._outqueue = SimpleQueue()
-            self._putin = self._inqueue._writer.send
-            self._getout = self._outqueue._reader.recv
-            self._getin = self._inqueue.get
-            self._putout = self._outqueue.put
-        elif self.worker_type == 'thread':
+            # _putin and _getout are made in _start_workers, the template 
+            # process makes the input queues
+            self._inqueue = SimpleQueue() if self.start_method != 'template' \
+                            else None
+        else:
+            # the elements of asyncio workers are scheduled on the event loop
             self._inqueue = Queue()
             self._outqueue = Queue()
             self._putin = self._inqueue.put
@@ -393,13 +952,18 @@ class NuMap(object):
             self._putout = self._outqueue.put
 
         # combine tasks into a weaved queue
-        self._next_available = {}   # per-task boolean queue 
-                                    # releases next to get a result
         self._next_skipped = {}     # per-task int, number of results
                                     # to skip (locked)
         self._task_next_lock = {}   # per-task lock around _next_skipped
+        self._task_released = None  # per-task released elements (if batch)
+        self._released_lock = tLock()
         self._task_finished = {}    # a per-task is finished variable
         self._task_results = {}     # a per-task queue for results
+        self._task_chunksize = {}   # a per-task chunksize (or None)
+        self._task_waiters = {}     # per-task callbacks of pending anext
+        self._task_weight = {}      # a per-task weight in the weave
+        self._task_upstream = {}    # a per-task id of the input task (or None)
+        self._task_cache = {}       # a per-task Cache (or None)
 
         log.debug('%s finished initializing' % self)
 
@@ -425,72 +989,464 @@ class NuMap(object):
         """
         (internal) starts input and output pool queue manager threads.
         """
-        self._task_queue = _Weave(self._tasks, self.stride)
+        self._stats = _Stats(len(self._tasks), len(self.pool), \
+                             self.worker_type == 'process')
+        if self._affinity is not None:
+            self._stats.affinity = self._affinity.layout(len(self.pool), \
+                                                         self._hosts)
+        weights = [self._task_weight[task] for task in \
+                                             xrange(len(self._tasks))]
+        upstream = [self._task_upstream[task] for task in \
+                                              xrange(len(self._tasks))]
+        # batches do not span strides
+        batched = [isinstance(self._tasks_registry[task][0], _Batched) for \
+                   task in xrange(len(self._tasks))]
+        batch = max([self._task_chunksize[task] for task in \
+                     xrange(len(self._tasks)) if batched[task]] or [1])
+        stride = max(self.stride, batch)
+        self._pressure = None
+        if self.schedule == 'backpressure':
+            self._task_queue = _Backpressure(self._tasks, stride, upstream)
+            self._pressure = self._task_queue
+        elif not self.balance and weights.count(1) == len(weights):
+            # strict round-robin
+            self._task_queue = _Weave(self._tasks, stride)
+        else:
+            self._task_queue = _Weave(self._tasks, stride, weights)
         # here we determine the size of the maximum memory consumption
-        self._semaphore_value = (self.buffer or (len(self._tasks) * self.stride))
-        self._pool_semaphore = Semaphore(self._semaphore_value)
-
+        default = self._task_queue.rotation_size()
+        if self.balance:
+            # room for weighted rotations
+            default *= 2
+        self._semaphore_value = default if self.buffer == 'auto' else \
+                                (self.buffer or default)
+        if self.buffer_bytes:
+            # the safe default number of elements is always allowed
+            self._budget = _Budget(self.buffer_bytes, default, self.buffer)
+            self._pool_semaphore = self._budget
+        else:
+            self._budget = None
+            self._pool_semaphore = Semaphore(self._semaphore_value)
+        if self.stride_auto or self.buffer == 'auto':
+            buffer_max = (self.buffer_max or 4 * default) \
+                         if self.buffer == 'auto' else self._semaphore_value
+            stride_max = max(stride, buffer_max // max(len(self._tasks), 1))\
+                         if self.stride_auto else stride
+            stride_min = batch if self.stride_auto else stride
+            self._tuner = _Tuner(self._task_queue, self._pool_semaphore, \
+                                 self._semaphore_value, len(self.pool), \
+                                 (stride_min, stride_max), \
+                                 (self._semaphore_value, buffer_max))
+        else:
+            self._tuner = None
+        for task, counters in enumerate(self._stats.tasks):
+            counters['weight'] = self._task_queue.weight(task)
+        if self.balance:
+            self._balancer = _Balancer(self._task_queue, self._stats.tasks, \
+                                       upstream, self._semaphore_value)
+        else:
+            self._balancer = None
+        # chunks are at most a stride long
+        chunksizes = []
+        for task_id in xrange(len(self._tasks)):
+            chunksize = self._task_chunksize[task_id] or self.chunksize
+            if chunksize == 'auto':
+                # every worker should get a chunk in each stride
+                chunksize = -(-stride // max(len(self.pool), 1))
+            chunksizes.append(chunksize if batched[task_id] else \
+                              max(1, min(chunksize, stride)))
+        # released elements of batched tasks
+        self._task_released = [0] * len(self._tasks) if any(batched) else None
 
+        if self.ordered or self.skip:
+            # a result is held at most until the buffer is full
+            reorders = [_Reorder(self._semaphore_value) for task in self._tasks]
+        else:
+            reorders = None
+        memos = self._memos()
+        hedgeable = [bool(getattr(self._tasks_registry[task_id][0], \
+                                  'idempotent', False)) for task_id in \
+                     xrange(len(self._tasks))]
+        if self.ordered and any(hedgeable):
+            workers = self.worker_num + sum([i[1] for i in self.worker_remote])
+            self._hedger = _Hedger(self._putin, workers, hedgeable, \
+                                   self._stats.tasks, arena=self._arena)
+            self._hedger.start()
+            putin = self._hedger.put
+        else:
+            self._hedger = None
+            putin = self._putin
         # start the pool getter thread
-        self._pool_getter = Thread(target=self._pool_get, args=(self._getout, \
-                self._task_results, self._next_available, \
+        # the manager threads are pinned to the reserved cpus
+        managers = self._affinity and self._affinity.managers
+        pool_get = _pinned(managers, self._pool_get)
+        pool_put = _pinned(managers, self._pool_put)
+        self._pool_getter = Thread(target=pool_get, args=(self._getout, \
+                self._task_results, reorders, self.ordered, \
                 self._task_next_lock, self._next_skipped, len(self._tasks), \
-                len(self.pool), id(self)))
+                len(self.pool), id(self), self._arena, self._tuner, \
+                self._stats, self._task_waiters, memos, self._hedger, \
+                self._budget, self._pressure))
         self._pool_getter.deamon = True
         self._pool_getter.start()
 
         # start the pool putter thread
-        self._pool_putter = Thread(target=self._pool_put, args=\
-                (self._pool_semaphore, self._task_queue, self._putin, \
-                len(self.pool), id(self), self._stopping.isSet))
+        self._pool_putter = Thread(target=pool_put, args=\
+                (self._pool_semaphore, self._task_queue, putin, \
+                len(self.pool), id(self), self._stopping.isSet, chunksizes, \
+                self._arena, self._tuner, self._stats, self._balancer, memos, \
+                self._putout, self._budget, batched, self._task_released))
         self._pool_putter.deamon = True
         self._pool_putter.start()
 
+    def _memos(self):
+        """
+        (internal) returns the ``_Memo`` of each **task** (or ``None``) or 
+        ``None`` if no **task** has a ``Cache``.
+        """
+        if not any(self._task_cache.values()):
+            return None
+        memos = []
+        for task_id in xrange(len(self._tasks)):
+            cache = self._task_cache[task_id]
+            memos.append(cache and _Memo(cache, \
+                                         *self._tasks_registry[task_id]))
+        return memos
+
+    def _start_inline(self):
+        """
+        (internal) prepares the evaluation of elements in the calling thread.
+        """
+        self._stats = _Stats(len(self._tasks), 1, False)
+        self._inline_memos = self._memos()
+        self._inline_failed = _init_worker(self.initializer, self.initargs)
+        self._inline_pending = dict([(task, deque()) for task in \
+                                     xrange(len(self._tasks))])
+
+    def _next_inline(self, task):
+        """
+        (internal) evaluates the next element (or batch) of a **task** in the 
+        calling thread.
+        """
+        pending = self._inline_pending[task]
+        if not pending:
+            func = self._tasks_registry[task][0]
+            size = self._task_chunksize[task] if isinstance(func, _Batched) \
+                   else 1
+            chunk = []
+            try:
+                while len(chunk) < size:
+                    if self._stopping.isSet():
+                        raise StopIteration
+                    task_id, item = self._tasks[task].next()
+                    chunk.append(item)
+            except StopIteration:
+                if not chunk:
+                    self._task_finished[task].set()
+                    raise
+            pending.extend(self._evaluate_inline(task, chunk))
+        index, is_valid, real_result = pending.popleft()
+        if type(real_result) is _Pickled:
+            # cached by "process" workers
+            real_result = loads(real_result)
+        if task in self._tasks_tracked:
+            self._tasks_tracked[task][index] = real_result
+        if _tracer.on:
+            _tracer.record('release', id(self), task, index, is_valid)
+        if is_valid:
+            return real_result
+        raise real_result
+
+    def _evaluate_inline(self, task, chunk):
+        """
+        (internal) returns the results of a chunk of elements of a **task**, 
+        which are evaluated in the calling thread.
+        """
+        func, args, kwargs = self._tasks_registry[task]
+        counters, wcounters = self._stats.tasks[task], self._stats.workers[0]
+        memo = self._inline_memos[task] if self._inline_memos else None
+        results, keys, misses = {}, {}, []
+        for index, data in chunk:
+            if memo is not None:
+                keys[index] = memo.key(data)
+                hit, real_result = memo.cache.get(keys[index]) if \
+                                   keys[index] is not None else (False, None)
+                if hit:
+                    counters['cached'] += 1
+                    counters['completed'] += 1
+                    results[index] = (index, True, real_result)
+                    continue
+            misses.append((index, data))
+        if misses:
+            counters['submitted'] += len(misses)
+            started = time()
+            if self._inline_failed is not None:
+                evaluated = [(index, False, self._inline_failed) for \
+                             index, data in misses]
+            elif isinstance(func, _Batched):
+                evaluated = func.evaluate(misses, args, kwargs)
+            else:
+                evaluated = []
+                for index, data in misses:
+                    try:
+                        evaluated.append((index, True, \
+                                          func(data, *args, **kwargs)))
+                    except Exception, excp:
+                        evaluated.append((index, False, excp))
+            computed = time() - started
+            counters['compute_time'] += computed
+            wcounters['compute_time'] += computed
+            wcounters['chunks'] += 1
+            for index, is_valid, real_result in evaluated:
+                outcome = 'completed' if is_valid else 'failed'
+                counters[outcome] += 1
+                wcounters[outcome] += 1
+                if is_valid and keys.get(index) is not None:
+                    memo.cache.put(keys[index], real_result)
+                results[index] = (index, is_valid, real_result)
+        return [results[index] for index, data in chunk]
+
+    def _release(self, task):
+        """
+        (internal) releases the semaphore for an element of a **task**.
+        """
+        self._pool_semaphore.release()
+        if self._pressure is not None:
+            self._pressure.release(task)
+        if self._task_released is not None:
+            # counted after the release, a pending element always frees the
+            # semaphore
+            self._released_lock.acquire()
+            self._task_released[task] += 1
+            self._released_lock.release()
+
     def _start_workers(self):
         """
         (internal) starts **worker pool** threads or processes.
         """
+        if hasattr(self, 'pool'):
+            # a persistent pool is waiting
+            self._restart_workers()
+            return
         # creating the pool of worker process or threads
         log.debug('%s starts a %s-pool of %s workers.' % \
                   (self, self.worker_type, self.worker_num))
-        self.pool = []
-        for host, worker_num in \
-                           [(None, self.worker_num)] + list(self.worker_remote):
-            for _worker in range(worker_num):
-                __worker = Thread(target=_pool_worker, args=\
-                                  (self._inqueue, self._outqueue, host)) \
-                                  if self.worker_type == 'thread' else \
-                           Process(target=_pool_worker, args=\
-                                  (self._inqueue, self._outqueue, host))
-                self.pool.append(__worker)
-        for __worker in self.pool:
+        if self.transport == 'shm':
+            # the arena is inherited by the forked workers
+            self._arena = _ShmArena(self.shm_size, self.shm_threshold)
+        if self.worker_type == 'asyncio':
+            # a single thread runs the event loop
+            loop = asyncio.new_event_loop()
+            worker = _AsyncioWorker(loop, self._outqueue, \
+                                    self._tasks_registry, self.worker_num, \
+                                    self.persistent, self.initializer, \
+                                    self.initargs)
+            self._aio_worker = worker
+            self._putin = partial(loop.call_soon_threadsafe, worker.submit)
+            __worker = Thread(target=worker.run)
             __worker.daemon = True
             __worker.start()
+            self.pool = [__worker]
+            log.debug('%s started the pool' % self)
+            return
+        hosts = [(None, self.worker_num)] + list(self.worker_remote)
+        # the host of each worker
+        self._hosts = [host for host, worker_num in hosts for _worker in \
+                       xrange(worker_num)]
+        if self.start_method == 'template':
+            # the input queues are in the template process
+            self._inqueue, channels, self._slots = \
+                            self._start_template().queues(len(self._hosts))
+            if self.dispatch != 'shared':
+                self._channels = channels
+        else:
+            if self.dispatch != 'shared':
+                # one input channel per worker
+                self._channels = [SimpleQueue() for host in self._hosts]
+            if self.worker_type == 'process':
+                # the chunk evaluated by each worker
+                self._slots = RawArray('i', [-1] * len(self._hosts))
+        self.pool = []
+        for worker, host in enumerate(self._hosts):
+            self.pool.append(self._spawn_worker(worker))
+        if self.worker_type == 'process':
+            self._start_supervisor()
+        else:
+            self._putin = self._inqueue.put
         log.debug('%s started the pool' % self)
 
+    def _spawn_worker(self, worker):
+        """
+        (internal) starts a **worker** thread or process, which is the 
+        "worker"-th of the pool.
+        """
+        host = self._hosts[worker]
+        if self.worker_type == 'thread':
+            control = None
+            if self.persistent:
+                control = Queue()
+                self._controls[worker:worker + 1] = [control.put]
+            __worker = Thread(target=_pool_worker, args=\
+                              (self._inqueue, self._outqueue, \
+                               self._tasks_registry, host, None, worker, \
+                               control, None, self.initializer, self.initargs))
+            __worker.daemon = True
+            __worker.start()
+            return __worker
+        control = None
+        if self.persistent:
+            control, sender = Pipe(duplex=False)
+            self._controls[worker:worker + 1] = [sender.send]
+        # each worker has its own result pipe
+        reader, writer = Pipe(duplex=False)
+        if self._template is not None:
+            __worker = self._template.spawn(worker, host, \
+                       self._tasks_registry, self.dispatch, writer, control, \
+                       self.initializer, self.initargs)
+        else:
+            # process workers wait for elements outside of the read lock
+            inqueue = _StealingQueue([self._inqueue], 0) if \
+                      self.dispatch == 'shared' else \
+                      _StealingQueue(self._channels, worker)
+            __worker = Process(target=_pool_worker, args=\
+                              (inqueue, writer, self._tasks_registry, host, \
+                               self._arena, worker, control, self._slots, \
+                               self.initializer, self.initargs))
+            __worker.daemon = True
+            __worker.start()
+        if self._affinity is not None and host is None:
+            _set_affinity(__worker.pid, self._affinity.cpus(worker))
+        # the worker holds the only write end of its pipe
+        writer.close()
+        if control is not None:
+            control.close()
+        self._readers[worker:worker + 1] = [reader]
+        return __worker
+
+    def _respawn(self, worker):
+        """
+        (internal) replaces a dead "process" **worker** and returns the result
+        pipe of the new **worker**. The **workers** are not replaced, but 
+        ``None`` is returned, if the interpreter exits, because the 
+        ``multiprocessing`` module terminates them.
+        """
+        self.pool[worker].join()
+        if _exiting:
+            log.debug('%s did not replace terminated worker %s' % \
+                      (self, worker))
+            return None
+        self._readers[worker].close()
+        if self._template is not None:
+            # forked by the template process
+            self.pool[worker] = self._spawn_worker(worker)
+        else:
+            # other threads of the pool do not log while the worker is forked
+            locks = _logging_locks()
+            for lock in locks:
+                lock.acquire()
+            try:
+                self.pool[worker] = self._spawn_worker(worker)
+            finally:
+                for lock in reversed(locks):
+                    lock.release()
+        log.warning('%s replaced dead worker %s' % (self, worker))
+        return self._readers[worker]
+
+    def _start_supervisor(self):
+        """
+        (internal) starts watching over "process" **workers** for a run.
+        """
+        if self.dispatch != 'shared':
+            send = _Dispatcher(self._channels, self.dispatch)
+        else:
+            send = partial(_send, self._inqueue._writer)
+        supervisor = _Supervisor(send, self._slots, self._respawn, \
+                                 self.retries, self._arena)
+        self._putin = supervisor.submit
+        # results from the cache are send by the pool putter
+        hits, putout = Pipe(duplex=False)
+        self._putout = putout.send
+        self._getout = _Multiplexer(self._readers, supervisor, hits).get
+
+    def _restart_workers(self):
+        """
+        (internal) starts the next run of a persistent **worker pool**. The 
+        waiting **workers** get the registry of the new **tasks**. Dead 
+        **workers** are replaced.
+        """
+        if self.worker_type == 'asyncio':
+            self._aio_worker.tasks = self._tasks_registry
+        else:
+            for worker, __worker in enumerate(self.pool):
+                if __worker.is_alive():
+                    self._controls[worker](self._tasks_registry)
+                elif self.worker_type == 'process':
+                    self._respawn(worker)
+        if self.worker_type == 'process':
+            self._start_supervisor()
+        log.debug('%s restarted the pool' % self)
+
+    def _stop_workers(self):
+        """
+        (internal) joins **worker pool** threads or processes, which have 
+        finished and releases their pipes and the shared memory.
+        """
+        for worker in self.pool:
+            worker.join()
+        del self.pool
+        for reader in self._readers:
+            reader.close()
+        self._readers = []
+        self._controls = []
+        # reclaim the shared memory
+        if self._arena is not None:
+            self._arena.close()
+            self._arena = None
+        # the next pool is forked from a new template process
+        if self._template is not None:
+            self._template.close()
+            self._template = None
+
+    def _start_template(self):
+        """
+        (internal) returns the template process, which is started if needed.
+        """
+        if self._template is None:
+            self._template = _Template()
+        return self._template
+
     def _stop(self):
         """
         (internal) stops input and output pool queue manager threads.
         """
         if self._started.isSet():
-            # join threads
-            self._pool_getter.join()
-            self._pool_putter.join()
-            for worker in self.pool:
-                worker.join()
-            # remove threads  
-            del self._pool_putter
-            del self._pool_getter
-            del self.pool
+            if self.worker_type != 'inline':
+                # join threads
+                self._pool_getter.join()
+                self._pool_putter.join()
+                if self._hedger is not None:
+                    self._hedger.stop()
+                    self._hedger = None
+                # remove threads  
+                del self._pool_putter
+                del self._pool_getter
+                if not self.persistent:
+                    self._stop_workers()
+            # the on-disk tiers are written
+            for cache in self._task_cache.values():
+                if cache:
+                    cache.flush()
             # remove results
             self._tasks = []
             self._tasks_tracked = {}
+            self._tasks_registry = {}
             # virgin variables
             self._stopping.clear()
             self._started.clear()
 
     def add_task(self, func, iterable, args=None, kwargs=None, timeout=None, \
-                block=True, track=False):
+                block=True, track=False, chunksize=None, weight=None, \
+                cache=None, batch=None, item_timeout=None):
         """ 
         Adds a **task** to evaluate. A **task** is jointly a function or 
         callable an iterable with optional arguments and keyworded arguments.
@@ -501,7 +1457,8 @@ class NuMap(object):
         
           - func (callable) this will be called on each element of the 
             "iterable" and supplied with arguments "args" and keyworded 
-            arguments "kwargs"
+            arguments "kwargs". The callable and its arguments are send to 
+            each **worker** only once, when the pool is started.
           - iterable (iterable) this must be a sequence of *picklable* objects 
             which will be the first arguments passed to the "func"
           - args (``tuple``) [default: ``None``] A ``tuple`` of optional 
@@ -518,23 +1475,86 @@ class NuMap(object):
             dictionary. This is only useful if the callable "func" creates 
             persistant data. The dictionary can be used to restore the correct 
             order of the data
+          - chunksize (``int`` or ``'auto'``) [default: ``None``] The number 
+            of elements of this **task** send to a **worker** in a single 
+            message. If ``None`` the "chunksize" of the ``NuMap`` instance is 
+            used.
+          - weight (``int`` or ``float``) [default: ``None``] The relative 
+            number of elements of this **task** in each rotation. Defaults to
+            ``1`` or to the "weight" of the **task** it consumes, which cannot
+            be changed see: *Weights*.
+          - cache (``Cache`` or ``True``) [default: ``None``] Memoizes the 
+            results of this **task**, if ``True`` a new in-memory ``Cache`` is
+            used see: *Cache*.
+          - batch (``int``) [default: ``None``] The number of consecutive 
+            elements passed as a ``list`` to a single call of "func", which 
+            returns a sequence of results. The "batch" replaces the 
+            "chunksize", raises the "stride" and must not exceed the "buffer"
+            see: *Parallel evaluation*. Not supported by "asyncio" 
+            **workers**.
+          - item_timeout (``float``) [default: ``None``] The number of seconds
+            after which a call of "func" fails with a ``TimeoutError`` see:
+            *Skipping*. A "batch" is a single call. Not supported by 
+            "asyncio" **workers**.
             
         """
         if not self._started.isSet():
-            task = izip(repeat(len(self._tasks)), repeat(func), \
-                        repeat((args or ())), repeat((kwargs or {})), \
-                        enumerate(iterable))
             task_id = len(self._tasks)
+            upstream = iterable.task if isinstance(iterable, _NuMapTask) and \
+                                        iterable.iterator is self else None
+            if upstream is not None and weight is None:
+                weight = self._task_weight[upstream]
+            weight = 1 if weight is None else weight
+            if weight <= 0 or (upstream is not None and \
+                               weight != self._task_weight[upstream]):
+                log.error('%s invalid weight %s for task %s' % \
+                          (self, weight, task_id))
+                raise ValueError('%s invalid weight %s for task %s' % \
+                                 (self, weight, task_id))
+            if batch and isinstance(self.buffer, int) and batch > self.buffer:
+                log.error('%s buffer %s is smaller than batch %s' % \
+                          (self, self.buffer, batch))
+                raise ValueError('%s buffer %s is smaller than batch %s' % \
+                                 (self, self.buffer, batch))
+            if batch and self.worker_type == 'asyncio':
+                log.error('%s asyncio workers do not support batches' % self)
+                raise ValueError('%s asyncio workers do not support batches' %\
+                                 self)
+            if item_timeout and self.worker_type == 'asyncio':
+                log.error('%s asyncio workers do not support item_timeout' % \
+                          self)
+                raise ValueError('%s asyncio workers do not support ' % self + \
+                                 'item_timeout')
+            if cache and self.transport != 'pipe':
+                log.error('%s cache requires the pipe transport' % self)
+                raise ValueError('%s cache requires the pipe transport' % self)
+            self._task_weight[task_id] = weight
+            self._task_upstream[task_id] = upstream
+            self._task_cache[task_id] = Cache() if cache is True else cache
+            if self.start_method == 'template':
+                # warm the template process
+                self._start_template().load(func)
+            if item_timeout:
+                func = _Timed(func, item_timeout)
+            if batch:
+                # one call per chunk
+                func, chunksize = _Batched(func), batch
+            # the callable and constant arguments are send to the workers
+            # once, the pool messages carry only the task id and the data.
+            self._tasks_registry[task_id] = (func, (args or ()), (kwargs or {}))
+            task = izip(repeat(task_id), enumerate(iterable))
             self._tasks.append(task)
             if track:
                 self._tasks_tracked[task_id] = {} # result:index
-            self._next_available[task_id] = Queue()
             self._next_skipped[task_id] = 0
             self._task_finished[task_id] = Event()
             self._task_next_lock[task_id] = tLock()
-            # this locks threads not processes
-            self._task_results[task_id] = _PriorityQueue() if self.ordered \
-                                                          else Queue()
+            self._task_chunksize[task_id] = chunksize
+            self._task_waiters[task_id] = []
+            # results are put in order if the NuMap is ordered
+            self._task_results[task_id] = Queue() if \
+                                          (self.ordered or self.skip) else \
+                                          _Unordered()
             return self.get_task(task=task_id, timeout=timeout, block=block)
         else:
             log.error('%s cannot add tasks (is started).' % self)
@@ -555,11 +1575,13 @@ class NuMap(object):
             if number is True:
                 self._tasks = []
                 self._tasks_tracked = {}
+                self._tasks_registry = {}
             elif number > 0:
                 last_task_id = len(self._tasks) - 1
                 for i in xrange(number):
                     self._tasks.pop()
                     self._tasks_tracked.pop(last_task_id - i, None)
+                    self._tasks_registry.pop(last_task_id - i, None)
         else:
             log.error('%s cannot delete tasks (is started).' % self)
             raise RuntimeError('%s cannot delete tasks (is started).' % self)
@@ -592,6 +1614,113 @@ class NuMap(object):
         """
         return _NuMapTask(self, task=task, timeout=timeout, block=block)
 
+    def anext(self, task=0, loop=None):
+        """
+        Returns an ``asyncio.Future`` of the next result for the given **task**.
+        The future is completed on the event loop by the pool getter thread as 
+        soon as the result is available, no thread blocks and nothing is 
+        polled. "inline" **workers** evaluate the element in the default 
+        executor of the loop. If the **task** is finished the future raises 
+        ``StopAsyncIteration``. ``_NuMapTask`` instances have the same method.
+        Results of a **task** should be either retrieved by ``NuMap.anext`` or
+        by ``NuMap.next``. Requires ``asyncio`` or ``trollius``.
+        
+        Arguments:
+        
+          - task (``int``) id of the task from the ``NuMap`` instance
+          - loop (event loop) [default: current event loop] The event loop of 
+            the future.
+            
+        """
+        if not HASAIO:
+            log.error('anext requires asyncio or trollius')
+            raise ImportError('anext requires asyncio or trollius')
+        loop = loop or asyncio.get_event_loop()
+        future = asyncio.Future(loop=loop)
+        self._areceive(task, future, loop)
+        return future
+
+    def _areceive(self, task, future, loop):
+        """
+        (internal) Completes the "future" with the next result of a **task** 
+        if it is available. Otherwise the pool getter calls it again on the 
+        "loop" once new results arrive.
+        """
+        if future.done():
+            # cancelled or completed by another call
+            return
+        if self.worker_type == 'inline' and self._started.isSet():
+            # the element is evaluated in the call
+            pending = loop.run_in_executor(None, partial(self.next, task=task))
+            pending.add_done_callback(partial(_resolve, future))
+            return
+        waiters = self._task_waiters[task]
+        waiter = partial(loop.call_soon_threadsafe, self._areceive, task, \
+                         future, loop)
+        # the waiter is registered before checking, so no result is missed
+        waiters.append(waiter)
+        if self._started.isSet() and not self._task_finished[task].isSet():
+            if self._task_results[task].empty():
+                return
+        try:
+            waiters.remove(waiter)
+        except ValueError:
+            # already called by the pool getter
+            pass
+        try:
+            # the result is available, the loop does not block
+            result = self.next(task=task, block=False)
+        except StopIteration:
+            future.set_exception(StopAsyncIteration())
+        except Exception, excp:
+            future.set_exception(excp)
+        else:
+            future.set_result(result)
+
+    def stats(self):
+        """
+        Returns a snapshot of the runtime statistics of the last start of the
+        ``NuMap`` instance as a dictionary ``{'tasks':[...], 'workers':[...]}``
+        with a dictionary of counters per **task** and per **worker**. The
+        counters are kept up-to-date by the pool putter and pool getter
+        threads, the timings of the **workers** are send with the results.
+        Times are in seconds, sizes in bytes. Serialization is only measured
+        for "process" **workers**.
+
+        Per **task**:
+
+          - submitted, completed, failed: number of elements submitted to the
+            **worker pool** and results or exceptions received from it.
+          - semaphore_wait: time the pool putter blocked on the "buffer".
+          - inqueue_time: time chunks waited in the input queue.
+          - compute_time: time spent evaluating the function.
+          - input_bytes, input_time: size of pickled chunks and time of their
+            serialization and deserialization.
+          - output_bytes, output_time: the same for chunks of results.
+          - result_time: time ``NuMap.next`` spent unpickling the results of 
+            "process" **workers**, which are not unpickled by the pool getter.
+          - reorder_depth, reorder_max: current and maximum number of results,
+            which are held back by the pool getter until previous results
+            arrive.
+          - cached: number of elements, which results were found in the 
+            ``Cache`` see: *Cache*.
+          - hedged: number of duplicated chunks see: *Hedging*.
+
+        Per **worker**:
+
+          - chunks, completed, failed, inqueue_time, compute_time, input_time,
+            output_bytes, output_time: as above.
+
+        If the **workers** are pinned the snapshot has an ``'affinity'`` 
+        dictionary with the "policy", the CPUs of the NUMA "nodes", of the 
+        "workers" (``None`` for remote **workers**) and of the "managers" 
+        (``None`` if not pinned) see: *Affinity*.
+
+        """
+        if self._stats is None:
+            return {'tasks':[], 'workers':[]}
+        return self._stats.snapshot()
+
     def start(self, stages=(1, 2)):
         """
         Starts the processes or threads in the internal pool and the threads, 
@@ -610,6 +1739,12 @@ class NuMap(object):
             the start process to execute, by default both stages.
 
         """
+        if self.worker_type == 'inline':
+            # there is no pool and there are no manager threads
+            if not self._started.isSet():
+                self._start_inline()
+                self._started.set()
+            return
         if 1 in stages:
             if not self._started.isSet():
                 self._start_workers()
@@ -679,6 +1814,24 @@ class NuMap(object):
                 log.error(msg)
                 raise RuntimeError(msg)
 
+    def shutdown(self):
+        """
+        Tears down a persistent **worker pool**. The ``NuMap`` instance has to
+        be stopped. The next call to ``NuMap.start`` will spawn a new pool.
+        """
+        if self._started.isSet():
+            log.error('%s cannot shutdown the pool (is started).' % self)
+            raise RuntimeError('%s cannot shutdown the pool (is started).' % \
+                               self)
+        if hasattr(self, 'pool'):
+            if self.worker_type == 'asyncio':
+                self._aio_worker.shutdown()
+            else:
+                for control in self._controls:
+                    control(None)
+            self._stop_workers()
+            log.debug('%s has shut down the pool' % self)
+
     def next(self, timeout=None, task=0, block=True):
         """
         Returns the next result for the given **task**. Defaults to ``0``, which
@@ -701,68 +1854,183 @@ class NuMap(object):
         elif self._task_finished[task].isSet():
             log.debug('%s has finished task %s' % (self, task))
             raise StopIteration
+        elif self.worker_type == 'inline':
+            return self._next_inline(task)
 
         # try to get a result
         try:
-            log.debug('%s waits for a result: ordered %s, task %s' % \
-                      (self, self.ordered, task))
-            if self.ordered:
-                _got_next = \
-                    self._next_available[task].get(timeout=timeout, block=block)
-                log.debug('%s has been released for task: %s' % (self, task))
-                result = self._task_results[task].get()
-            else:
-                result = \
-                    self._task_results[task].get(timeout=timeout, block=block)
+            # if ordered the results are put in order by the pool getter
+            result = self._task_results[task].get(timeout=timeout, block=block)
         except Empty:
-            self._task_next_lock[task].acquire()
             log.debug('%s timeout for result: ordered %s, task %s' % \
                       (self, self.ordered, task))
+            if not (self.ordered or self.skip):
+                # the pool getter does not lock the unordered fast path
+                raise TimeoutError('%s timeout for result: ordered %s, task %s' % \
+                                   (self, self.ordered, task))
+            self._task_next_lock[task].acquire()
             # the threads might have switched between the exception and the 
             # lock.acquire during this switch several items could have been 
             # submited to the queue if one of them is the one we are waiting 
             # for we get it here immediately, but lock the pool getter not to
             # submit more results.
             try:
-                if self.ordered:
-                    _got_next = self._next_available[task].get(block=False)
-                    log.debug('%s has been released for task: %s' % \
-                              (self, task))
-                    result = self._task_results[task].get()
-                else:
-                    result = self._task_results[task].get(block=False)
+                result = self._task_results[task].get(block=False)
             except Empty:
                 if self.skip:
                     self._next_skipped[task] += 1
-                    self._pool_semaphore.release()
+                    self._release(task)
                 self._task_next_lock[task].release()
                 raise TimeoutError('%s timeout for result: ordered %s, task %s' % \
                                    (self, self.ordered, task))
-        log.debug('%s got a result: ordered %s, task %s, %s' % \
-                  (self, self.ordered, task, result))
         # return or raise the result
         index, is_valid, real_result = result
+        if self._pressure is not None:
+            self._pressure.consume(task)
         if index == 'stop':
             # got the stop sentinel
             self._task_finished[task].set()
-            log.debug('%s releases semaphore after StopIteration of task %s' % \
-                      (self, task))
             self._pool_semaphore.release()
+            if _tracer.on:
+                _tracer.record('stop', id(self), task)
             log.debug('%s has finished task %s for the first time' % \
                       (self, task))
             raise StopIteration
+        if type(real_result) is _Pickled:
+            # not by the pool getter
+            start = time()
+            real_result = loads(real_result)
+            self._stats.tasks[task]['result_time'] += time() - start
+        if self._arena is not None:
+            # this reclaims the shared memory of the result
+            real_result = self._arena.loads(real_result)
         if task in self._tasks_tracked:
             self._tasks_tracked[task][index] = real_result
+        if self._budget is not None:
+            self._budget.discharge(task, index)
+        self._release(task)
+        if _tracer.on:
+            _tracer.record('release', id(self), task, index, is_valid)
         if is_valid:
-            log.debug('%s returns %s for task %s' % (self, index, task))
-            self._pool_semaphore.release()
             return real_result
         else:
-            log.debug('%s raises %s for task %s' % (self, index, task))
-            self._pool_semaphore.release()
             raise real_result
 
 
+def _resolve(future, pending):
+    """
+    (internal) Completes the "future" of ``NuMap.anext`` with the outcome of 
+    the future "pending" of ``NuMap.next``.
+    """
+    if future.done():
+        return
+    try:
+        future.set_result(pending.result())
+    except StopIteration:
+        future.set_exception(StopAsyncIteration())
+    except Exception, excp:
+        future.set_exception(excp)
+
+def _wake(waiters):
+    """
+    (internal) Calls and removes the waiters of a **task**.
+    """
+    while waiters:
+        try:
+            waiters.pop()()
+        except (IndexError, RuntimeError):
+            # removed by anext or the event loop is closed
+            pass
+
+
+_worker = local()           # the state of the worker in this thread
+_exiting = False            # the interpreter exits
+
+def _exit():
+    # runs before multiprocessing terminates the workers at exit
+    global _exiting
+    _exiting = True
+
+atexit.register(_exit)
+
+def _logging_locks():
+    """
+    (internal) Returns the locks of the ``logging`` module and its handlers.
+    """
+    handlers = [handler() for handler in logging._handlerList]
+    return [logging._lock] + [handler.lock for handler in handlers if \
+                              handler is not None and handler.lock is not None]
+
+def worker_state():
+    """
+    Returns the state of the current **worker**. It is a ``dict``, which 
+    persists between the elements evaluated by a **worker** thread or process
+    and is usually filled by the "initializer" of the ``NuMap``. Outside of a 
+    **worker** it is the state of the calling thread.
+    """
+    try:
+        return _worker.state
+    except AttributeError:
+        _worker.state = {}
+        return _worker.state
+
+def _init_worker(initializer, initargs):
+    """
+    (internal) Starts the state of a **worker** and calls the "initializer" 
+    with "initargs". Returns the exception raised by the "initializer" or 
+    ``None``.
+    """
+    _worker.state = {}
+    if initializer is not None:
+        try:
+            initializer(*initargs)
+        except Exception, excp:
+            log.error('initializer of worker failed: %r' % excp)
+            return excp
+
+def start_tracer(size=2 ** 16, stall=None):
+    """
+    Starts recording events of all ``NuMap`` instances and ``Pipers`` into a 
+    ring buffer, which holds the last "size" events. Tracing replaces debug 
+    messages in the loops which handle individual elements. If it is not
+    started it costs a single attribute lookup per event. An event is a tuple 
+    ``(time, event, owner, task, index, extra)``, where "event" is one of:
+    
+      - ``'submit'`` a chunk of elements has been submitted to the pool, 
+        "extra" is the number of elements.
+      - ``'start'``, ``'finish'`` a **worker** started or finished a chunk, 
+        "extra" is the number of the **worker**.
+      - ``'release'`` a result has been returned, "extra" is ``False`` for 
+        exceptions. A ``Piper`` with multiple downstream ``Pipers`` records a
+        release if the lock of its ``itertools.tee`` objects is passed on.
+      - ``'stop'`` a **task** has been finished.
+    
+    The "owner" is the ``id`` of a ``NuMap`` or the name of a ``Piper``.
+      
+    Arguments:
+    
+      - size (``int``) [default: ``2 ** 16``] The number of recorded events.
+      - stall (``float``) [default: ``None``] If given the events are dumped 
+        to the log if no new event has been recorded for "stall" seconds i.e. 
+        on a dead-lock.
+    
+    """
+    _tracer.start(size, stall)
+
+def stop_tracer():
+    """
+    Stops recording events. The recorded events are kept.
+    """
+    _tracer.stop()
+
+def dump_trace(file=None):
+    """
+    Returns the recorded events ordered by time and writes them to the 
+    file-like object "file" if given. 
+    """
+    return _tracer.dump(file)
+
+
 def imports(modules, forgive=False):
     """
     Should be used as a decorator to *attach* import statments to function
@@ -842,117 +2110,2232 @@ def imports(modules, forgive=False):
     return wrap
 
 
-class _Weave(object):
+def idempotent(func):
     """
-    (internal) Weaves a sequence of iterators, which can be stopped if the same 
-    number of results has been consumed from all iterators (repeats boundaries).
+    Should be used as a decorator to declare that a function can be evaluated
+    more than once for the same element, its chunks can be duplicated see: 
+    *Hedging*.
+    """
+    func.idempotent = True
+    return func
 
+
+class _Batched(object):
+    """
+    (internal) Marks the callable of a **task**, which is evaluated in 
+    batches see: *Parallel evaluation*. Other attributes are looked up in the
+    callable.
+    
     Arguments:
     
-      - iterators (iterable) A sequence of objects supporting the iterator 
-        protocol.
-      - repeats (``int``) [default: ``1``] A positive integer defining the 
-        number of results to retrieve from one iterator before the next iterator
-        in the sequence.
-        
+      - func (callable) Is called with a ``list`` of elements and returns a 
+        sequence of results.
+    
     """
-    def __init__(self, iterators, repeats=1):
-        self.iterators = iterators          # sequence of iterators
-        self.lenght = len(self.iterators)
-        self.i = 0                          # index of current iterators
-        self.repeats = repeats     # number of repeats from an iterator (stride)
-        self.r = 0                 # current repeat
-        self.stopping = False      # if True stop at i==0, r==0
-        self.stopped = False
+    def __init__(self, func):
+        self.func = func
 
-    def __iter__(self):
-        # support for the iterator protocol
-        return self
+    def __getattr__(self, name):
+        if name == 'func':
+            # not yet unpickled
+            raise AttributeError(name)
+        return getattr(self.func, name)
 
-    def stop(self):
-        """
-        Triggers stopping. ``_Weave`` will stop at repeats boundaries.
-        """
-        # stopping is a one-way process
-        # log.debug('Weave(%s) told to stop.' % id(self))
-        self.stopping = True
+    def _inject(self, conn):
+        func = self.func._inject(conn) if hasattr(self.func, '_inject') else \
+               _inject_func(self.func, conn)
+        return _Batched(func)
 
-    def next(self):
+    def evaluate(self, chunk, args, kwargs, arena=None):
         """
-        Returns the next element or raises ``StopIteration`` if stopped.
+        Returns the results of a chunk of elements.
         """
-        # need new iterable?
-        if self.r == self.repeats:
-            self.i = (self.i + 1) % self.lenght
-            self.r = 0
+        try:
+            if arena is None:
+                batch = [data for i, data in chunk]
+            else:
+                batch = [arena.loads(data, False) for i, data in chunk]
+            outputs = list(self.func(batch, *args, **kwargs))
+            if len(outputs) != len(chunk):
+                raise ValueError('a batch of %s elements returned %s results'\
+                                 % (len(chunk), len(outputs)))
+        except Exception, excp:
+            return [(i, False, excp) for i, data in chunk]
+        if arena is not None:
+            outputs = [arena.dumps(output) for output in outputs]
+        return [(i, True, output) for (i, data), output in \
+                izip(chunk, outputs)]
 
-        self.r += 1
-        if self.stopping and self.i == 0 and self.r == 1:
-            self.stopped = True
-        if self.i == 0 and self.stopped:
-            raise StopIteration
-        else:
-            iterator = self.iterators[self.i]
+
+class _Timed(object):
+    """
+    (internal) Limits the duration of each call of the callable of a 
+    **task** see: *Skipping*. In the main thread of a process the call is 
+    interrupted by a ``SIGALRM``, otherwise the call is evaluated by the 
+    ``_Runner`` of the calling thread, which is abandoned if the call times 
+    out. Other attributes are looked up in the callable.
+    
+    Arguments:
+    
+      - func (callable) The callable of the **task**.
+      - item_timeout (``float``) The maximum duration of a call in seconds.
+    
+    """
+    def __init__(self, func, item_timeout):
+        self.func = func
+        self.item_timeout = item_timeout
+
+    def __getattr__(self, name):
+        if name == 'func':
+            # not yet unpickled
+            raise AttributeError(name)
+        return getattr(self.func, name)
+
+    def _inject(self, conn):
+        func = self.func._inject(conn) if hasattr(self.func, '_inject') else \
+               _inject_func(self.func, conn)
+        return _Timed(func, self.item_timeout)
+
+    def __call__(self, *args, **kwargs):
+        # the alarm fires only while the call is armed
+        armed = [True]
+        message = 'call timed out after %s seconds' % self.item_timeout
+        def alarm(signum, frame):
+            if armed[0]:
+                armed[0] = False
+                raise TimeoutError(message)
+        try:
+            previous = signal(SIGALRM, alarm)
+        except ValueError:
+            # not the main thread
+            return self._timer(args, kwargs)
+        setitimer(ITIMER_REAL, self.item_timeout)
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            # the timer is stopped before the alarm is disarmed
+            setitimer(ITIMER_REAL, 0)
+            armed[0] = False
+            signal(SIGALRM, previous)
+
+    def _timer(self, args, kwargs):
+        runner = getattr(_runners, 'runner', None)
+        if runner is None:
+            runner = _runners.runner = _Runner()
+        try:
+            return runner.call(self.item_timeout, self.func, args, kwargs)
+        except TimeoutError:
+            # the runner is still busy with the call
+            runner.abandon()
+            _runners.runner = None
+            raise
+
+
+class _Runner(object):
+    """
+    (internal) A thread, which evaluates the calls of a single thread see: 
+    ``_Timed``. The calling thread waits for the result of a call at most 
+    until its timeout. A call which has timed out is abandoned with its 
+    ``_Runner``, which ends after the call has returned. The calls share the
+    state of the calling **worker**.
+    """
+    def __init__(self):
+        self.calls = Queue()
+        thread = Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def call(self, timeout, func, args, kwargs):
+        """
+        Returns the result of "func" called with "args" and "kwargs" or 
+        raises its exception. Raises a ``TimeoutError`` if the call has not
+        returned after "timeout" seconds.
+        """
+        done, outcome = Event(), []
+        self.calls.put((func, args, kwargs, getattr(_worker, 'state', None), \
+                        done, outcome))
+        if not done.wait(timeout):
+            raise TimeoutError('call timed out after %s seconds' % timeout)
+        is_valid, result = outcome[0]
+        if not is_valid:
+            raise result
+        return result
+
+    def abandon(self):
+        """
+        Ends the ``_Runner`` after its current call.
+        """
+        self.calls.put(None)
+
+    def _run(self):
+        while True:
+            call = self.calls.get()
+            if call is None:
+                break
+            func, args, kwargs, state, done, outcome = call
+            if state is not None:
+                _worker.state = state
+            try:
+                outcome.append((True, func(*args, **kwargs)))
+            except Exception, excp:
+                outcome.append((False, excp))
+            done.set()
+
+
+_runners = local()          # the _Runner of the calling thread
+
+
+class Cache(object):
+    """
+    Memoizes the results of **tasks** see: *Cache*. The most recently used 
+    results are kept in memory, if a "path" is given all results are also 
+    pickled into a directory and survive the ``Cache`` instance. The files are
+    written by a separate thread, ``Cache.flush`` waits for pending writes. 
+    The results of "process" **workers** are kept pickled.
+
+    Arguments:
+
+      - size (``int``) [default: ``1024``] The maximum number of results kept
+        in memory.
+      - path (``str``) [default: ``None``] The directory of the on-disk tier, 
+        it is created if it does not exist.
+
+    """
+    def __init__(self, size=1024, path=None):
+        self.size = size
+        self.path = path
+        self.memory = OrderedDict()     # {key:result} least-recent first
+        self.lock = tLock()             # pool putter and getter both access
+        self.hits = 0
+        self.misses = 0
+        self.unwritten = {}             # {key:result} queued for the writer
+        self.writes = None              # queue of the writer thread
+        if path is not None and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.pickle')
+
+    def _remember(self, key, result):
+        # called with the lock held
+        self.memory.pop(key, None)
+        self.memory[key] = result
+        while len(self.memory) > self.size:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        """
+        Returns a ``(hit, result)`` tuple for the "key", a hit from the on-disk
+        tier is moved into memory.
+        """
+        self.lock.acquire()
+        try:
+            if key in self.memory:
+                result = self.memory.pop(key)
+                self.memory[key] = result
+                self.hits += 1
+                return (True, result)
+            if key in self.unwritten:
+                result = self.unwritten[key]
+                self._remember(key, result)
+                self.hits += 1
+                return (True, result)
+            if self.path is not None:
+                try:
+                    with open(self._file(key), 'rb') as file:
+                        result = load(file)
+                except (IOError, EOFError):
+                    pass
+                else:
+                    self._remember(key, result)
+                    self.hits += 1
+                    return (True, result)
+            self.misses += 1
+            return (False, None)
+        finally:
+            self.lock.release()
+
+    def put(self, key, result):
+        """
+        Stores a result under the "key". The file of the on-disk tier is 
+        written later by the writer thread and replaced atomically.
+        """
+        self.lock.acquire()
+        try:
+            self._remember(key, result)
+            if self.path is not None:
+                if self.writes is None:
+                    self.writes = Queue()
+                    writer = Thread(target=self._write)
+                    writer.daemon = True
+                    writer.start()
+                self.unwritten[key] = result
+                self.writes.put((key, result))
+        finally:
+            self.lock.release()
+
+    def _write(self):
+        # the writer thread of the on-disk tier
+        while True:
+            key, result = self.writes.get()
+            try:
+                name = self._file(key)
+                temp = '%s.%s.%s' % (name, os.getpid(), id(result))
+                with open(temp, 'wb') as file:
+                    file.write(dumps(result, HIGHEST_PROTOCOL))
+                os.rename(temp, name)
+            except Exception, excp:
+                log.error('Cache cannot write %s: %s' % (key, excp))
+            finally:
+                self.lock.acquire()
+                if self.unwritten.get(key) is result:
+                    del self.unwritten[key]
+                self.lock.release()
+                self.writes.task_done()
+
+    def flush(self):
+        """
+        Blocks until all results are written to the on-disk tier.
+        """
+        if self.writes is not None:
+            self.writes.join()
+
+
+def _fingerprint(func):
+    """
+    (internal) Returns a string, which changes with the code and the default 
+    arguments of a function, method, ``functools.partial`` or callable 
+    instance. Built-in callables have an empty fingerprint.
+    """
+    func = getattr(func, 'func', func)          # partial
+    func = getattr(func, '__func__', func)      # method
+    code = getattr(func, '__code__', None)
+    if code is None:
+        call = getattr(type(func), '__call__', None)
+        func = getattr(call, '__func__', call)
+        code = getattr(func, '__code__', None)
+        if code is None:
+            return ''
+    return _code(code) + repr(getattr(func, '__defaults__', None))
+
+def _code(code):
+    # the bytecode, constants and names of a code object and its nested code
+    parts = [code.co_code, repr(code.co_names)]
+    for const in code.co_consts:
+        parts.append(_code(const) if isinstance(const, CodeType) else \
+                     repr(const))
+    return '\0'.join(parts)
+
+
+class _Memo(object):
+    """
+    (internal) Keys the elements of a **task** in a ``Cache``. The key is the
+    hash of the pickled callable, its code, the constant arguments of the 
+    **task** and the pickled element. Callables, which cannot be pickled are
+    identified by their module and name. Callables are pickled by name, the 
+    bytecode, constants and names of their code invalidate the results of a 
+    changed body. Elements (or arguments), which cannot be pickled have no key,
+    they are evaluated, but not cached.
+    
+    Arguments:
+    
+      - cache (``Cache``) The ``Cache`` of the **task**.
+      - func (callable) The callable of the **task**.
+      - args (``tuple``) The constant arguments of the **task**.
+      - kwargs (``dict``) The keyworded arguments of the **task**.
+    
+    """
+    def __init__(self, cache, func, args, kwargs):
+        self.cache = cache
+        try:
+            identity = dumps(func, HIGHEST_PROTOCOL)
+        except Exception:
+            identity = '%s.%s' % (getattr(func, '__module__', None), \
+                                  getattr(func, '__name__', repr(func)))
+        identity += _fingerprint(func)
+        try:
+            self.prefix = identity + dumps((args, sorted(kwargs.items())), \
+                                           HIGHEST_PROTOCOL)
+        except Exception:
+            self.prefix = None
+        self.pending = {}       # {index:key} of submitted elements
+
+    def key(self, data):
+        """
+        Returns the key of an element or ``None``.
+        """
+        if self.prefix is None:
+            return None
+        try:
+            return sha1(self.prefix + dumps(data, HIGHEST_PROTOCOL)).hexdigest()
+        except Exception:
+            return None
+
+
+class _Weave(object):
+    """
+    (internal) Weaves a sequence of iterators, which can be stopped if the same 
+    number of results has been consumed from all iterators (repeats boundaries).
+
+    Arguments:
+    
+      - iterators (iterable) A sequence of objects supporting the iterator 
+        protocol.
+      - repeats (``int``) [default: ``1``] A positive integer defining the 
+        number of results to retrieve from one iterator before the next iterator
+        in the sequence.
+      - weights (sequence) [default: ``None``] Positive relative weights of the
+        iterators. The number of results retrieved from an iterator is 
+        "repeats" times its weight relative to the smallest weight, fractions 
+        are carried over to the next rotation (deficit round-robin).
+        
+    """
+    def __init__(self, iterators, repeats=1, weights=None):
+        self.iterators = iterators          # sequence of iterators
+        self.lenght = len(self.iterators)
+        self.i = 0                          # index of current iterators
+        self.stride = repeats      # number of repeats in this rotation
+        self.r = 0                 # current repeat
+        self.rotation_repeats = repeats  # repeats from the next rotation
+        self.weights = weights     # relative weights of the iterators
+        self.deficits = [0.] * self.lenght
+        self.repeats = self._quantum(0) # repeats from the current iterator
+        self.stopping = False      # if True stop at i==0, r==0
+        self.stopped = False
+
+    def weight(self, i):
+        """
+        Returns the weight of the i-th iterator relative to the smallest weight.
+        """
+        if not self.weights:
+            return 1.
+        return float(self.weights[i]) / min(self.weights)
+
+    def rotation_size(self, repeats=None):
+        """
+        Returns the maximum number of results retrieved in a rotation.
+        """
+        repeats = repeats or self.rotation_repeats
+        return sum([int(-(-repeats * self.weight(i) // 1)) for i in \
+                                                     xrange(self.lenght)])
+
+    def _quantum(self, i):
+        # number of repeats from the i-th iterator in this rotation
+        if not self.weights:
+            return self.stride
+        deficit = self.deficits[i] + self.stride * self.weight(i)
+        quantum = max(int(deficit), 1)
+        self.deficits[i] = max(deficit - quantum, 0.)
+        return quantum
+
+    def __iter__(self):
+        # support for the iterator protocol
+        return self
+
+    def stop(self):
+        """
+        Triggers stopping. ``_Weave`` will stop at repeats boundaries.
+        """
+        # stopping is a one-way process
+        # log.debug('Weave(%s) told to stop.' % id(self))
+        self.stopping = True
+
+    def next(self):
+        """
+        Returns the next element or raises ``StopIteration`` if stopped.
+        """
+        # need new iterable?
+        if self.r == self.repeats:
+            self.i = (self.i + 1) % self.lenght
+            self.r = 0
+            if self.i == 0:
+                # a new rotation
+                self.stride = self.rotation_repeats
+            self.repeats = self._quantum(self.i)
+
+        self.r += 1
+        if self.stopping and self.i == 0 and self.r == 1:
+            self.stopped = True
+        if self.i == 0 and self.stopped:
+            raise StopIteration
+        else:
+            iterator = self.iterators[self.i]
             return iterator.next()
 
 
-class _NuMapTask(object):
+class _Backpressure(_Weave):
+    """
+    (internal) Chooses the next **task** of a ``NuMap`` by backpressure. The 
+    elements are taken in bursts from the most downstream **task** with 
+    available input results, otherwise from the input **tasks** in turns. A 
+    **task** is not fed while it holds "repeats" elements in the pool or in its
+    result queue. The pool getter counts the results it queues and 
+    ``NuMap.next`` the results it takes and releases, if no **task** can be fed
+    the pool putter waits until one of them signals. It has the interface of 
+    ``_Weave`` used by the pool putter.
+
+    Arguments:
+    
+      - iterators (iterable) A sequence of objects supporting the iterator 
+        protocol.
+      - repeats (``int``) The maximum number of elements held by a **task**.
+      - upstream (``list``) The id of the **task** consumed by each **task**
+        or ``None``.
+        
+    """
+    def __init__(self, iterators, repeats, upstream):
+        _Weave.__init__(self, iterators, repeats)
+        self.upstream = upstream
+        self.changed = Condition(tLock())
+        self.taken = [0] * self.lenght      # elements taken from each task
+        self.released = [0] * self.lenght   # results released by next
+        self.queued = [0] * self.lenght     # results in the result queues
+        self.finished = [False] * self.lenght
+        self.root = -1                      # last fed input task
+        self.r = self.repeats               # the first burst is chosen
+
+    def arrive(self, i, number=1):
+        """
+        Counts "number" results put into the result queue of the i-th **task**
+        by the pool getter.
+        """
+        self.changed.acquire()
+        try:
+            self.queued[i] += number
+            self.changed.notify()
+        finally:
+            self.changed.release()
+
+    def consume(self, i):
+        """
+        Counts a result taken from the result queue of the i-th **task**.
+        """
+        self.changed.acquire()
+        self.queued[i] -= 1
+        self.changed.release()
+
+    def release(self, i):
+        """
+        Counts a released element of the i-th **task**.
+        """
+        self.changed.acquire()
+        try:
+            self.released[i] += 1
+            self.changed.notify()
+        finally:
+            self.changed.release()
+
+    def held(self, i):
+        """
+        Returns the number of elements of the i-th **task** in the pool or in
+        its result queue.
+        """
+        return self.taken[i] - self.released[i]
+
+    def _choose(self):
+        # the task and the length of the next burst or None
+        if self.stopping:
+            for i in xrange(self.lenght):
+                if self.upstream[i] is None and not self.finished[i]:
+                    # input tasks stop, the others are drained
+                    self.i = i
+                    self.finished[i] = True
+                    raise StopIteration
+        if all(self.finished):
+            raise StopIteration
+        # downstream tasks first
+        for i in xrange(self.lenght - 1, -1, -1):
+            upstream = self.upstream[i]
+            if upstream is None or self.finished[i]:
+                continue
+            burst = min(self.stride - self.held(i), self.queued[upstream])
+            if burst > 0:
+                return i, burst
+        # input tasks in turns
+        for shift in xrange(1, self.lenght + 1):
+            i = (self.root + shift) % self.lenght
+            if self.upstream[i] is not None or self.finished[i] or \
+               self.stopping:
+                continue
+            burst = self.stride - self.held(i)
+            if burst > 0:
+                self.root = i
+                return i, burst
+
+    def _burst(self):
+        # chooses the task and the length of the next burst
+        self.stride = self.rotation_repeats
+        self.changed.acquire()
+        try:
+            choice = self._choose()
+            while choice is None:
+                self.changed.wait()
+                choice = self._choose()
+        finally:
+            self.changed.release()
+        self.i, self.r, self.repeats = choice[0], 0, choice[1]
+
+    def next(self):
+        """
+        Returns the next element or raises ``StopIteration`` if the current 
+        **task** is finished.
+        """
+        if self.r == self.repeats:
+            self._burst()
+        self.r += 1
+        try:
+            element = self.iterators[self.i].next()
+        except StopIteration:
+            self.finished[self.i] = True
+            self.r = self.repeats
+            raise
+        self.changed.acquire()
+        self.taken[self.i] += 1
+        self.changed.release()
+        return element
+
+
+class _Tracer(object):
+    """
+    (internal) Records events into a ring buffer. Callers check the "on" 
+    attribute before calling ``_Tracer.record``. A "stall" watchdog thread 
+    dumps the events to the log if no new event has been recorded for "stall"
+    seconds.
+    """
+    def __init__(self):
+        self.on = False
+        self.events = deque([], 0)
+        self.stall = None
+
+    def start(self, size, stall=None):
+        self.events = deque([], size)
+        self.stall = stall
+        self.on = True
+        if stall:
+            watchdog = Thread(target=self._watch, args=(self.events, stall))
+            watchdog.daemon = True
+            watchdog.start()
+
+    def stop(self):
+        self.on = False
+
+    def record(self, event, owner, task=None, index=None, extra=None, \
+               stamp=None):
+        """
+        Records an event at the current time or at the time "stamp".
+        """
+        self.events.append((stamp or time(), event, owner, task, index, extra))
+
+    def dump(self, file=None):
+        events = sorted(self.events)
+        if file is not None:
+            for event in events:
+                file.write('%.6f %s %s %s %s %s\n' % event)
+        return events
+
+    def _watch(self, events, stall):
+        # runs until the tracer is stopped or restarted
+        last, dumped = None, False
+        while self.on and self.events is events:
+            seen = events[-1] if events else None
+            if seen is not last:
+                last, changed, dumped = seen, time(), False
+            elif last is not None and not dumped and \
+                 time() - changed > stall:
+                dump = StringIO()
+                self.dump(dump)
+                log.error('no events for %ss, last events:\n%s' % \
+                          (stall, dump.getvalue()))
+                dumped = True
+            sleep(stall / 2.)
+
+# the tracer shared by all NuMap and Piper instances
+_tracer = _Tracer()
+
+
+class _Tuner(object):
+    """
+    (internal) Adapts the "stride" of a ``_Weave`` and the size of the 
+    semaphore of a running ``NuMap``. It is called by the pool putter before
+    each rotation of the ``_Weave``. The pool putter counts the submitted 
+    elements and the time it waits for the semaphore, the pool getter counts
+    the received results. The difference is the number of elements in the 
+    pool, if it is smaller than the number of **workers** some are idle.
+    The semaphore never drops below the number of **tasks** times the stride.
+    
+    Arguments:
+    
+      - weave (``_Weave``) The weave of **tasks**.
+      - semaphore (``Semaphore``) The pool semaphore.
+      - value (``int``) The initial value of the semaphore.
+      - pool_size (``int``) The number of **workers**.
+      - strides (``tuple``) The minimum and maximum stride.
+      - buffers (``tuple``) The minimum and maximum value of the semaphore.
+    
+    """
+    def __init__(self, weave, semaphore, value, pool_size, strides, buffers):
+        self.weave = weave
+        self.semaphore = semaphore
+        self.value = value      # current value of the semaphore
+        self.debt = 0           # permits to take back from the semaphore
+        self.pool_size = max(pool_size, 1)
+        self.strides = strides
+        self.buffers = buffers
+        self.submitted = 0      # written by the pool putter
+        self.received = 0       # written by the pool getter
+        self._reset()
+
+    def _reset(self):
+        self.started = time()
+        self.waited = 0.        # time waited for the semaphore
+        self.busy = 0           # sum of the sampled elements in the pool
+        self.samples = 0
+
+    def submit(self):
+        """
+        Counts a submitted element and samples the number of elements in the 
+        pool.
+        """
+        self.submitted += 1
+        self.busy += self.submitted - self.received
+        self.samples += 1
+
+    def resize(self, value):
+        """
+        Grows or shrinks the semaphore. Permits, which are in use, are taken 
+        back later.
+        """
+        floor = self.weave.rotation_size()
+        value = max(min(value, self.buffers[1]), self.buffers[0], floor)
+        while self.value < value:
+            if self.debt:
+                self.debt -= 1
+            else:
+                self.semaphore.release()
+            self.value += 1
+        self.debt += self.value - value
+        self.value = value
+        while self.debt and self.semaphore.acquire(False):
+            self.debt -= 1
+
+    def rotate(self):
+        """
+        Adapts the stride and the semaphore for the next rotation.
+        """
+        elapsed = time() - self.started
+        if self.samples < self.pool_size or elapsed < 0.01:
+            # too little to judge
+            return
+        blocked = self.waited / elapsed
+        occupancy = float(self.busy) / self.samples / self.pool_size
+        tasks = self.weave.lenght
+        stride = self.weave.rotation_repeats
+        if occupancy < 1.:
+            # idle workers
+            if blocked > 0.1:
+                self.resize(self.value + tasks)
+            if stride < self.strides[1] and not self.debt and \
+               tasks * (stride + 1) <= self.value:
+                stride += 1
+        elif occupancy > 2. and stride > self.strides[0]:
+            stride -= 1
+        elif blocked < 0.01:
+            self.resize(self.value - tasks)
+        self.weave.rotation_repeats = stride
+        self.resize(self.value)     # pay back debt
+        self._reset()
+
+
+class _Balancer(object):
+    """
+    (internal) Sets the weights of the **tasks** of a ``_Weave`` from their 
+    measured compute time per element, such that each chain of **tasks** gets
+    a similar share of the **worker** time. It is called by the pool putter 
+    before each rotation of the ``_Weave``. A **task** has the weight of the 
+    **task** it consumes and a rotation never exceeds the semaphore.
+    
+    Arguments:
+    
+      - weave (``_Weave``) The weave of **tasks**.
+      - counters (``list``) The per-**task** counters of ``_Stats``.
+      - upstream (``list``) The id of the **task** consumed by each **task**
+        or ``None``. Consumed **tasks** precede their consumers.
+      - value (``int``) The value of the semaphore.
+    
+    """
+    def __init__(self, weave, counters, upstream, value):
+        self.weave = weave
+        self.counters = counters
+        self.upstream = upstream
+        self.value = value
+
+    def rotate(self):
+        """
+        Adapts the weights for the next rotation.
+        """
+        # compute time per element of each chain of tasks
+        heads, costs = [], {}
+        for task, counters in enumerate(self.counters):
+            upstream = self.upstream[task]
+            head = task if upstream is None else heads[upstream]
+            heads.append(head)
+            done = counters['completed'] + counters['failed']
+            if done and counters['compute_time']:
+                costs[head] = costs.get(head, 0.) + \
+                              counters['compute_time'] / done
+        if not costs:
+            # too little to judge
+            return
+        top = max(costs.values())
+        weights = []
+        for task, head in enumerate(heads):
+            weights.append(top / costs[head] if head in costs else \
+                           self.weave.weight(head))
+        # a rotation has to fit into the semaphore
+        stride = self.weave.rotation_repeats
+        room = self.value - len(weights) * (stride + 1)
+        extra = sum([stride * (weight - 1.) for weight in weights])
+        if extra > room:
+            scale = max(room, 0) / extra
+            weights = [1. + (weight - 1.) * scale for weight in weights]
+        self.weave.weights = weights
+        for counters, weight in izip(self.counters, weights):
+            counters['weight'] = weight
+
+
+class _Hedger(object):
+    """
+    (internal) Tracks the chunks in the **worker pool** and duplicates 
+    straggling chunks of idempotent **tasks** see: *Hedging*. A chunk is a 
+    straggler if it has been in the pool "factor" times longer than the 
+    "percentile" of the latencies of the recent chunks of its **task**. At 
+    most one duplicate per idle **worker** is submitted, idle **workers** are
+    inferred from the number of chunks in the pool. The sentinels of the 
+    **workers** are held back until all chunks have returned, the last chunks
+    can be duplicated. Each duplicate holds its own references to the shared
+    memory of its elements.
+    
+    Arguments:
+    
+      - put (callable) Submits a chunk message to the **worker pool**.
+      - workers (``int``) The number of chunks evaluated concurrently.
+      - hedgeable (``list``) A ``bool`` per **task**, ``True`` if its chunks
+        can be duplicated.
+      - counters (``list``) The per-**task** counters of ``_Stats``.
+      - percentile (``float``) [default: ``0.9``] The percentile of recent 
+        latencies.
+      - factor (``float``) [default: ``2.``] The multiple of the percentile 
+        after which a chunk is a straggler.
+      - window (``int``) [default: ``64``] The number of recent latencies.
+      - samples (``int``) [default: ``4``] The number of latencies needed 
+        before chunks of a **task** are duplicated.
+      - poll (``float``) [default: ``0.01``] The interval between checks for
+        stragglers.
+      - arena (``_ShmArena``) [default: ``None``] The shared memory of the
+        elements.
+    
+    """
+    def __init__(self, put, workers, hedgeable, counters, percentile=0.9, \
+                 factor=2., window=64, samples=4, poll=0.01, arena=None):
+        self.put_to_pool_in = put
+        self.arena = arena
+        self.workers = workers
+        self.hedgeable = hedgeable
+        self.counters = counters
+        self.percentile = percentile
+        self.factor = factor
+        self.samples = samples
+        self.poll = poll
+        self.latencies = [deque(maxlen=window) for task in hedgeable]
+        self.inflight = {}      # {seq:[message or None, copies]}
+        self.losers = {}        # {seq:copies} duplicates to be discarded
+        self.sentinels = 0      # held back sentinels of the workers
+        self.closed = False     # the workers have been sent sentinels
+        self.lock = tLock()     # pool putter, getter and hedger threads
+        self.sending = tLock()  # no duplicates after the sentinels
+        self.stopped = Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Starts checking for stragglers in a separate thread.
+        """
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops checking for stragglers.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.poll):
+            self.hedge()
+
+    def put(self, message):
+        """
+        Submits a message of the pool putter and tracks it if it is a chunk.
+        """
+        if message is None:
+            self.lock.acquire()
+            self.sentinels += 1
+            flush = not self.inflight
+            self.lock.release()
+            if flush:
+                self.flush()
+            return
+        if message[1] is not None:
+            task = message[0]
+            self.lock.acquire()
+            self.inflight[message[3]] = [message if self.hedgeable[task] else \
+                                         None, 1]
+            self.lock.release()
+        self.put_to_pool_in(message)
+
+    def flush(self):
+        """
+        Sends the held back sentinels, no chunk is duplicated afterwards.
+        """
+        self.sending.acquire()
+        try:
+            self.lock.acquire()
+            sentinels, self.sentinels = self.sentinels, 0
+            self.closed = True
+            self.lock.release()
+            for sentinel in xrange(sentinels):
+                self.put_to_pool_in(None)
+        finally:
+            self.sending.release()
+
+    def receive(self, seq):
+        """
+        Returns ``False`` if the results of the chunk "seq" have already been
+        received from a duplicate.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.inflight.pop(seq, None)
+            if entry is None:
+                copies = self.losers.pop(seq, None)
+                if copies is None:
+                    # not from the pool
+                    return True
+                if copies > 1:
+                    self.losers[seq] = copies - 1
+                return False
+            message, copies = entry
+            if copies > 1:
+                self.losers[seq] = copies - 1
+            elif message is not None:
+                self.latencies[message[0]].append(time() - message[2])
+            flush = self.sentinels and not self.inflight
+        finally:
+            self.lock.release()
+        if flush:
+            self.flush()
+        return True
+
+    def hedge(self):
+        """
+        Duplicates the longest straggling chunks if **workers** are idle.
+        """
+        now = time()
+        duplicates = []
+        self.lock.acquire()
+        try:
+            idle = self.workers - sum(self.losers.values()) - \
+                   sum([copies for message, copies in self.inflight.values()])
+            if idle <= 0:
+                return
+            limits = []
+            for latencies in self.latencies:
+                if len(latencies) < self.samples:
+                    limits.append(None)
+                else:
+                    recent = sorted(latencies)[int(self.percentile * \
+                                                   (len(latencies) - 1))]
+                    limits.append(self.factor * recent)
+            stragglers = []
+            for seq, (message, copies) in self.inflight.iteritems():
+                if message is None or copies > 1:
+                    continue
+                limit = limits[message[0]]
+                if limit is not None and now - message[2] > limit:
+                    stragglers.append((message[2], seq))
+            stragglers.sort()
+            for sent, seq in stragglers[:idle]:
+                entry = self.inflight[seq]
+                entry[1] += 1
+                self.counters[entry[0][0]]['hedged'] += 1
+                duplicates.append(entry[0])
+        finally:
+            self.lock.release()
+        if duplicates:
+            self.sending.acquire()
+            try:
+                if not self.closed:
+                    for message in duplicates:
+                        if self.arena is not None:
+                            # the worker of each copy frees the elements
+                            for i, data in _load_chunk(message[1])[1]:
+                                if type(data) is _ShmHandle:
+                                    self.arena.incref(data)
+                        self.put_to_pool_in(message)
+            finally:
+                self.sending.release()
+
+
+class _Budget(object):
+    """
+    (internal) A semaphore of elements, which is also a budget of bytes see: 
+    *Byte budget*. An element is acquired before it is submitted, its charge
+    is set by the pool putter and the pool getter and returned when it is 
+    released. The size of the last results of a **task** is the estimate for
+    its submitted elements.
+    
+    Arguments:
+    
+      - limit (``int``) The budget in bytes.
+      - minimum (``int``) The number of elements, which are acquired 
+        regardless of the budget.
+      - maximum (``int``) [default: ``None``] The maximum number of elements.
+    
+    """
+    def __init__(self, limit, minimum, maximum=None):
+        self.limit = limit
+        self.minimum = minimum
+        self.maximum = maximum
+        self.items = 0          # acquired elements
+        self.bytes = 0          # charged bytes
+        self.peak = 0           # maximum of charged bytes
+        self.charges = {}       # {(task, index):bytes}
+        self.estimates = {}     # {task:bytes} of the last result
+        self.condition = Condition(tLock())
+
+    def _blocked(self):
+        return (self.maximum and self.items >= self.maximum) or \
+               (self.items >= self.minimum and \
+                (not self.estimates or self.bytes >= self.limit))
+
+    def acquire(self, blocking=True):
+        """
+        Acquires an element, returns ``False`` if it would block and 
+        "blocking" is ``False``.
+        """
+        self.condition.acquire()
+        try:
+            while self._blocked():
+                if not blocking:
+                    return False
+                self.condition.wait()
+            self.items += 1
+            return True
+        finally:
+            self.condition.release()
+
+    def release(self):
+        """
+        Releases an element.
+        """
+        self.condition.acquire()
+        self.items -= 1
+        self.condition.notify()
+        self.condition.release()
+
+    def _charge(self, task, indices, share):
+        # called with the lock held
+        for index in indices:
+            self.bytes += share - self.charges.get((task, index), 0)
+            self.charges[(task, index)] = share
+        self.peak = max(self.peak, self.bytes)
+        self.condition.notify()
+
+    def submit(self, task, indices, size):
+        """
+        Charges the elements of a submitted chunk with their share of its 
+        "size" or the estimated size of their results.
+        """
+        share = size // max(len(indices), 1)
+        self.condition.acquire()
+        self._charge(task, indices, max(share, self.estimates.get(task, 0)))
+        self.condition.release()
+
+    def receive(self, task, indices, size):
+        """
+        Charges the elements of a received chunk with their share of its 
+        "size".
+        """
+        share = size // max(len(indices), 1)
+        self.condition.acquire()
+        self.estimates[task] = share
+        self._charge(task, indices, share)
+        self.condition.release()
+
+    def discharge(self, task, index):
+        """
+        Returns the charge of an element.
+        """
+        self.condition.acquire()
+        self.bytes -= self.charges.pop((task, index), 0)
+        self.condition.notify()
+        self.condition.release()
+
+
+class _Stats(object):
+    """
+    (internal) Counters of a running ``NuMap`` instance per **task** and per 
+    **worker**. Each counter is written by a single thread. The **workers** 
+    measure their timings and send them with each chunk of results.
+    
+    Arguments:
+    
+      - task_num (``int``) The number of **tasks**.
+      - worker_num (``int``) The number of **workers**.
+      - pickled (``bool``) If ``True`` chunks are pickled explicitly and the 
+        serialization is measured.
+    
+    """
+    TASK = ('submitted', 'completed', 'failed', 'semaphore_wait', \
+            'inqueue_time', 'compute_time', 'input_bytes', 'input_time', \
+            'output_bytes', 'output_time', 'result_time', 'reorder_depth', \
+            'reorder_max', 'weight', 'cached', 'hedged')
+    WORKER = ('chunks', 'completed', 'failed', 'inqueue_time', 'compute_time', \
+              'input_time', 'output_bytes', 'output_time')
+
+    def __init__(self, task_num, worker_num, pickled):
+        self.pickled = pickled
+        self.affinity = None    # the layout of pinned workers
+        self.tasks = [dict.fromkeys(self.TASK, 0) for i in xrange(task_num)]
+        self.workers = [dict.fromkeys(self.WORKER, 0) for i in \
+                        xrange(worker_num)]
+
+    def snapshot(self):
+        """
+        Returns a copy of the counters.
+        """
+        snapshot = {'tasks':[dict(counters) for counters in self.tasks],
+                    'workers':[dict(counters) for counters in self.workers]}
+        if self.affinity is not None:
+            snapshot['affinity'] = dict(self.affinity)
+        return snapshot
+
+
+class _NuMapTask(object):
+    """
+    (internal) the ``_NumMapTask`` is an object-wrapper of ``NuMap`` instaces.
+    It is an interator over the results from a single **task**.
+    
+    Arguments:
+    
+        - iterator (``NuMap``) instance to be wrapped, usually initialization 
+          is done by the ``NuMap.get_task``
+
+    """
+    def __init__(self, iterator, task, timeout, block):
+        self.timeout = timeout
+        self.block = block
+        self.task = task
+        self.iterator = iterator
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """
+        Returns a result if availble within "timeout" else raises a 
+        ``TimeoutError`` exception. See documentation for ``NuMap.next``.
+        """
+        return self.iterator.next(task=self.task, timeout=self.timeout,
+                                                    block=self.block)
+
+    def anext(self, loop=None):
+        """
+        Returns a future of the next result see: ``NuMap.anext``.
+        """
+        return self.iterator.anext(task=self.task, loop=loop)
+
+
+class _AsyncioWorker(object):
+    """
+    (internal) The **worker pool** of an "asyncio" ``NuMap``. Evaluates the
+    elements of all **tasks** on an event loop, which runs in a single thread.
+    Elements are submitted by the pool putter thread through 
+    ``loop.call_soon_threadsafe``. Coroutines and futures returned by the 
+    functions of the **tasks** are awaited, at most "worker_num" of them 
+    concurrently. A chunk of results is returned when all its elements are 
+    evaluated.
+    
+    Arguments:
+    
+      - loop (event loop) A new event loop.
+      - outqueue (``Queue``) The output queue of the **worker pool**.
+      - tasks (``dict``) The registry ``{task_id:(func, args, kwargs)}``.
+      - worker_num (``int``) The maximum number of concurrently awaited 
+        elements.
+      - persistent (``bool``) [default: ``False``] If ``True`` the event loop 
+        keeps running after the **worker** sentinel until ``_AsyncioWorker.shutdown``.
+      - initializer (callable) [default: ``None``] Called with "initargs" in 
+        the thread of the event loop, see: ``worker_state``.
+      - initargs (``tuple``) [default: ``()``] The arguments of the 
+        "initializer".
+    
+    """
+    def __init__(self, loop, outqueue, tasks, worker_num, persistent=False, \
+                 initializer=None, initargs=()):
+        self.loop = loop
+        self.initializer = initializer
+        self.initargs = initargs
+        self.failed = None      # exception of the initializer
+        self.persistent = persistent
+        self.outqueue = outqueue
+        self.tasks = tasks
+        self.limit = max(worker_num, 1)
+        self.running = 0        # awaited elements
+        self.waiting = deque()  # elements waiting for a free slot
+        self.stopping = False
+
+    def run(self):
+        """
+        Runs the event loop until the **worker** sentinel is received and all
+        elements are evaluated.
+        """
+        asyncio.set_event_loop(self.loop)
+        self.failed = _init_worker(self.initializer, self.initargs)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def submit(self, task):
+        """
+        Receives a message from the pool putter.
+        """
+        if task is None:
+            self.stopping = True
+            self._finish()
+            return
+        if task[1] is None:
+            self.outqueue.put(task)
+            return
+        job, chunk, sent, seq = task
+        # [job, results, pending, sent, started, seq]
+        state = [job, [None] * len(chunk), len(chunk), sent, time(), seq]
+        for slot, (i, data) in enumerate(chunk):
+            self.waiting.append((state, slot, i, data))
+        self._schedule()
+
+    def _schedule(self):
+        while self.waiting and self.running < self.limit:
+            state, slot, i, data = self.waiting.popleft()
+            func, args, kwargs = self.tasks[state[0]]
+            try:
+                if self.failed is not None:
+                    raise self.failed
+                result = func(data, *args, **kwargs)
+                if asyncio.iscoroutine(result) or \
+                   isinstance(result, asyncio.Future):
+                    future = asyncio.ensure_future(result, loop=self.loop)
+                    future.add_done_callback(partial(self._done, state, slot, i))
+                    self.running += 1
+                    continue
+                result = (i, True, result)
+            except Exception, excp:
+                result = (i, False, excp)
+            self._store(state, slot, result)
+
+    def _done(self, state, slot, i, future):
+        self.running -= 1
+        try:
+            result = (i, True, future.result())
+        except Exception, excp:
+            result = (i, False, excp)
+        self._store(state, slot, result)
+        self._schedule()
+        self._finish()
+
+    def _store(self, state, slot, result):
+        state[1][slot] = result
+        state[2] -= 1
+        if not state[2]:
+            job, results, pending, sent, started, seq = state
+            self.outqueue.put((job, results, (0, started, started - sent, 0., \
+                                              time() - started, 0, 0.), seq))
+
+    def _finish(self):
+        if self.stopping and not self.running and not self.waiting:
+            self.stopping = False
+            self.outqueue.put(None)
+            if not self.persistent:
+                self.loop.stop()
+
+    def shutdown(self):
+        """
+        Stops the event loop of a persistent **worker**.
+        """
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class _Unordered(object):
+    """
+    (internal) The results of a **task** of an unordered ``NuMap``, which does
+    not skip results. The pool getter adds whole chunks of results and wakes
+    the waiting consumers once per chunk. Available results are taken without 
+    locking. It has the interface of a ``Queue`` used by ``NuMap.next``.
+    """
+    def __init__(self):
+        self.items = deque()
+        self.ready = Condition(tLock())
+
+    def extend(self, items):
+        """
+        Adds a chunk of results.
+        """
+        self.ready.acquire()
+        try:
+            self.items.extend(items)
+            self.ready.notify(len(items))
+        finally:
+            self.ready.release()
+
+    def put(self, item):
+        self.extend((item,))
+
+    def empty(self):
+        return not self.items
+
+    def qsize(self):
+        return len(self.items)
+
+    def get(self, block=True, timeout=None):
+        """
+        Returns a result. Raises ``Queue.Empty`` if no result is available 
+        within "timeout" or immediately if "block" is ``False``.
+        """
+        try:
+            return self.items.popleft()
+        except IndexError:
+            if not block:
+                raise Empty
+        if timeout is not None:
+            deadline = time() + timeout
+        self.ready.acquire()
+        try:
+            while True:
+                try:
+                    return self.items.popleft()
+                except IndexError:
+                    pass
+                if timeout is None:
+                    self.ready.wait()
+                else:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        raise Empty
+                    self.ready.wait(remaining)
+        finally:
+            self.ready.release()
+
+
+class _Reorder(object):
     """
-    (internal) the ``_NumMapTask`` is an object-wrapper of ``NuMap`` instaces.
-    It is an interator over the results from a single **task**.
+    (internal) Restores the order of the results of a **task**. A result is 
+    held in a ring buffer at the position of its index modulo the size of 
+    the ring until all previous results have been released. Consecutive 
+    results are released in constant time and the memory is bounded by the 
+    number of results, which can be held at the same time. The ring grows if
+    a result arrives too early.
     
     Arguments:
     
-        - iterator (``NuMap``) instance to be wrapped, usually initialization 
-          is done by the ``NuMap.get_task``
+      - size (``int``) The initial size of the ring, usually the size of the 
+        "buffer".
+    
+    """
+    def __init__(self, size):
+        self.ring = [None] * max(size, 1)
+        self.last = -1          # index of the last released result
+        self.depth = 0          # number of held results
+
+    def put(self, i, item):
+        """
+        Holds the "item" of the result with index "i" until it is released.
+        """
+        while i - self.last > len(self.ring):
+            self._grow()
+        self.ring[i % len(self.ring)] = item
+        self.depth += 1
+
+    def _grow(self):
+        size = len(self.ring)
+        ring = [None] * (2 * size)
+        for i in xrange(self.last + 1, self.last + 1 + size):
+            ring[i % (2 * size)] = self.ring[i % size]
+        self.ring = ring
 
+    def pop(self):
+        """
+        Releases and returns the next item or returns ``None`` if it has not 
+        arrived.
+        """
+        slot = (self.last + 1) % len(self.ring)
+        item = self.ring[slot]
+        if item is not None:
+            self.ring[slot] = None
+            self.last += 1
+            self.depth -= 1
+        return item
+
+    def skip(self, number):
+        """
+        Gives up the next "number" of results and returns the held items of 
+        those results.
+        """
+        skipped = []
+        for i in xrange(self.last + 1, self.last + 1 + \
+                        min(number, len(self.ring))):
+            slot = i % len(self.ring)
+            if self.ring[slot] is not None:
+                skipped.append(self.ring[slot])
+                self.ring[slot] = None
+                self.depth -= 1
+        self.last += number
+        return skipped
+
+
+class _Dispatcher(object):
     """
-    def __init__(self, iterator, task, timeout, block):
-        self.timeout = timeout
-        self.block = block
-        self.task = task
-        self.iterator = iterator
+    (internal) Feeds elements into the input channels (``SimpleQueues``) of 
+    "process" **workers**. The channel is chosen in turns (``'round_robin'``)
+    or by the smallest number of bytes pending in its pipe (``'depth'``). 
+    **Worker** sentinels are send one per channel.
+    
+    Arguments:
+    
+      - channels (``list``) A list of ``SimpleQueue`` instances one per 
+        **worker**.
+      - policy (``'round_robin'`` or ``'depth'``) The dispatch policy.
+    
+    """
+    def __init__(self, channels, policy):
+        self.channels = channels
+        self.policy = policy
+        self.i = 0              # next channel (round_robin)
+        self.sentinels = 0      # channels, which got a sentinel
+        self._depth = array('i', [0])
 
-    def __iter__(self):
-        return self
+    def depth(self, channel):
+        """
+        Returns the number of bytes pending in the pipe of a channel.
+        """
+        ioctl(self.channels[channel]._reader.fileno(), FIONREAD, \
+              self._depth, True)
+        return self._depth[0]
 
-    def next(self):
+    def __call__(self, task):
+        if task is None:
+            channel = self.sentinels
+            self.sentinels += 1
+        elif self.policy == 'depth':
+            channel = min(xrange(len(self.channels)), key=self.depth)
+        else:
+            channel = self.i
+            self.i = (self.i + 1) % len(self.channels)
+        _send(self.channels[channel]._writer, task)
+
+
+def _dump_chunk(message):
+    """
+    (internal) Pickles a chunk message for "process" **workers**. The header
+    ``(task, sent, seq)`` is pickled before the chunk, so that a **worker** 
+    knows the sequence number of a chunk before it unpickles the chunk.
+    """
+    task, chunk, sent, seq = message
+    frame = StringIO()
+    pickler = Pickler(frame, HIGHEST_PROTOCOL)
+    pickler.dump((task, sent, seq))
+    pickler.dump(chunk)
+    return frame.getvalue()
+
+def _load_chunk(frame):
+    """
+    (internal) Returns the chunk message pickled by ``_dump_chunk``.
+    """
+    unpickler = Unpickler(StringIO(frame))
+    task, sent, seq = unpickler.load()
+    return (task, unpickler.load(), sent, seq)
+
+class _Pickled(str):
+    """
+    (internal) A result of a "process" **worker** pickled by the **worker**. 
+    It is passed as it is by the pool getter and unpickled by ``NuMap.next``
+    in the thread of the consumer.
+    """
+    __slots__ = ()
+
+def _pickle_result(item):
+    """
+    (internal) Returns a result ``(index, is_valid, result)`` with its result
+    pickled, or the exception if it cannot be pickled.
+    """
+    index, is_valid, result = item
+    try:
+        return (index, is_valid, _Pickled(dumps(result, HIGHEST_PROTOCOL)))
+    except Exception, excp:
+        return (index, False, excp)
+
+def _send(writer, message):
+    """
+    (internal) Sends a message to "process" **workers** through the pipe 
+    "writer". A chunk message carries the chunk message pickled by the pool 
+    putter see: ``_dump_chunk``, which is send as it is.
+    """
+    if message is not None and message[1] is not None:
+        writer.send_bytes(message[1])
+    else:
+        writer.send(message)
+
+
+# a pickled worker sentinel
+_SENTINEL = dumps(None, HIGHEST_PROTOCOL)
+
+def _ready(connections):
+    """
+    (internal) Returns the ``Connections``, which can be read. Blocks until 
+    there is one. Without ``select`` the ``Connections`` are polled in turn.
+    """
+    if HASCH:
+        return select(connections, [], [])[0]
+    if len(connections) == 1:
+        connections[0].poll(None)
+        return connections
+    while True:
+        for connection in connections:
+            if connection.poll(0.001):
+                return [connection]
+
+
+class _StealingQueue(object):
+    """
+    (internal) The input of a "process" **worker** with its own channel. 
+    Elements are taken from the own channel if available, otherwise they are 
+    stolen from the channels of other **workers**. A stolen **worker** 
+    sentinel is given back to its channel, which is not stolen from anymore.
+    
+    Arguments:
+    
+      - channels (``list``) A list of ``SimpleQueue`` instances one per 
+        **worker**.
+      - own (``int``) The index of the channel of this **worker**.
+    
+    """
+    def __init__(self, channels, own):
+        self.channels = channels
+        self.own = own
+        self.finished = set()   # channels, which do not get new elements
+
+    def _take(self, channel, block):
         """
-        Returns a result if availble within "timeout" else raises a 
-        ``TimeoutError`` exception. See documentation for ``NuMap.next``.
+        (internal) Returns a ``list`` with a pickled element from a channel if
+        its lock can be acquired and an element is available.
         """
-        return self.iterator.next(task=self.task, timeout=self.timeout,
-                                                    block=self.block)
+        queue = self.channels[channel]
+        if queue._rlock.acquire(block):
+            try:
+                if queue._reader.poll():
+                    return [queue._reader.recv_bytes()]
+            finally:
+                queue._rlock.release()
+        return []
+
+    def get(self):
+        """
+        Returns the next pickled element for the **worker**. Blocks until an 
+        element is available in any channel.
+        """
+        while True:
+            readers = [queue._reader for channel, queue in \
+                       enumerate(self.channels) if channel == self.own or \
+                       channel not in self.finished]
+            ready = _ready(readers)
+            # prefer the own channel
+            if self.channels[self.own]._reader in ready:
+                task = self._take(self.own, True)
+                if task:
+                    return task[0]
+            for channel, queue in enumerate(self.channels):
+                if channel == self.own or queue._reader not in ready:
+                    continue
+                task = self._take(channel, False)
+                if not task:
+                    continue
+                if task[0] == _SENTINEL:
+                    # sentinel of another worker
+                    queue.put(None)
+                    self.finished.add(channel)
+                    continue
+                return task[0]
+
+
+class _Channel(object):
+    """
+    (internal) The ``NuMap`` end of an input queue, which has been made by the
+    template process. It has the "_reader" and "_writer" ``Connections`` of a 
+    ``SimpleQueue``.
+    """
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+
+    def put(self, obj):
+        self._writer.send(obj)
+
+
+class _Forked(object):
+    """
+    (internal) A "process" **worker** forked by the template process. It has 
+    the interface of a ``Process`` used by the ``NuMap``. The **worker** holds
+    the only write end of its "lifeline" pipe, which ends when the **worker**
+    has ended.
+    
+    Arguments:
+    
+      - pid (``int``) The process id of the **worker**.
+      - lifeline (``Connection``) [default: ``None``] The read end of the 
+        lifeline pipe. Without it the process id is signalled.
+    
+    """
+    def __init__(self, pid, lifeline=None):
+        self.pid = pid
+        self.lifeline = lifeline
+
+    def is_alive(self):
+        if self.lifeline is not None:
+            return not self.lifeline.poll()
+        try:
+            os.kill(self.pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def join(self, timeout=None):
+        """
+        Waits until the **worker** has ended.
+        """
+        self.lifeline.poll(timeout)
+
+    def terminate(self):
+        if self.is_alive():
+            try:
+                os.kill(self.pid, SIGTERM)
+            except OSError:
+                pass
+
+
+class _Template(object):
+    """
+    (internal) Starts and talks to a template process, which is a fresh Python
+    interpreter, see: ``_template_main``. The template process imports the 
+    modules needed by the **tasks** and forks "process" **workers** on 
+    request. File descriptors are passed through a UNIX socket.
+    """
+    def __init__(self):
+        parent, child = socketpair()
+        self.conn = Connection(os.dup(parent.fileno()))
+        parent.close()
+        # the template process ends if the NuMap process closes the socket, 
+        # template processes must not inherit it
+        flags = fcntl(self.conn.fileno(), F_GETFD)
+        fcntl(self.conn.fileno(), F_SETFD, flags | FD_CLOEXEC)
+        command = 'import sys; from %s import _template_main; ' % __name__ + \
+                  '_template_main(int(sys.argv[1]))'
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        self.process = Popen([sys.executable, '-c', command, \
+                              str(child.fileno())], env=env)
+        child.close()
+        self.lock = tLock()
+        self.main = False
+        # the template process is prepared like a spawned process, the main
+        # module is imported only for callables defined in it
+        self.conn.send(('prepare', {'sys_path':sys.path, 'dir':os.getcwd()}))
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def load(self, func):
+        """
+        Imports the module of a callable and the modules listed by its 
+        ``imports`` decorator in the template process.
+        """
+        modules = list(getattr(func, 'imports', []))
+        module = getattr(func, '__module__', None)
+        if module and module != '__main__':
+            modules.append(module)
+        self.lock.acquire()
+        try:
+            if modules:
+                self.conn.send(('import', modules))
+            main_path = getattr(sys.modules['__main__'], '__file__', None)
+            if module == '__main__' and main_path and not self.main:
+                # imported as __parents_main__ i.e. guarded code does not run
+                self.conn.send(('prepare', \
+                                {'main_path':os.path.abspath(main_path)}))
+                self.main = True
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """
+        Ends the template process and the **workers** forked by it.
+        """
+        self.conn.close()
+        self.process.wait()
+
+    def queues(self, worker_num):
+        """
+        Makes the input queue, the input channels of "worker_num" **workers** 
+        and the shared chunk slots. Returns the ``NuMap`` ends of the queues 
+        and the slots.
+        """
+        slots = TemporaryFile()
+        slots.write(array('i', [-1] * worker_num).tostring())
+        slots.flush()
+        self.lock.acquire()
+        try:
+            self.conn.send(('queues', worker_num))
+            sendfd(self.conn.fileno(), slots.fileno())
+            channels = []
+            for channel in xrange(worker_num + 1):
+                reader = Connection(recvfd(self.conn.fileno()))
+                writer = Connection(recvfd(self.conn.fileno()))
+                channels.append(_Channel(reader, writer))
+        finally:
+            self.lock.release()
+        return channels[0], channels[1:], _map_slots(slots.fileno(), \
+                                                     worker_num)
+
+    def spawn(self, worker, host, tasks, dispatch, writer, control=None, \
+              initializer=None, initargs=()):
+        """
+        Forks the "worker"-th **worker** with the result pipe "writer" and the 
+        optional "control" pipe. Returns a ``_Forked`` instance.
+        """
+        lifeline, end = os.pipe()
+        self.lock.acquire()
+        try:
+            self.conn.send(('spawn', worker, host, tasks, dispatch, \
+                            control is not None, initializer, initargs))
+            sendfd(self.conn.fileno(), writer.fileno())
+            if control is not None:
+                sendfd(self.conn.fileno(), control.fileno())
+            sendfd(self.conn.fileno(), end)
+            os.close(end)
+            return _Forked(self.conn.recv(), Connection(lifeline))
+        finally:
+            self.lock.release()
+
+
+class _Multiplexer(object):
+    """
+    (internal) Multiplexes the result pipes of "process" **workers**. A result
+    is received from whichever pipe is ready, the time of the 
+    deserialization of a chunk of results is added to its timings. The pipe 
+    of a **worker** is not read after its sentinel. The end of a pipe before the sentinel means that
+    the **worker** has died, it is handled by the "supervisor".
+    
+    Arguments:
+    
+      - readers (``list``) A list of ``Connection`` instances one per 
+        **worker**.
+      - supervisor (``_Supervisor``) [default: ``None``] Tracks the chunks in 
+        the pool and replaces dead **workers**.
+      - hits (``Connection``) [default: ``None``] A pipe of results from the 
+        ``Cache``, which are received first.
+    
+    """
+    def __init__(self, readers, supervisor=None, hits=None):
+        self.readers = list(readers)
+        self.workers = dict([(reader, worker) for worker, reader in \
+                             enumerate(readers)])
+        self.supervisor = supervisor
+        self.hits = hits
+        self.ready = []
+        self.failed = []        # results of chunks of dead workers
+
+    def _recv(self, reader):
+        """
+        (internal) Receives a result from the pipe "reader".
+        """
+        frame = reader.recv_bytes()
+        start = time()
+        unpickler = Unpickler(StringIO(frame))
+        result = unpickler.load()
+        if type(result) is list:
+            # the results of a worker are followed by their header
+            task, timing, seq = unpickler.load()
+            result = (task, result, timing[:6] + (timing[6] + time() - \
+                      start,), seq)
+        elif result is not None and result[1] is not None:
+            # the results from the cache
+            task, results, timing, seq = result
+            result = (task, results, timing[:5] + (len(frame), \
+                      timing[6] + time() - start), seq)
+        return result
+
+    def get(self):
+        """
+        Returns the next result from any **worker**.
+        """
+        while not self.failed:
+            while not self.ready:
+                self.ready = _ready(self.readers + ([self.hits] if \
+                                    self.hits else []))
+            if self.hits in self.ready:
+                # cached results precede the sentinels of the workers
+                result = self._recv(self.hits)
+                if not self.hits.poll():
+                    self.ready.remove(self.hits)
+                return result
+            reader = self.ready.pop()
+            try:
+                result = self._recv(reader)
+            except (EOFError, IOError):
+                if self.supervisor is None:
+                    raise
+                # the worker has died
+                worker = self.workers.pop(reader)
+                self.readers.remove(reader)
+                reader, self.failed = self.supervisor.crashed(worker)
+                if reader is None:
+                    # the worker has been terminated, instead of its sentinel
+                    return None
+                self.workers[reader] = worker
+                self.readers.append(reader)
+                continue
+            if result is None:
+                self.readers.remove(reader)
+            elif self.supervisor is not None and result[1] is not None:
+                self.supervisor.done(result[3])
+            return result
+        return self.failed.pop()
+
+
+class _Supervisor(object):
+    """
+    (internal) Watches over "process" **workers** during a run. Chunks are 
+    kept from their submission until their results are received. A 
+    **worker** writes the sequence number of the chunk it evaluates into its
+    slot of a shared array. If a **worker** dies its chunk is submitted again
+    at most "retries" times, afterwards its elements fail. The sentinels of 
+    the **workers** are held back until all chunks have returned, so that a 
+    resubmitted chunk is evaluated. A **worker** frees the shared memory of
+    its elements after it has sent the results, the memory of a chunk of a
+    dead **worker** is still valid.
+    
+    Arguments:
+    
+      - send (callable) Sends a message to the **worker pool**.
+      - slots (``RawArray``) The sequence numbers of the chunks evaluated by 
+        the **workers** or ``-1``.
+      - respawn (callable) Replaces the n-th **worker** and returns the result
+        pipe of the new **worker** or ``None`` if it is not replaced.
+      - retries (``int``) The number of times a chunk is submitted again.
+      - arena (``_ShmArena``) [default: ``None``] The shared memory of the 
+        elements of failed chunks is freed.
+    
+    """
+    def __init__(self, send, slots, respawn, retries, arena=None):
+        self.send = send
+        self.slots = slots
+        self.respawn = respawn
+        self.retries = retries
+        self.arena = arena
+        self.inflight = {}      # {seq:chunk message}
+        self.tries = {}         # {seq:resubmissions}
+        self.sentinels = 0      # held back sentinels of the workers
+        self.state = tLock()    # the chunks in flight and the sentinels
+        self.lock = tLock()     # pool putter and getter both send
+
+    def _send(self, message):
+        self.lock.acquire()
+        try:
+            self.send(message)
+        finally:
+            self.lock.release()
+
+    def submit(self, message):
+        """
+        Sends a message to the **worker pool** and keeps it if it is a chunk.
+        """
+        self.state.acquire()
+        try:
+            if message is None and self.inflight:
+                self.sentinels += 1
+                return
+            if message is not None and message[1] is not None:
+                self.inflight[message[3]] = message
+        finally:
+            self.state.release()
+        self._send(message)
+
+    def done(self, seq):
+        """
+        Forgets a chunk, which results have been received.
+        """
+        self.state.acquire()
+        try:
+            self.inflight.pop(seq, None)
+            self.tries.pop(seq, None)
+            sentinels = 0
+            if not self.inflight:
+                sentinels, self.sentinels = self.sentinels, 0
+        finally:
+            self.state.release()
+        # the held back sentinels
+        for sentinel in xrange(sentinels):
+            self._send(None)
+
+    def crashed(self, worker):
+        """
+        Replaces a dead **worker** and submits its chunk again. Returns the 
+        result pipe of the new **worker** and a ``list`` of failed results. 
+        The result pipe is ``None`` if the **worker** is not replaced.
+        """
+        self.state.acquire()
+        try:
+            seq = self.slots[worker]
+            self.slots[worker] = -1
+            message = self.inflight.get(seq)
+            if message is not None:
+                tries = self.tries.get(seq, 0) + 1
+                if tries <= self.retries:
+                    self.tries[seq] = tries
+        finally:
+            self.state.release()
+        reader = self.respawn(worker)
+        failed = []
+        if reader is not None and message is not None:
+            if tries <= self.retries:
+                self._send(message)
+            else:
+                self.done(seq)
+                task, chunk, sent, seq = _load_chunk(message[1])
+                if self.arena is not None:
+                    for i, data in chunk:
+                        self.arena.free(data)
+                results = [(i, False, RuntimeError('worker %s died on element'\
+                           ' %s of task %s' % (worker, i, task))) \
+                           for i, data in chunk]
+                failed.append((task, results, (worker, time(), 0., 0., 0., \
+                               0, 0.), seq))
+        return reader, failed
+
+
+def _parse_cpus(text):
+    """
+    (internal) Returns the CPUs of a ``/sys`` CPU list e.g. ``0-3,8``.
+    """
+    cpus = []
+    for part in text.strip().split(','):
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+def _cpu_mask(cpus=()):
+    # a cpu_set_t of 1024 CPUs
+    bits = 8 * sizeof(c_ulong)
+    mask = (c_ulong * (1024 // bits))()
+    for cpu in cpus:
+        mask[cpu // bits] |= 1 << (cpu % bits)
+    return mask
+
+def _get_affinity(pid=0):
+    """
+    (internal) Returns the CPUs a process or thread "pid" may run on, ``0`` 
+    is the calling thread.
+    """
+    mask = _cpu_mask()
+    if _libc.sched_getaffinity(pid, sizeof(mask), mask):
+        errno = get_errno()
+        raise OSError(errno, os.strerror(errno))
+    bits = 8 * sizeof(c_ulong)
+    return [cpu for cpu in xrange(len(mask) * bits) if \
+            mask[cpu // bits] >> (cpu % bits) & 1]
+
+def _set_affinity(pid, cpus):
+    """
+    (internal) Pins a process or thread "pid" to the "cpus", ``0`` is the 
+    calling thread.
+    """
+    mask = _cpu_mask(cpus)
+    if _libc.sched_setaffinity(pid, sizeof(mask), mask):
+        errno = get_errno()
+        log.error('cannot pin %s to cpus %s' % (pid, cpus))
+        raise OSError(errno, os.strerror(errno))
+
+def _pinned(cpus, target):
+    """
+    (internal) Returns "target" or a callable, which pins the calling thread 
+    to the "cpus" before it calls "target".
+    """
+    if not cpus:
+        return target
+    def pinned(*args, **kwargs):
+        _set_affinity(0, cpus)
+        return target(*args, **kwargs)
+    return pinned
+
+
+class _Affinity(object):
+    """
+    (internal) Places "process" **workers** on the CPUs of the NUMA nodes see:
+    *Affinity*. The nodes are read from ``/sys``, without NUMA information 
+    all allowed CPUs form a single node.
+    
+    Arguments:
+    
+      - policy (``str`` or sequence) Either ``'compact'``, ``'spread'``, 
+        ``'reserve'`` or a sequence of CPUs or CPU sets.
+      - root (``str``) [default: ``'/sys/devices/system'``] The ``sysfs`` 
+        directory of the topology.
+    
+    """
+    POLICIES = ('compact', 'spread', 'reserve')
+
+    def __init__(self, policy, root='/sys/devices/system'):
+        if isinstance(policy, basestring):
+            supported = policy in self.POLICIES
+        else:
+            supported = bool(policy)
+        if not supported:
+            log.error('affinity %s is not supported' % policy)
+            raise ValueError('affinity %s is not supported' % policy)
+        self.policy = policy
+        allowed = set(_get_affinity())
+        self.nodes = []
+        node_dir = os.path.join(root, 'node')
+        if os.path.isdir(node_dir):
+            for name in sorted(os.listdir(node_dir)):
+                if not (name.startswith('node') and name[4:].isdigit()):
+                    continue
+                with open(os.path.join(node_dir, name, 'cpulist')) as file:
+                    cpus = [cpu for cpu in _parse_cpus(file.read()) if \
+                            cpu in allowed]
+                if cpus:
+                    self.nodes.append(cpus)
+        if not self.nodes:
+            self.nodes = [sorted(allowed)]
+        # cpus node by node
+        self.compact = [cpu for cpus in self.nodes for cpu in cpus]
+        self.managers = None
+        if policy == 'reserve' and len(self.compact) > 1:
+            self.managers = self.compact[:1]
+            self.compact = self.compact[1:]
+
+    def cpus(self, worker):
+        """
+        Returns the CPUs of the "worker"-th **worker**.
+        """
+        if self.policy in ('compact', 'reserve'):
+            return [self.compact[worker % len(self.compact)]]
+        if self.policy == 'spread':
+            return list(self.nodes[worker % len(self.nodes)])
+        cpus = self.policy[worker % len(self.policy)]
+        return list(cpus) if hasattr(cpus, '__iter__') else [cpus]
 
+    def layout(self, worker_num, hosts=None):
+        """
+        Returns the placement of "worker_num" **workers**, remote **workers** 
+        (with a host in "hosts") are not pinned.
+        """
+        hosts = hosts or [None] * worker_num
+        return {'policy':self.policy,
+                'nodes':[list(cpus) for cpus in self.nodes],
+                'workers':[(self.cpus(worker) if hosts[worker] is None else \
+                            None) for worker in xrange(worker_num)],
+                'managers':self.managers}
+
+
+class _ShmHandle(tuple):
+    """
+    (internal) A ``(slab, slabs, size, raw)`` reference to a payload in a 
+    ``_ShmArena``.
+    """
+    __slots__ = ()
+
+
+class _ShmBlob(str):
+    """
+    (internal) A pickled payload, which was too small for the ``_ShmArena``.
+    """
+    __slots__ = ()
 
-class _PriorityQueue(Queue):
+
+class _ShmArena(object):
     """
-    (internal) a priority queue using a heap on a list. This queue can be used 
-    with "thread", but not "process" ``NuMap`` instances.
+    (internal) A shared memory arena for large payloads of "process" ``NuMap``
+    instances. The arena is an anonymous shared ``mmap``, which is inherited by
+    forked **workers** and is divided into slabs. A payload of at least 
+    "threshold" bytes is copied into a run of consecutive free slabs and only a
+    small ``_ShmHandle`` is send through the pipe. Strings are stored raw and 
+    are copied out of the shared memory, other objects are pickled and 
+    unpickled directly from the shared memory. A consumer never gets a view of
+    the shared memory. Runs are reference counted and reclaimed if the count 
+    drops to zero. If the arena is full the payload is send through the pipe.
+
+    Arguments:
+
+      - size (``int``) size of the arena in bytes
+      - threshold (``int``) minimum size of a payload in bytes
+      - slab (``int``) [default: ``2 ** 16``] size of a slab in bytes
+
     """
-    def _init(self, maxsize):
-        self.maxsize = maxsize
-        self.queue = []
+    def __init__(self, size, threshold, slab=2 ** 16):
+        self.slab = slab
+        self.slabs = max(1, size // slab)
+        self.threshold = threshold
+        self.mmap = mmap(-1, self.slabs * slab)  # MAP_SHARED
+        self.used = RawArray('c', self.slabs)   # one byte per slab
+        self.refs = RawArray('i', self.slabs)   # per-run reference counts
+        self.lock = Lock()
+        self.cursor = 0                         # next-fit (per process)
+
+    def _alloc(self, size):
+        """
+        (internal) Returns a ``(slab, slabs)`` run or ``None`` if full.
+        """
+        slabs = -(-size // self.slab) or 1
+        free = '\0' * slabs
+        self.lock.acquire()
+        try:
+            used = self.used.raw
+            slab = used.find(free, self.cursor)
+            if slab == -1:
+                slab = used.find(free)
+                if slab == -1:
+                    return None
+            self.used[slab:slab + slabs] = '\1' * slabs
+            self.refs[slab] = 1
+            self.cursor = slab + slabs
+        finally:
+            self.lock.release()
+        return (slab, slabs)
+
+    def incref(self, handle):
+        """
+        Increments the reference count of the run of a ``_ShmHandle``.
+        """
+        self.lock.acquire()
+        try:
+            self.refs[handle[0]] += 1
+        finally:
+            self.lock.release()
+
+    def decref(self, handle):
+        """
+        Decrements the reference count of the run of a ``_ShmHandle`` and 
+        reclaims the run if it drops to zero.
+        """
+        slab, slabs = handle[0], handle[1]
+        self.lock.acquire()
+        try:
+            self.refs[slab] -= 1
+            if not self.refs[slab]:
+                self.used[slab:slab + slabs] = '\0' * slabs
+        finally:
+            self.lock.release()
+
+    def free(self, obj):
+        """
+        Reclaims the memory of a payload, which will not be loaded.
+        """
+        if type(obj) is _ShmHandle:
+            self.decref(obj)
+
+    def dumps(self, obj):
+        """
+        Returns a ``_ShmHandle`` for a large payload, a ``_ShmBlob`` for a 
+        small pickled payload or a small string unchanged.
+        """
+        if type(obj) is str:
+            if len(obj) < self.threshold:
+                return obj
+            blob, raw = obj, True
+        else:
+            blob, raw = dumps(obj, HIGHEST_PROTOCOL), False
+            if len(blob) < self.threshold:
+                return _ShmBlob(blob)
+        run = self._alloc(len(blob))
+        if run is None:
+            return obj if raw else _ShmBlob(blob)
+        start = run[0] * self.slab
+        self.mmap[start:start + len(blob)] = blob
+        return _ShmHandle(run + (len(blob), raw))
 
-    def _put(self, item):
-        return heappush(self.queue, item)
+    def loads(self, obj, free=True):
+        """
+        Returns the payload for the result of ``_ShmArena.dumps`` and reclaims
+        its memory if "free" is ``True``. A string is a copy of the shared 
+        memory.
+        """
+        if type(obj) is _ShmHandle:
+            slab, slabs, size, raw = obj
+            start = slab * self.slab
+            if raw:
+                payload = self.mmap[start:start + size]
+            else:
+                payload = load(StringIO(buffer(self.mmap, start, size)))
+            if free:
+                self.decref(obj)
+            return payload
+        elif type(obj) is _ShmBlob:
+            return loads(obj)
+        return obj
 
-    def _get(self):
-        return heappop(self.queue)
+    def close(self):
+        """
+        Unmaps the arena.
+        """
+        self.mmap.close()
 
 
-def _pool_worker(inqueue, outqueue, host=None):
+def _pool_worker(inqueue, outqueue, tasks, host=None, arena=None, worker=0, \
+                 control=None, slots=None, initializer=None, initargs=()):
     """
     (internal) Function which is executed by worker pool processes or threads.
-    It waits for tasks (function, data, arguments) at the input queue "inqueue"
-    evaluates the result and passes it to the output queue "outqueue". It 
-    optionally evaluates the function on a remote host.
+    It waits for chunks of tasks (task id, data) at the input queue "inqueue"
+    evaluates the results and passes them as a single chunk to the output 
+    queue or the own result pipe "outqueue". The callables and their constant arguments are looked up
+    in the "tasks" registry ``{task_id:(func, args, kwargs)}``, which is given 
+    to the worker on start. It optionally evaluates the function on a remote 
+    host. Large elements and results are passed through the shared memory 
+    "arena" if given, they are freed after the results have been sent. A 
+    "process" **worker** gets pickled chunk messages and sends its results 
+    pickled once, each result is pickled separately and only unpickled by 
+    ``NuMap.next``. Each chunk of results carries the number of the "worker" 
+    and its timings: start, time in the input queue, deserialization, 
+    evaluation, size and time of serialization. A **worker** of a persistent 
+    pool waits after the end of a run for the "tasks" registry of the next 
+    run at its "control" pipe or queue, ``None`` ends the **worker**. The 
+    sequence number of the evaluated chunk is written into the "worker"-th of
+    the shared "slots", which allows to resubmit it if the **worker** dies.
+    The "initializer" is called with "initargs" before the first chunk, if it
+    fails the elements of all chunks fail with its exception.
     """
-    put = outqueue.put
     get = inqueue.get
-    if hasattr(inqueue, '_writer'):
-        inqueue._writer.close()
-        outqueue._reader.close()
+    pickled = hasattr(outqueue, 'send')
+    if pickled:
+        # a process with its own result pipe
+        put = outqueue.send
+    else:
+        put = outqueue.put
     if host:
         host_port = host.split(':')
         try:
@@ -961,6 +4344,11 @@ def _pool_worker(inqueue, outqueue, host=None):
             pass
         conn = rpyc.classic.connect(*host_port)
         conn.execute(getsource(imports)) # provide @imports on server
+        # inject all callables once
+        tasks = _inject_tasks(tasks, conn)
+    if control is not None:
+        next_run = control.recv if hasattr(control, 'recv') else control.get
+    failed = _init_worker(initializer, initargs)
 
     while True:
         try:
@@ -969,25 +4357,168 @@ def _pool_worker(inqueue, outqueue, host=None):
             #gc.enable()
         except (EOFError, IOError):
             break
+        started = time()
+        if pickled:
+            # a chunk message is a header followed by the chunk
+            unpickler = Unpickler(StringIO(task))
+            task = unpickler.load()
 
         if task is None:
             put(None)
-            break
+            if control is None:
+                break
+            # the end of a run of a persistent pool
+            tasks = next_run()
+            if tasks is None:
+                break
+            if host:
+                tasks = _inject_tasks(tasks, conn)
+            if hasattr(inqueue, 'finished'):
+                # channels of other workers get elements again
+                inqueue.finished.clear()
+            continue
 
         if task[1] is None:
             put(task)
             continue
 
-        job, func, args, kwargs, (i, data) = task
-        if host:
-            func = func._inject(conn) if hasattr(func, '_inject') else\
-                   _inject_func(func, conn)
-        try:
-            ok, result = (True, func(data, *args, **kwargs))
-        except Exception, excp:
-            ok, result = (False, excp)
+        if pickled:
+            job, sent, seq = task
+            # before the chunk is loaded, the worker might die on it
+            if slots is not None:
+                slots[worker] = seq
+            chunk = unpickler.load()
+        else:
+            job, chunk, sent, seq = task
+        loaded = time()
+        func, args, kwargs = tasks[job]
+        if isinstance(func, _Batched) and failed is None:
+            # a single call evaluates the chunk
+            results = func.evaluate(chunk, args, kwargs, arena)
+        else:
+            results = []
+            for i, data in chunk:
+                try:
+                    if failed is not None:
+                        raise failed
+                    if arena is None:
+                        results.append((i, True, func(data, *args, **kwargs)))
+                    else:
+                        data = arena.loads(data, False)
+                        result = func(data, *args, **kwargs)
+                        results.append((i, True, arena.dumps(result)))
+                except Exception, excp:
+                    results.append((i, False, excp))
+        computed = time()
         #gc.disable(), gc.enable()
-        put((job, i, ok, result))
+        if pickled:
+            if arena is None:
+                # the results are unpickled by the consumer
+                results = [_pickle_result(item) for item in results]
+            # the results are followed by their header, which has the size 
+            # and time of their serialization
+            frame = StringIO()
+            pickler = Pickler(frame, HIGHEST_PROTOCOL)
+            pickler.dump(results)
+            pickler.dump((job, (worker, started, started - sent, loaded - \
+                          started, computed - loaded, frame.tell(), \
+                          time() - computed), seq))
+            outqueue.send_bytes(frame.getvalue())
+        else:
+            put((job, results, (worker, started, started - sent, loaded - \
+                 started, computed - loaded, 0, 0.), seq))
+        if arena is not None:
+            # a chunk is submitted again, if the worker dies before this
+            for i, data in chunk:
+                arena.free(data)
+        if slots is not None:
+            slots[worker] = -1
+
+def _map_slots(fd, worker_num):
+    """
+    (internal) Maps the chunk slots of "worker_num" **workers** from the file
+    "fd" into memory shared by the ``NuMap`` and the template process.
+    """
+    return (c_int * worker_num).from_buffer(mmap(fd, 4 * worker_num))
+
+def _template_main(fd):
+    """
+    (internal) The main loop of a template process, which gets requests from 
+    the ``_Template`` at the UNIX socket "fd". It imports modules, makes the 
+    input queues of the **workers** and forks **workers**, which run
+    ``_pool_worker``. The template process and its **workers** end if the 
+    ``NuMap`` process closes the socket.
+    """
+    conn = Connection(fd)
+    # forked workers are reaped automatically
+    signal(SIGCHLD, SIG_IGN)
+    inqueue, channels, slots, children = None, [], None, []
+    while True:
+        try:
+            request = conn.recv()
+        except (EOFError, IOError):
+            break
+        if request[0] == 'prepare':
+            prepare(request[1])
+        elif request[0] == 'import':
+            for alternatives in request[1]:
+                for module in alternatives.split(','):
+                    try:
+                        __import__(module.strip())
+                        break
+                    except Exception:
+                        pass
+        elif request[0] == 'queues':
+            worker_num = request[1]
+            slots = _map_slots(recvfd(conn.fileno()), worker_num)
+            inqueue = SimpleQueue()
+            channels = [SimpleQueue() for worker in xrange(worker_num)]
+            for queue in [inqueue] + channels:
+                sendfd(conn.fileno(), queue._reader.fileno())
+                sendfd(conn.fileno(), queue._writer.fileno())
+        elif request[0] == 'spawn':
+            worker, host, tasks, dispatch, controlled, initializer, \
+                                                    initargs = request[1:]
+            writer = Connection(recvfd(conn.fileno()))
+            control = Connection(recvfd(conn.fileno())) if controlled else None
+            # held only by the worker, not by programs it runs
+            lifeline = recvfd(conn.fileno())
+            fcntl(lifeline, F_SETFD, fcntl(lifeline, F_GETFD) | FD_CLOEXEC)
+            queue = _StealingQueue([inqueue], 0) if dispatch == 'shared' else \
+                    _StealingQueue(channels, worker)
+            pid = os.fork()
+            if pid == 0:
+                conn.close()
+                signal(SIGCHLD, SIG_DFL)
+                code = 0
+                try:
+                    _pool_worker(queue, writer, tasks, host, None, worker, \
+                                 control, slots, initializer, initargs)
+                except Exception:
+                    code = 1
+                os._exit(code)
+            writer.close()
+            if control is not None:
+                control.close()
+            os.close(lifeline)
+            children = [child for child in children if \
+                        _Forked(child).is_alive()]
+            children.append(pid)
+            conn.send(pid)
+    for child in children:
+        _Forked(child).terminate()
+
+def _inject_tasks(tasks, conn):
+    """
+    (internal) injects the callables of a "tasks" registry into a RPyC 
+    connection object and returns the registry of the injected callables.
+    """
+    injected = {}
+    for job, (func, args, kwargs) in tasks.iteritems():
+        func = func._inject(conn) if hasattr(func, '_inject') else\
+               _inject_func(func, conn)
+        injected[job] = (func, args, kwargs)
+    return injected
 
 def _inject_func(func, conn):
     """
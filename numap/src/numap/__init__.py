@@ -17,4 +17,5 @@ The package is tested on Python 2.6+
 """
 __author__ = 'Marcin Cieslik <mpc4p@virginia.edu>'
 
-from .NuMap import NuMap, imports
+from .NuMap import NuMap, Cache, imports, idempotent, worker_state, \
+                   start_tracer, stop_tracer, dump_trace
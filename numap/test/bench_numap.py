@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+"""
+Benchmarks the throughput and latency of ``NuMap`` and compares them with
+``multiprocessing.Pool.imap`` and ``itertools.imap``. The sweep covers the
+"worker_type", "worker_num", "stride", "buffer", ordered and unordered
+evaluation, the size of the elements, the cost of the function and the depth
+of chained **tasks**. Each configuration is run in a fresh interpreter, so
+that its peak RSS is its own. The results are written as JSON e.g.::
+
+    python bench_numap.py --quick --output bench.json
+    python bench_numap.py --worker_type process --payload 10,1000000
+
+Per configuration the number of elements per second, the median and 99th
+percentile of the latency (from taking an element from the input to
+receiving its result) and the peak RSS of the benchmark process and of its
+largest worker process are reported. The latter is ``None`` for threads or if
+no worker process exceeded the processes started before the run e.g. on 
+import. No network access is needed.
+"""
+
+import os
+import sys
+import json
+import platform
+import resource
+import argparse
+from time import time
+from itertools import imap
+from subprocess import Popen, PIPE
+from multiprocessing import Pool, cpu_count
+
+# need to find numap
+script_path = os.path.dirname(os.path.realpath(__file__))
+root_path = script_path[:-5]
+sys.path.insert(0, root_path + '/src')
+from numap import NuMap
+
+
+def work(inbox, cost=0.):
+    # busy for "cost" seconds, returns the element
+    end = time() + cost
+    while time() < end:
+        pass
+    return inbox
+
+class _Work(object):
+    # Pool.imap and imap pass a single argument, must be picklable
+    def __init__(self, cost):
+        self.cost = cost
+    def __call__(self, inbox):
+        return work(inbox, self.cost)
+
+def source(items, payload, stamps):
+    # elements are indexed and stamped when they are taken from the input
+    data = 'x' * payload
+    for i in xrange(items):
+        stamps.append(time())
+        yield (i, data)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+def measure(results, stamps, items):
+    """
+    Consumes the results and returns the throughput and latencies.
+    """
+    latencies = []
+    start = time()
+    for i, data in results:
+        latencies.append(time() - stamps[i])
+    wall = time() - start
+    assert len(latencies) == items
+    return {'wall':wall,
+            'items_per_s':items / wall,
+            'latency_p50':percentile(latencies, 0.5),
+            'latency_p99':percentile(latencies, 0.99)}
+
+def run_numap(config):
+    stamps = []
+    imap_ = NuMap(worker_type=config['worker_type'],
+                  worker_num=config['worker_num'], stride=config['stride'],
+                  buffer=config['buffer'], ordered=config['ordered'])
+    out = source(config['items'], config['payload'], stamps)
+    for depth in xrange(config['depth']):
+        out = imap_.add_task(work, out, (config['cost'],))
+    imap_.start()
+    result = measure(out, stamps, config['items'])
+    imap_.stop(ends=[config['depth'] - 1])
+    return result
+
+def run_pool(config):
+    stamps = []
+    pool = Pool(config['worker_num'])
+    map_ = pool.imap if config['ordered'] else pool.imap_unordered
+    out = source(config['items'], config['payload'], stamps)
+    for depth in xrange(config['depth']):
+        out = map_(_Work(config['cost']), out)
+    result = measure(out, stamps, config['items'])
+    pool.close()
+    pool.join()
+    return result
+
+def run_serial(config):
+    stamps = []
+    out = source(config['items'], config['payload'], stamps)
+    for depth in xrange(config['depth']):
+        out = imap(_Work(config['cost']), out)
+    return measure(out, stamps, config['items'])
+
+RUNNERS = {'numap':run_numap, 'pool':run_pool, 'serial':run_serial}
+
+def run(config):
+    """
+    Runs a single configuration in this interpreter.
+    """
+    result = dict(config)
+    # the peak of the children is a maximum, it cannot be subtracted
+    baseline = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    result.update(RUNNERS[config['map']](config))
+    # kilobytes on Linux
+    result['rss_self_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    processes = config['map'] == 'pool' or \
+                config.get('worker_type') == 'process'
+    result['rss_children_kb'] = children if processes and \
+                                            children > baseline else None
+    return result
+
+def spawn(config):
+    """
+    Runs a single configuration in a fresh interpreter.
+    """
+    process = Popen([sys.executable, os.path.realpath(__file__), '--run',
+                     json.dumps(config)], stdout=PIPE)
+    output = process.communicate()[0]
+    if process.returncode:
+        result = dict(config)
+        result['error'] = process.returncode
+        return result
+    return json.loads(output)
+
+def configs(options):
+    """
+    Returns the configurations of the sweep, the baselines are not swept over
+    the arguments of ``NuMap``.
+    """
+    for payload in options.payload:
+        for cost in options.cost:
+            for depth in options.depth:
+                common = {'items':options.items, 'payload':payload,
+                          'cost':cost, 'depth':depth}
+                yield dict(common, map='serial')
+                for worker_num in options.worker_num:
+                    for ordered in options.ordered:
+                        yield dict(common, map='pool', worker_num=worker_num,
+                                   ordered=ordered)
+                        for worker_type in options.worker_type:
+                            for stride in options.stride:
+                                for buffer in options.buffer:
+                                    yield dict(common, map='numap',
+                                               worker_type=worker_type,
+                                               worker_num=worker_num,
+                                               stride=stride, buffer=buffer,
+                                               ordered=ordered)
+
+def values(kind):
+    # a comma separated list, 'default' is None
+    def parse(text):
+        return [None if value == 'default' else kind(value) for value in \
+                text.split(',')]
+    return parse
+
+def size(value):
+    return value if value == 'auto' else int(value)
+
+def flag(value):
+    return value.lower() in ('1', 'true', 'yes', 'ordered')
+
+DEFAULTS = {'worker_type':['thread', 'process'], 'ordered':[True, False],
+            'payload':[100, 100000], 'cost':[0., 0.001], 'depth':[1, 3]}
+QUICK = ('ordered', 'payload', 'cost', 'depth')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--run', help='run a single JSON configuration')
+    parser.add_argument('--quick', action='store_true',
+                        help='a short sweep with few elements')
+    parser.add_argument('--items', type=int, default=None)
+    parser.add_argument('--worker_type', type=values(str),
+                        default=DEFAULTS['worker_type'])
+    parser.add_argument('--worker_num', type=values(int), default=[2])
+    parser.add_argument('--stride', type=values(size), default=[None])
+    parser.add_argument('--buffer', type=values(size), default=[None])
+    parser.add_argument('--ordered', type=values(flag), default=None)
+    parser.add_argument('--payload', type=values(int), default=None,
+                        help='bytes per element')
+    parser.add_argument('--cost', type=values(float), default=None,
+                        help='seconds per element and task')
+    parser.add_argument('--depth', type=values(int), default=None,
+                        help='number of chained tasks')
+    parser.add_argument('--output', help='JSON file [default: stdout]')
+    options = parser.parse_args()
+    if options.run:
+        json.dump(run(json.loads(options.run)), sys.stdout)
+        return
+    for name in QUICK:
+        # a quick sweep shortens only the options, which are not given
+        if getattr(options, name) is None:
+            default = DEFAULTS[name]
+            setattr(options, name, default[:1] if options.quick else default)
+    options.items = options.items or (200 if options.quick else 2000)
+    results = []
+    for config in configs(options):
+        result = spawn(config)
+        sys.stderr.write('%s\n' % json.dumps(result, sort_keys=True))
+        results.append(result)
+    report = {'machine':{'python':platform.python_version(),
+                         'platform':platform.platform(),
+                         'cpu_count':cpu_count()},
+              'results':results}
+    if options.output:
+        with open(options.output, 'w') as file:
+            json.dump(report, file, indent=1, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
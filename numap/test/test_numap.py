@@ -4,6 +4,7 @@ tests for ``imap.IMap``.
 """
 
 import os
+import sys
 import unittest
 import numap
 from numap import *
@@ -12,6 +13,13 @@ import time
 from random import randint
 from multiprocessing import TimeoutError
 from itertools import izip
+from threading import Lock, Semaphore, Thread, current_thread
+from Queue import Empty
+from numap.NuMap import _Tuner, _Weave, _Reorder, _Unordered, _Balancer, \
+                        _Backpressure, _Affinity, _get_affinity, HASAIO, \
+                        HASAFF, StopAsyncIteration, _Memo
+if HASAIO:
+    from numap.NuMap import asyncio
 
 #import logging
 #LOG_FILENAME = '/tmp/logging_example.out'
@@ -32,6 +40,122 @@ def waiter(inbox, *args, **kwargs):
     time.sleep(0.1 * 1 / inbox)
     return inbox
 
+class Pickled(object):
+    # counts how often constant arguments are pickled
+    dumps = 0
+    def __getstate__(self):
+        Pickled.dumps += 1
+        return {}
+def checker(inbox, pickled):
+    assert isinstance(pickled, Pickled)
+    return inbox
+def crasher(inbox, marker=None):
+    # kills the worker process (only once if a marker file is given)
+    if inbox < 0 and (marker is None or not os.path.exists(marker)):
+        if marker is not None:
+            open(marker, 'w').close()
+        os.kill(os.getpid(), 9)
+    return inbox
+class Slow(object):
+    # slow to pickle
+    def __reduce__(self):
+        time.sleep(0.02)
+        return (Slow, ())
+def slower(inbox):
+    return Slow()
+class Loaded(object):
+    # unpickled into the name of the unpickling thread
+    def __reduce__(self):
+        return (loaded, ())
+def loaded():
+    return current_thread().name
+def loader(inbox):
+    return Loaded()
+class Bomb(object):
+    # kills a worker process, which unpickles it, once
+    def __init__(self, marker):
+        self.marker = marker
+        self.pid = os.getpid()
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if os.getpid() != self.pid and not os.path.exists(self.marker):
+            open(self.marker, 'w').close()
+            os.kill(os.getpid(), 9)
+def breaker(inbox, marker):
+    # kills the worker process once on a string starting with '-'
+    if inbox.startswith('-') and not os.path.exists(marker):
+        open(marker, 'w').close()
+        os.kill(os.getpid(), 9)
+    return inbox
+@imports(['colorsys'])
+def parent(inbox):
+    # the process, which has forked the worker
+    return (inbox, os.getppid(), colorsys.__name__)
+def initializer(offset):
+    # prepares the state of a worker once
+    state = worker_state()
+    state['offset'] = offset
+    state['calls'] = state.get('calls', 0) + 1
+def broken_initializer():
+    raise ValueError('initializer')
+def stateful(inbox):
+    state = worker_state()
+    return (inbox + state['offset'], state['calls'])
+def batcher(inboxes, offset=0):
+    # evaluates a batch of elements
+    if -1 in inboxes:
+        return inboxes[1:]
+    if -2 in inboxes:
+        raise ValueError(inboxes)
+    return [(inbox + offset, len(inboxes)) for inbox in inboxes]
+def spinner(inbox):
+    # busy for inbox seconds
+    end = time.time() + inbox
+    while time.time() < end:
+        pass
+    return inbox
+def spinners(inboxes):
+    return [spinner(inbox) for inbox in inboxes]
+def threaded(inbox):
+    # the thread, which evaluates the element
+    return current_thread().name
+def pinned(inbox):
+    # the cpus of the worker
+    return _get_affinity()
+def blower(inbox):
+    # a large result
+    return str(inbox) * 100000
+def lagger(inbox, marker):
+    # only the first evaluation of the last element is slow
+    if inbox == 9 and not os.path.exists(marker):
+        open(marker, 'w').close()
+        time.sleep(2)
+    time.sleep(0.01)
+    return inbox
+@idempotent
+def straggler(inbox, marker):
+    return lagger(inbox, marker)
+@idempotent
+def string_straggler(inbox, marker):
+    # only the first evaluation of a string starting with '-' is slow
+    lagger(9 if inbox.startswith('-') else 0, marker)
+    return inbox
+waiting = {'now':0, 'most':0}
+def async_waiter(inbox):
+    # returns a future, which is completed by the event loop
+    loop = asyncio.get_event_loop()
+    future = asyncio.Future(loop=loop)
+    if inbox < 0:
+        loop.call_later(0.1, future.set_exception, ValueError(inbox))
+    else:
+        loop.call_later(0.1, future.set_result, inbox)
+    # counts the concurrently pending futures
+    waiting['now'] += 1
+    waiting['most'] = max(waiting['most'], waiting['now'])
+    future.add_done_callback(lambda future: 
+                             waiting.__setitem__('now', waiting['now'] - 1))
+    return future
+
 class Test_numap(unittest.TestCase):
 
     heavy_repeats = 10
@@ -450,6 +574,884 @@ class Test_numap(unittest.TestCase):
 
 
 
+    def test_chunksize(self):
+        for wt in ('process', 'thread'):
+            for st in (1, 2, 5):
+                for cs in (1, 2, 3, 'auto'):
+                    inp = range(1, 20)
+                    imap = NuMap(worker_type=wt, stride=st, worker_num=2, \
+                                 chunksize=cs)
+                    out = imap.add_task(adder, inp)
+                    imap.add_task(miner, out, chunksize=st)
+                    imap.start()
+                    self.assertEqual(list(imap.get_task(1)), inp)
+                    imap.stop(ends=[1])
+                    self.assertRaises(RuntimeError, imap.next)
+                    imap = NuMap(worker_type=wt, stride=st, chunksize=cs)
+                    imap.add_task(diver, [1, 0, 2])
+                    imap.start()
+                    self.assertEqual(imap.next(), 1)
+                    self.assertRaises(ZeroDivisionError, imap.next)
+                    self.assertEqual(imap.next(), 0)
+                    self.assertRaises(StopIteration, imap.next)
+                    imap.stop(ends=[0])
+
+    def test_registry(self):
+        for wt in ('process', 'thread'):
+            Pickled.dumps = 0
+            inp = range(100)
+            imap = NuMap(checker, inp, (Pickled(),), worker_type=wt, \
+                         worker_num=2)
+            self.assertEqual(list(imap), inp)
+            # at most once per worker not once per element
+            assert Pickled.dumps <= 2
+            imap.stop(ends=[0])
+
+    def test_shm(self):
+        self.assertRaises(ValueError, NuMap, transport='shm', \
+                          worker_type='thread')
+        for cs in (1, 3):
+            inp = ['a' * 10, 'b' * 100000, range(50000), 'c' * 300000, 1]
+            imap = NuMap(passer, inp, transport='shm', shm_size=2 ** 20, \
+                         shm_threshold=2 ** 12, chunksize=cs, worker_num=2)
+            self.assertEqual(list(imap), inp)
+            arena = imap._arena
+            imap.stop(ends=[0])
+            assert imap._arena is None
+            # all elements and results returned by next are reclaimed, the
+            # workers free the elements after their results are sent
+            self.assertEqual(arena.used.raw.count('\1'), 0)
+
+    def test_dispatch(self):
+        self.assertRaises(ValueError, NuMap, dispatch='depth', \
+                          worker_type='thread')
+        for dp in ('round_robin', 'depth'):
+            for cs in (1, 2):
+                inp = range(1, 50)
+                imap = NuMap(worker_num=3, stride=4, dispatch=dp, chunksize=cs)
+                out = imap.add_task(adder, inp)
+                imap.add_task(miner, out)
+                imap.start()
+                self.assertEqual(list(imap.get_task(1)), inp)
+                imap.stop(ends=[1])
+        # without select and fcntl the shared queue is used
+        module = sys.modules[NuMap.__module__]
+        module.HASCH = False
+        try:
+            imap = NuMap(worker_num=3, stride=4, dispatch='depth')
+            self.assertEqual(imap.dispatch, 'shared')
+            out = imap.add_task(adder, range(20))
+            imap.start()
+            self.assertEqual(list(out), range(1, 21))
+            imap.stop(ends=[0])
+        finally:
+            module.HASCH = True
+        # the second worker steals the slow elements from the first
+        wait = [0.3, 0.0, 0.3, 0.0, 0.3, 0.0, 0.3, 0.0]
+        imap = NuMap(real_waiter, wait, worker_num=2, stride=8, \
+                     dispatch='round_robin')
+        self.assertEqual(list(imap), wait)
+        imap.stop(ends=[0])
+        # round-robin alone gives all slow elements to the first worker
+        workers = imap.stats()['workers']
+        self.assertTrue(min([w['compute_time'] for w in workers]) >= 0.3)
+
+    def test_result_pipes(self):
+        for ordered in (True, False):
+            inp = range(1, 40)
+            imap = NuMap(worker_num=4, stride=8, ordered=ordered)
+            imap.add_task(lambda i: str(i) * 10000, inp)
+            imap.start()
+            # one result pipe per worker
+            self.assertEqual(len(imap._getout.__self__.readers), 4)
+            self.assertEqual(sorted(imap), sorted([str(i) * 10000 for i in inp]))
+            imap.stop(ends=[0])
+
+    def test_auto(self):
+        for wt in ('thread', 'process'):
+            for stride, buffer in (('auto', None), (None, 'auto'), \
+                                   ('auto', 'auto')):
+                inp = range(200)
+                imap = NuMap(worker_type=wt, worker_num=2, stride=stride, \
+                             buffer=buffer, buffer_max=32)
+                out1 = imap.add_task(adder, inp)
+                out2 = imap.add_task(miner, out1)
+                imap.start()
+                self.assertEqual(list(out2), inp)
+                tuner = imap._tuner
+                self.assertTrue(1 <= tuner.weave.rotation_repeats <= 32)
+                self.assertTrue(tuner.value <= \
+                                max(32 if buffer else 2 * imap.stride, 4))
+                imap.stop(ends=[1])
+        # the semaphore is resized within its bounds
+        semaphore = Semaphore(4)
+        tuner = _Tuner(_Weave([None, None], 2), semaphore, 4, 2, (1, 4), \
+                       (4, 8))
+        tuner.resize(100)
+        self.assertEqual(tuner.value, 8)
+        self.assertEqual(semaphore._Semaphore__value, 8)
+        for i in range(8):
+            semaphore.acquire()
+        tuner.resize(0)
+        self.assertEqual((tuner.value, tuner.debt), (4, 4))
+        for i in range(8):
+            semaphore.release()
+        tuner.resize(tuner.value)
+        self.assertEqual((tuner.debt, semaphore._Semaphore__value), (0, 4))
+
+    def test_weights(self):
+        # deficit round-robin
+        weave = _Weave([iter('a' * 20), iter('b' * 20)], 1, [2, 3])
+        self.assertEqual(weave.rotation_size(), 3)
+        self.assertEqual(''.join(weave.next() for i in range(10)), 
+                         'ababbababb')
+        self.assertEqual(_Weave([None, None], 3).rotation_size(), 6)
+        for wt in ('thread', 'process'):
+            imap = NuMap(worker_type=wt, worker_num=2, stride=2)
+            out1 = imap.add_task(adder, range(40), weight=3)
+            out2 = imap.add_task(miner, out1)
+            out3 = imap.add_task(passer, range(10))
+            imap.start()
+            self.assertEqual(imap._semaphore_value, 14)
+            result = []
+            consumer = Thread(target=result.extend, args=(out3,))
+            consumer.start()
+            self.assertEqual(list(out2), range(40))
+            consumer.join()
+            self.assertEqual(result, range(10))
+            imap.stop(ends=[1, 2])
+            self.assertEqual([task['weight'] for task in imap.stats()['tasks']],
+                             [3., 3., 1.])
+        # a task has the weight of the task it consumes
+        imap = NuMap()
+        out1 = imap.add_task(adder, range(4), weight=2)
+        self.assertRaises(ValueError, imap.add_task, miner, out1, weight=1)
+        self.assertRaises(ValueError, imap.add_task, passer, [], weight=0)
+        # weights from compute times of chains
+        counters = [{'completed':10, 'failed':0, 'compute_time':1., 
+                     'weight':1.} for i in range(3)]
+        counters[1]['compute_time'] = 0.25
+        counters[2]['compute_time'] = 0.25
+        weave = _Weave([None, None, None], 2)
+        _Balancer(weave, counters, [None, None, None], 100).rotate()
+        self.assertEqual(weave.weights, [1., 4., 4.])
+        _Balancer(weave, counters, [None, None, 1], 100).rotate()
+        self.assertEqual(weave.weights, [1., 2., 2.])
+        # a rotation fits into the semaphore
+        _Balancer(weave, counters, [None, None, None], 12).rotate()
+        self.assertEqual(weave.weights, [1., 1.75, 1.75])
+        self.assertTrue(weave.rotation_size() <= 12)
+        for wt in ('thread', 'process'):
+            imap = NuMap(worker_type=wt, worker_num=2, stride=2, balance=True)
+            out1 = imap.add_task(real_waiter, [0.01] * 20)
+            out2 = imap.add_task(passer, range(200))
+            imap.start()
+            result = []
+            consumer = Thread(target=result.extend, args=(out1,))
+            consumer.start()
+            self.assertEqual(list(out2), range(200))
+            consumer.join()
+            self.assertEqual(result, [0.01] * 20)
+            imap.stop(ends=[0, 1])
+            weights = [task['weight'] for task in imap.stats()['tasks']]
+            self.assertEqual(weights[0], 1.)
+            self.assertTrue(weights[1] > 1.)
+
+    def test_backpressure(self):
+        # downstream tasks with available input first
+        tasks = _Backpressure([iter('a' * 10), iter('b' * 10)], 2, [None, 0])
+        self.assertEqual([tasks.next() for i in range(2)], ['a', 'a'])
+        tasks.arrive(0, 2)
+        tasks.release(0)
+        self.assertEqual([tasks.next() for i in range(3)], ['b', 'b', 'a'])
+        self.assertEqual((tasks.taken, tasks.held(0), tasks.held(1)), 
+                         ([3, 2], 2, 2))
+        tasks.stop()
+        self.assertRaises(StopIteration, tasks.next)
+        self.assertEqual((tasks.i, tasks.finished), (0, [True, False]))
+        # a full task blocks until an element is released
+        tasks = _Backpressure([iter('a' * 10)], 1, [None])
+        self.assertEqual(tasks.next(), 'a')
+        taken = []
+        putter = Thread(target=lambda: taken.append(tasks.next()))
+        putter.start()
+        putter.join(0.1)
+        self.assertEqual(taken, [])
+        tasks.release(0)
+        putter.join()
+        self.assertEqual((taken, tasks.held(0)), (['a'], 1))
+        for wt in ('thread', 'process'):
+            imap = NuMap(worker_type=wt, worker_num=2, stride=3, 
+                         schedule='backpressure')
+            out1 = imap.add_task(adder, range(100))
+            out2 = imap.add_task(miner, out1)
+            out3 = imap.add_task(passer, range(50))
+            imap.start()
+            result = []
+            consumer = Thread(target=result.extend, args=(out3,))
+            consumer.start()
+            self.assertEqual(list(out2), range(100))
+            consumer.join()
+            self.assertEqual(result, range(50))
+            imap.stop(ends=[1, 2])
+            # stopping drains the downstream tasks
+            imap = NuMap(worker_type=wt, worker_num=2, stride=3, 
+                         schedule='backpressure')
+            out1 = imap.add_task(adder, xrange(10000))
+            out2 = imap.add_task(miner, out1)
+            imap.start()
+            self.assertEqual([out2.next() for i in range(3)], [0, 1, 2])
+            imap.stop(ends=[1])
+            self.assertRaises(RuntimeError, imap.next)
+        self.assertRaises(ValueError, NuMap, schedule='backpressure', 
+                          balance=True)
+
+    def test_stats(self):
+        for wt in ('thread', 'process'):
+            self.assertEqual(NuMap(worker_type=wt).stats(), \
+                             {'tasks':[], 'workers':[]})
+            inp = [1, 'a', 3] * 10
+            imap = NuMap(worker_type=wt, worker_num=2, stride=4, chunksize=2)
+            out1 = imap.add_task(adder, inp)
+            out2 = imap.add_task(passer, range(30))
+            imap.start()
+            for i in range(30):
+                try:
+                    out1.next()
+                except TypeError:
+                    pass
+                out2.next()
+            imap.stop(ends=[0, 1])
+            stats = imap.stats()
+            self.assertEqual(len(stats['tasks']), 2)
+            self.assertEqual(len(stats['workers']), 2)
+            task1, task2 = stats['tasks']
+            self.assertEqual((task1['submitted'], task1['completed'], \
+                              task1['failed']), (30, 20, 10))
+            self.assertEqual((task2['submitted'], task2['completed'], \
+                              task2['failed']), (30, 30, 0))
+            self.assertEqual(task1['reorder_depth'], 0)
+            self.assertTrue(task1['reorder_max'] <= 4)
+            self.assertEqual(sum([w['completed'] for w in stats['workers']]), \
+                             50)
+            self.assertTrue(sum([w['chunks'] for w in stats['workers']]) >= 30)
+            if wt == 'process':
+                self.assertTrue(task2['input_bytes'] > 0)
+                self.assertTrue(task2['output_bytes'] > 0)
+            else:
+                self.assertEqual(task2['output_bytes'], 0)
+        # the serialization of results by the workers is measured
+        imap = NuMap(slower, range(5), worker_num=2)
+        list(imap)
+        imap.stop(ends=[0])
+        self.assertTrue(imap.stats()['tasks'][0]['output_time'] >= 0.1)
+        # the results are unpickled by the consumer, not by the pool getter
+        imap = NuMap(loader, range(5), worker_num=2)
+        self.assertEqual(list(imap), [current_thread().name] * 5)
+        imap.stop(ends=[0])
+        self.assertTrue(imap.stats()['tasks'][0]['result_time'] > 0)
+
+    def test_trace(self):
+        from cStringIO import StringIO
+        from numap.NuMap import _tracer
+        for wt in ('thread', 'process'):
+            start_tracer(size=1000)
+            imap = NuMap(worker_type=wt, worker_num=2, chunksize=2)
+            out = imap.add_task(adder, range(10))
+            imap.start()
+            self.assertEqual(list(out), range(1, 11))
+            imap.stop(ends=[0])
+            stop_tracer()
+            dump = StringIO()
+            events = dump_trace(dump)
+            self.assertEqual(len(dump.getvalue().splitlines()), len(events))
+            kinds = [event[1] for event in events]
+            for kind in ('submit', 'start', 'finish', 'release', 'stop'):
+                self.assertTrue(kind in kinds)
+            self.assertEqual(kinds.count('release'), 10)
+            self.assertEqual(sum([event[5] for event in events if \
+                                  event[1] == 'submit']), 10)
+            self.assertEqual(events, sorted(events))
+        # the ring buffer keeps the last events
+        start_tracer(size=5)
+        imap = NuMap(worker_type='thread')
+        out = imap.add_task(adder, range(10))
+        imap.start()
+        list(out)
+        imap.stop(ends=[0])
+        stop_tracer()
+        self.assertEqual(len(dump_trace()), 5)
+        self.assertFalse(_tracer.on)
+
+    @unittest.skipUnless(HASAIO, 'requires asyncio or trollius')
+    def test_asyncio(self):
+        # concurrent evaluation on a single event loop
+        inp = range(100)
+        imap = NuMap(worker_type='asyncio', worker_num=100, stride=100)
+        out = imap.add_task(async_waiter, inp)
+        out2 = imap.add_task(adder, out)
+        waiting['most'] = 0
+        imap.start()
+        self.assertEqual(list(out2), [i + 1 for i in inp])
+        self.assertTrue(waiting['most'] > 1)
+        imap.stop(ends=[1])
+        self.assertEqual(len(imap.stats()['workers']), 1)
+        imap = NuMap(async_waiter, [1, -1, 2], worker_type='asyncio')
+        self.assertEqual(imap.next(), 1)
+        self.assertRaises(ValueError, imap.next)
+        self.assertEqual(imap.next(), 2)
+        imap.stop(ends=[0])
+        # results are awaited without blocking the event loop
+        for wt in ('inline', 'thread', 'process', 'asyncio'):
+            for ordered in (True, False):
+                loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(loop)
+                imap = NuMap(worker_type=wt, worker_num=2, ordered=ordered)
+                out = imap.add_task(adder, [0, 'a', 2, 3])
+                imap.start()
+                results = []
+                def receive():
+                    out.anext().add_done_callback(received)
+                def received(future):
+                    try:
+                        results.append(future.result())
+                    except StopAsyncIteration:
+                        loop.stop()
+                        return
+                    except TypeError:
+                        results.append(None)
+                    receive()
+                loop.call_soon(receive)
+                loop.run_forever()
+                loop.close()
+                asyncio.set_event_loop(None)
+                self.assertEqual(sorted(results), [None, 1, 3, 4])
+                imap.stop(ends=[0])
+        # inline evaluation does not stall the event loop
+        loop = asyncio.new_event_loop()
+        imap = NuMap(real_waiter, [0.1, 0.1], worker_type='inline')
+        imap.start()
+        ticks = []
+        def tick():
+            ticks.append(None)
+            loop.call_later(0.01, tick)
+        def received(future):
+            if future.exception() is None:
+                imap.anext(loop=loop).add_done_callback(received)
+            else:
+                loop.stop()
+        loop.call_soon(tick)
+        imap.anext(loop=loop).add_done_callback(received)
+        loop.run_forever()
+        loop.close()
+        self.assertTrue(len(ticks) > 5)
+        imap.stop(ends=[0])
+
+    def test_persistent(self):
+        configs = [('thread', 'shared'), ('process', 'shared'), \
+                   ('process', 'round_robin')]
+        if HASAIO:
+            configs.append(('asyncio', 'shared'))
+        for wt, dispatch in configs:
+            imap = NuMap(worker_type=wt, worker_num=2, dispatch=dispatch, \
+                         persistent=True)
+            out = imap.add_task(adder, range(10))
+            imap.start()
+            self.assertEqual(list(out), range(1, 11))
+            pool = imap.pool
+            imap.stop(ends=[0])
+            # the workers wait for the next run
+            self.assertTrue(all([worker.is_alive() for worker in pool]))
+            out1 = imap.add_task(miner, range(10))
+            out2 = imap.add_task(adder, out1)
+            imap.start()
+            self.assertTrue(imap.pool is pool)
+            self.assertRaises(RuntimeError, imap.shutdown)
+            self.assertEqual(list(out2), range(10))
+            imap.stop(ends=[1])
+            imap.shutdown()
+            self.assertFalse(any([worker.is_alive() for worker in pool]))
+            # a new pool
+            out = imap.add_task(passer, range(10))
+            imap.start()
+            self.assertFalse(imap.pool is pool)
+            self.assertEqual(list(out), range(10))
+            imap.stop(ends=[0])
+            imap.shutdown()
+
+    def test_crash(self):
+        import tempfile
+        for dispatch in ('shared', 'round_robin'):
+            # the chunk of the dead worker is resubmitted
+            marker = tempfile.mktemp()
+            inp = [1, 2, 3, -4, 5, 6, 7, 8]
+            imap = NuMap(worker_num=2, chunksize=2, dispatch=dispatch)
+            out = imap.add_task(crasher, inp, (marker,))
+            imap.start()
+            self.assertEqual(list(out), inp)
+            imap.stop(ends=[0])
+            self.assertTrue(os.path.exists(marker))
+            os.unlink(marker)
+            # the workers end after the resubmitted chunk of the last element
+            imap = NuMap(crasher, [1, 2, 3, -1], (marker,), worker_num=2, 
+                         dispatch=dispatch)
+            self.assertEqual(list(imap), [1, 2, 3, -1])
+            imap.stop(ends=[0])
+            os.unlink(marker)
+            # the worker dies while it unpickles the chunk
+            imap = NuMap(bool, [1, 2, Bomb(marker), 4], worker_num=2, 
+                         dispatch=dispatch)
+            self.assertEqual(list(imap), [True] * 4)
+            imap.stop(ends=[0])
+            self.assertTrue(os.path.exists(marker))
+            os.unlink(marker)
+            # the shared memory of a resubmitted chunk is valid
+            inp = [('-' if i == 5 else '%s' % i) * 200000 for i in range(40)]
+            imap = NuMap(worker_num=3, stride=3, buffer=12, transport='shm',
+                         dispatch=dispatch)
+            out = imap.add_task(breaker, inp, (marker,))
+            imap.start()
+            self.assertTrue(list(out) == inp)
+            imap.stop(ends=[0])
+            os.unlink(marker)
+            # after all retries the elements fail
+            imap = NuMap(worker_num=2, dispatch=dispatch, retries=2)
+            out = imap.add_task(crasher, [1, -2, 3])
+            imap.start()
+            self.assertEqual(out.next(), 1)
+            self.assertRaises(RuntimeError, out.next)
+            self.assertEqual(out.next(), 3)
+            imap.stop(ends=[0])
+        # a persistent pool replaces workers, which died between runs
+        imap = NuMap(worker_num=2, persistent=True)
+        out = imap.add_task(passer, range(4))
+        imap.start()
+        list(out)
+        imap.stop(ends=[0])
+        dead = imap.pool[0]
+        os.kill(dead.pid, 9)
+        dead.join()
+        out = imap.add_task(adder, range(4))
+        imap.start()
+        self.assertFalse(imap.pool[0] is dead)
+        self.assertEqual(list(out), range(1, 5))
+        imap.stop(ends=[0])
+        imap.shutdown()
+
+    def test_template(self):
+        import tempfile
+        for dispatch in ('shared', 'depth'):
+            imap = NuMap(worker_num=2, dispatch=dispatch, 
+                         start_method='template')
+            out = imap.add_task(parent, range(10))
+            imap.start()
+            template = imap._template.pid
+            self.assertEqual(list(out), 
+                             [(i, template, 'colorsys') for i in range(10)])
+            imap.stop(ends=[0])
+            # dead workers are forked again
+            marker = tempfile.mktemp()
+            inp = [1, 2, 3, -4, 5, 6, 7, 8]
+            out = imap.add_task(crasher, inp, (marker,))
+            imap.start()
+            self.assertEqual(list(out), inp)
+            imap.stop(ends=[0])
+            os.unlink(marker)
+        # a persistent pool
+        imap = NuMap(worker_num=2, persistent=True, start_method='template')
+        for run in range(2):
+            out = imap.add_task(adder, range(10))
+            imap.start()
+            self.assertEqual(list(out), range(1, 11))
+            imap.stop(ends=[0])
+        pool = imap.pool
+        template = imap._template.process
+        imap.shutdown()
+        for worker in pool:
+            worker.join(1)
+        self.assertFalse(any([worker.is_alive() for worker in pool]))
+        # the template process ends with the pool
+        self.assertFalse(template.poll() is None)
+        self.assertRaises(ValueError, NuMap, worker_type='thread', 
+                          start_method='template')
+        self.assertRaises(ValueError, NuMap, start_method='spawn')
+
+    def test_initializer(self):
+        configs = [('thread', None), ('process', None), 
+                   ('process', 'template')]
+        if HASAIO:
+            configs.append(('asyncio', None))
+        for wt, start_method in configs:
+            imap = NuMap(worker_type=wt, worker_num=2, persistent=True, 
+                         start_method=start_method, initializer=initializer,
+                         initargs=(10,))
+            # the state persists between runs
+            for run in range(2):
+                out = imap.add_task(stateful, range(10))
+                imap.start()
+                self.assertEqual(list(out), [(i + 10, 1) for i in range(10)])
+                imap.stop(ends=[0])
+            imap.shutdown()
+            # elements fail if the initializer fails
+            imap = NuMap(worker_type=wt, worker_num=2, 
+                         initializer=broken_initializer)
+            out = imap.add_task(stateful, range(2))
+            imap.start()
+            self.assertRaises(ValueError, out.next)
+            self.assertRaises(ValueError, out.next)
+            self.assertRaises(StopIteration, out.next)
+            imap.stop(ends=[0])
+        self.assertTrue(worker_state() is worker_state())
+
+    def test_cache(self):
+        import tempfile
+        path = tempfile.mkdtemp()
+        for wt in ('thread', 'process'):
+            cache = Cache(size=10)
+            for run in range(2):
+                imap = NuMap(worker_type=wt, worker_num=2)
+                out = imap.add_task(adder, range(10), cache=cache)
+                imap.start()
+                # hits keep their order
+                self.assertEqual(list(out), range(1, 11))
+                imap.stop(ends=[0])
+                stats = imap.stats()['tasks'][0]
+                self.assertEqual(stats['completed'], 10)
+                self.assertEqual(stats['cached'], run * 10)
+                self.assertEqual(stats['submitted'], 10 - run * 10)
+            # exceptions are not cached
+            imap = NuMap(worker_type=wt, worker_num=2)
+            out = imap.add_task(diver, [0, 1, 0], cache=True)
+            imap.start()
+            self.assertRaises(ZeroDivisionError, out.next)
+            self.assertEqual(out.next(), 1)
+            self.assertRaises(ZeroDivisionError, out.next)
+            imap.stop(ends=[0])
+            # the on-disk tier survives the cache
+            cache = Cache(size=1, path=path)
+            imap = NuMap(worker_type=wt, worker_num=2)
+            out = imap.add_task(miner, range(5), cache=cache)
+            imap.start()
+            self.assertEqual(list(out), range(-1, 4))
+            imap.stop(ends=[0])
+            imap = NuMap(worker_type=wt, worker_num=2)
+            out = imap.add_task(miner, range(5), cache=Cache(size=1, path=path))
+            imap.start()
+            self.assertEqual(list(out), range(-1, 4))
+            imap.stop(ends=[0])
+            self.assertEqual(imap.stats()['tasks'][0]['cached'], 5)
+        # a changed body invalidates the results
+        bodies = []
+        for body in ('inbox + 1', 'inbox + 2', 'inbox + 1'):
+            namespace = {}
+            exec 'def changed(inbox):\n    return %s' % body in namespace
+            bodies.append(_Memo(cache, namespace['changed'], (), {}).key(1))
+        self.assertEqual(bodies[0], bodies[2])
+        self.assertNotEqual(bodies[0], bodies[1])
+        # elements, which cannot be pickled are evaluated but not cached
+        lock = Lock()
+        for wt in ('thread', 'inline'):
+            imap = NuMap(worker_type=wt)
+            out = imap.add_task(passer, [lock, 1, lock], cache=True)
+            imap.start()
+            self.assertEqual(list(out), [lock, 1, lock])
+            imap.stop(ends=[0])
+            self.assertEqual(imap.stats()['tasks'][0]['submitted'], 3)
+        self.assertRaises(ValueError, NuMap(transport='shm').add_task, adder,
+                          range(2), cache=True)
+
+    def test_hedge(self):
+        import tempfile
+        for wt in ('thread', 'process'):
+            marker = tempfile.mktemp()
+            imap = NuMap(worker_type=wt, worker_num=2)
+            out = imap.add_task(straggler, range(10), (marker,))
+            imap.start()
+            self.assertEqual(list(out), range(10))
+            imap.stop(ends=[0])
+            self.assertEqual(imap.stats()['tasks'][0]['hedged'], 1)
+            os.unlink(marker)
+        # duplicates read valid shared memory
+        marker = tempfile.mktemp()
+        inp = [('-' if i == 5 else '%s' % i) * 200000 for i in range(40)]
+        imap = NuMap(worker_num=3, stride=3, buffer=12, transport='shm', 
+                     persistent=True)
+        out = imap.add_task(string_straggler, inp, (marker,))
+        imap.start()
+        self.assertTrue(list(out) == inp)
+        imap.stop(ends=[0])
+        self.assertEqual(imap.stats()['tasks'][0]['hedged'], 1)
+        # each copy has freed its references
+        self.assertEqual(min(imap._arena.refs), 0)
+        self.assertEqual(imap._arena.used.raw.count('\1'), 0)
+        imap.shutdown()
+        os.unlink(marker)
+        # only idempotent tasks are duplicated
+        marker = tempfile.mktemp()
+        imap = NuMap(worker_type='thread', worker_num=2)
+        out = imap.add_task(lagger, range(10), (marker,))
+        imap.start()
+        self.assertEqual(list(out), range(10))
+        imap.stop(ends=[0])
+        self.assertEqual(imap.stats()['tasks'][0]['hedged'], 0)
+        os.unlink(marker)
+
+    def test_buffer_bytes(self):
+        imap = NuMap(worker_num=2, buffer_bytes=500000)
+        out = imap.add_task(blower, range(50))
+        imap.start()
+        for i in range(50):
+            time.sleep(0.002)
+            self.assertEqual(out.next(), str(i) * 100000)
+        self.assertRaises(StopIteration, out.next)
+        imap.stop(ends=[0])
+        # the budget bounds the results, which are held
+        self.assertTrue(imap._budget.peak < 1000000)
+        self.assertEqual(imap._budget.bytes, 0)
+        # elements larger than the budget do not dead-lock
+        imap = NuMap(worker_num=2, buffer_bytes=10)
+        out = imap.add_task(blower, range(5))
+        imap.start()
+        self.assertEqual(list(out), [str(i) * 100000 for i in range(5)])
+        imap.stop(ends=[0])
+        self.assertRaises(ValueError, NuMap, worker_type='thread', 
+                          buffer_bytes=10)
+        self.assertRaises(ValueError, NuMap, buffer='auto', buffer_bytes=10)
+
+    def test_batch(self):
+        for wt in ('thread', 'process'):
+            imap = NuMap(worker_type=wt, worker_num=2, stride=4, buffer=8)
+            out = imap.add_task(batcher, range(8), (10,), batch=4)
+            imap.start()
+            self.assertEqual(list(out), [(i + 10, 4) for i in range(8)])
+            imap.stop(ends=[0])
+            # the stride is raised to the batch
+            imap = NuMap(worker_type=wt, worker_num=2, stride=2, buffer=4)
+            out = imap.add_task(batcher, range(4), batch=4)
+            imap.start()
+            self.assertEqual(list(out), [(i, 4) for i in range(4)])
+            imap.stop(ends=[0])
+            self.assertRaises(ValueError, imap.add_task, batcher, range(4), 
+                              batch=5)
+            # batches are not split while the results are retrieved
+            for ordered in (True, False):
+                imap = NuMap(worker_type=wt, worker_num=4, ordered=ordered)
+                out = imap.add_task(batcher, range(4000), batch=1000)
+                imap.start()
+                results = list(out)
+                imap.stop(ends=[0])
+                self.assertEqual(sorted(results), 
+                                 [(i, 1000) for i in range(4000)])
+            # all elements of a failed batch fail
+            imap = NuMap(worker_type=wt, worker_num=2, stride=2, buffer=6)
+            out = imap.add_task(batcher, [0, 1, 2, 3, -1], batch=2)
+            imap.start()
+            self.assertEqual(out.next(), (0, 2))
+            self.assertEqual(out.next(), (1, 2))
+            self.assertEqual(out.next(), (2, 2))
+            self.assertEqual(out.next(), (3, 2))
+            self.assertRaises(ValueError, out.next)
+            imap.stop(ends=[0])
+            imap = NuMap(worker_type=wt, worker_num=2, stride=2, buffer=4)
+            out = imap.add_task(batcher, [-2, 0, 1], batch=2)
+            imap.start()
+            self.assertRaises(ValueError, out.next)
+            self.assertRaises(ValueError, out.next)
+            self.assertEqual(out.next(), (1, 1))
+            imap.stop(ends=[0])
+
+    @unittest.skipIf(not HASAFF, 'requires sched_setaffinity')
+    def test_affinity(self):
+        import tempfile
+        allowed = _get_affinity()
+        # a fake topology of two nodes
+        root = tempfile.mkdtemp()
+        for node, cpus in (('node0', '0-1'), ('node1', '2,3'), 
+                           ('online', '0-3')):
+            path = os.path.join(root, 'node', node)
+            if node == 'online':
+                open(path, 'w').write(cpus)
+                continue
+            os.makedirs(path)
+            open(os.path.join(path, 'cpulist'), 'w').write(cpus)
+        if set(allowed) >= set(range(4)):
+            self.assertEqual(_Affinity('spread', root).nodes, [[0, 1], [2, 3]])
+            self.assertEqual([_Affinity('spread', root).cpus(w) for w in 
+                              range(3)], [[0, 1], [2, 3], [0, 1]])
+            self.assertEqual([_Affinity('reserve', root).cpus(w) for w in 
+                              range(3)], [[1], [2], [3]])
+        affinity = _Affinity('compact', root)
+        self.assertEqual(affinity.compact, [cpu for cpu in range(4) if 
+                                            cpu in allowed] or allowed)
+        self.assertEqual(_Affinity([0, (1, 2)]).cpus(3), [1, 2])
+        self.assertRaises(ValueError, _Affinity, 'loose')
+        self.assertRaises(ValueError, NuMap, worker_type='thread', 
+                          affinity='compact')
+        # the workers are pinned
+        cpu = allowed[-1]
+        for start_method in ('fork', 'template'):
+            imap = NuMap(worker_num=2, affinity=[cpu], 
+                         start_method=start_method)
+            out = imap.add_task(pinned, range(4))
+            imap.start()
+            self.assertEqual(list(out), [[cpu]] * 4)
+            imap.stop(ends=[0])
+            self.assertEqual(imap.stats()['affinity']['workers'], [[cpu]] * 2)
+        imap = NuMap(worker_num=1, affinity='reserve')
+        out = imap.add_task(passer, range(4))
+        imap.start()
+        self.assertEqual(list(out), range(4))
+        imap.stop(ends=[0])
+        layout = imap.stats()['affinity']
+        self.assertEqual(layout['policy'], 'reserve')
+        if len(allowed) > 1:
+            self.assertEqual(layout['managers'], allowed[:1])
+            self.assertEqual(layout['workers'], [allowed[1:2]])
+
+    def test_item_timeout(self):
+        for wt in ('thread', 'process'):
+            imap = NuMap(worker_type=wt, worker_num=1)
+            out = imap.add_task(spinner, [0.01, 10, 0.01], item_timeout=0.5)
+            imap.start()
+            self.assertEqual(out.next(), 0.01)
+            self.assertRaises(TimeoutError, out.next)
+            self.assertEqual(out.next(), 0.01)
+            imap.stop(ends=[0])
+            stats = imap.stats()['tasks'][0]
+            self.assertEqual((stats['completed'], stats['failed']), (2, 1))
+            # a batch is a single call
+            imap = NuMap(worker_type=wt, worker_num=1, stride=2)
+            out = imap.add_task(spinners, [10, 0.01], item_timeout=0.2, 
+                                batch=2)
+            imap.start()
+            self.assertRaises(TimeoutError, out.next)
+            self.assertRaises(TimeoutError, out.next)
+            imap.stop(ends=[0])
+        # calls which end close to their timeout do not end the workers
+        imap = NuMap(worker_type='thread', worker_num=2)
+        out = imap.add_task(spinner, [0.0099] * 200, item_timeout=0.01)
+        imap.start()
+        timed_out = 0
+        for i in xrange(200):
+            try:
+                self.assertEqual(out.next(), 0.0099)
+            except TimeoutError:
+                timed_out += 1
+        imap.stop(ends=[0])
+        stats = imap.stats()['tasks'][0]
+        self.assertEqual(stats['completed'] + stats['failed'], 200)
+        self.assertEqual(stats['failed'], timed_out)
+        # the worker state is shared with the call
+        imap = NuMap(worker_type='thread', worker_num=1, 
+                     initializer=initializer, initargs=(10,))
+        out = imap.add_task(stateful, [1, 2], item_timeout=1)
+        imap.start()
+        self.assertEqual(list(out), [(11, 1), (12, 1)])
+        imap.stop(ends=[0])
+        if HASAIO:
+            self.assertRaises(ValueError, 
+                              NuMap(worker_type='asyncio').add_task, spinner, 
+                              [1], item_timeout=1)
+
+    def test_inline(self):
+        imap = NuMap(worker_type='inline')
+        out1 = imap.add_task(adder, range(10), track=True)
+        out2 = imap.add_task(miner, out1)
+        out3 = imap.add_task(diver, [1, 0, 2])
+        imap.start()
+        self.assertEqual(out3.next(), 1)
+        self.assertRaises(ZeroDivisionError, out3.next)
+        self.assertEqual(list(out2), range(10))
+        self.assertEqual(list(out3), [0])
+        self.assertEqual(imap._tasks_tracked[0], dict(zip(range(10), 
+                                                          range(1, 11))))
+        imap.stop(ends=[1, 2])
+        stats = imap.stats()
+        self.assertEqual(len(stats['workers']), 1)
+        self.assertEqual([(task['completed'], task['failed']) for task in 
+                          stats['tasks']], [(10, 0), (10, 0), (2, 1)])
+        # stopping does not evaluate further elements
+        imap = NuMap(worker_type='inline', initializer=initializer, 
+                     initargs=(10,))
+        out = imap.add_task(stateful, xrange(10 ** 9), cache=True)
+        imap.start()
+        self.assertEqual(out.next(), (10, 1))
+        imap.stop(ends=[0])
+        self.assertEqual(imap.stats()['tasks'][0]['submitted'], 1)
+        # elements are evaluated in the calling thread
+        imap = NuMap(worker_type='inline')
+        out = imap.add_task(threaded, [0])
+        imap.start()
+        self.assertEqual(list(out), [current_thread().name])
+        imap.stop(ends=[0])
+        # a batch is a single call
+        imap = NuMap(worker_type='inline')
+        out = imap.add_task(batcher, range(5), batch=2)
+        imap.start()
+        self.assertEqual(list(out), [(0, 2), (1, 2), (2, 2), (3, 2), (4, 1)])
+        imap.stop(ends=[0])
+        self.assertRaises(ValueError, NuMap, worker_type='inline', 
+                          worker_remote=[('localhost', 1)])
+
+    def test_reorder(self):
+        reorder = _Reorder(4)
+        for i in (2, 1, 3):
+            reorder.put(i, i)
+        self.assertEqual(reorder.pop(), None)
+        reorder.put(0, 0)
+        self.assertEqual(reorder.depth, 4)
+        self.assertEqual([reorder.pop() for i in range(5)], [0, 1, 2, 3, None])
+        # too early results grow the ring
+        reorder.put(9, 9)
+        reorder.put(5, 5)
+        self.assertEqual(len(reorder.ring), 8)
+        self.assertEqual(reorder.pop(), None)
+        # skipped results are returned
+        self.assertEqual(reorder.skip(2), [5])
+        self.assertEqual((reorder.last, reorder.depth), (5, 1))
+        for i in (6, 7, 8):
+            reorder.put(i, i)
+        self.assertEqual([reorder.pop() for i in range(5)], [6, 7, 8, 9, None])
+        self.assertEqual(reorder.ring, [None] * 8)
+        # results of a long stream
+        for ordered in (True, False):
+            imap = NuMap(worker_num=3, stride=5, ordered=ordered)
+            out = imap.add_task(passer, xrange(5000))
+            imap.start()
+            result = list(out)
+            if ordered:
+                self.assertEqual(result, range(5000))
+            else:
+                self.assertEqual(sorted(result), range(5000))
+            imap.stop(ends=[0])
+            self.assertEqual(imap.stats()['tasks'][0]['reorder_depth'], 0)
+
+    def test_unordered(self):
+        results = _Unordered()
+        self.assertRaises(Empty, results.get, block=False)
+        self.assertRaises(Empty, results.get, timeout=0.01)
+        results.extend([(0, True, 0), (1, True, 1)])
+        self.assertEqual([results.get(), results.get()], 
+                         [(0, True, 0), (1, True, 1)])
+        self.assertTrue(results.empty())
+        for wt in ('thread', 'process'):
+            imap = NuMap(worker_type=wt, worker_num=2, ordered=False, 
+                         chunksize=3)
+            # the first chunk of each worker is slow
+            out = imap.add_task(real_waiter, ([0.3] + [0.0] * 2) * 2 + \
+                                             [0.0] * 15)
+            imap.start()
+            self.assertTrue(isinstance(imap._task_results[0], _Unordered))
+            self.assertRaises(TimeoutError, imap.next, timeout=0.01)
+            # late results are not lost after a timeout
+            result = list(out)
+            self.assertEqual(sorted(result), [0.0] * 19 + [0.3] * 2)
+            imap.stop(ends=[0])
+        # the fast path is not used if results are skipped
+        imap = NuMap(ordered=False, skip=True)
+        imap.add_task(passer, [])
+        self.assertFalse(isinstance(imap._task_results[0], _Unordered))
+
     def test_iterinit_stop(self):
         for i in range(self.repeats):
             for wt in ('thread', 'process'):
@@ -19,7 +19,7 @@ from logging import getLogger
 from time import time
 import itertools, os, sys
 
-from numap.NuMap import _inject_func, imports, _Weave
+from numap.NuMap import _inject_func, imports, _Weave, _tracer
 
 # self-imports
 from graph import DictGraph
@@ -576,7 +576,8 @@ class Plumber(Dagger):
             i = piper.imap
             in_ = i.name if hasattr(i, 'name') else False
             if in_ and in_ not in idone:
-                icall += I_SIG % (in_, i.worker_type, i.worker_num, i.stride, \
+                stride = 'auto' if i.stride_auto else i.stride
+                icall += I_SIG % (in_, i.worker_type, i.worker_num, stride, \
                                   i.buffer, i.ordered, i.skip, in_)
                 idone.append(in_)
             ws = W_SIG % (",".join([t.__name__ for t in w.task]), w.args, w.kwargs)
@@ -1176,6 +1177,8 @@ class Piper(object):
         except StopIteration, excp:
             self.log.info('Piper %s has processed all jobs (finished)' % self)
             self.finished = True
+            if _tracer.on:
+                _tracer.record('stop', self.name)
             # We re-raise StopIteration as part of the iterator protocol.
             # And the outbox should do the same.
             raise excp
@@ -1209,6 +1212,9 @@ class Piper(object):
             if self.debug:
                 raise next
             self.log.info('Piper %s propagates %s' % (self, next[0]))
+        if _tracer.on:
+            _tracer.record('release', self.name, None, None, \
+                           not isinstance(next, PiperError))
         return next
 
 
@@ -1750,6 +1756,9 @@ class _TeePiper(object):
         if self.s == self.stride or self.finished:
             self.s = 1
             self.piper.tee_locks[(self.i + 1) % len(self.piper.tees)].release()
+            if _tracer.on:
+                _tracer.record('stop' if self.finished else 'release', \
+                               self.piper.name, self.i)
 
         else:
             self.s += 1
@@ -7,7 +7,7 @@ source code.
 
 """
 # imap call signature
-I_SIG = '    %s = NuMap(worker_type="%s", worker_num=%s, stride=%s, buffer=%s, ' + \
+I_SIG = '    %s = NuMap(worker_type="%s", worker_num=%s, stride=%r, buffer=%r, ' + \
                   'ordered =%s, skip =%s, name ="%s")\n'
 
 # piper call signature
@@ -8,8 +8,13 @@ Provides a (possibly shared, but not yet) dictionary.
 
 def get_runtime():
     """
-    Returns a PAPY_RUNTIME dictionary.
+    Returns a PAPY_RUNTIME dictionary. Within a ``NuMap`` **worker** it is the
+    persistent state of the **worker** see: ``numap.NuMap.worker_state``.
     
     """
-    PAPY_RUNTIME = {}
-    return PAPY_RUNTIME
+    try:
+        from numap.NuMap import worker_state
+    except ImportError:
+        PAPY_RUNTIME = {}
+        return PAPY_RUNTIME
+    return worker_state()